@@ -1,5 +1,16 @@
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+import argparse
+import os
+import sys
+
+# the repository root, so the modules of this project can import the
+# shared modules of common/ whatever the order of their imports
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import db
+from sql_queries import drop_table_queries, layout_create_queries, LAYOUTS
+from metrics import recorder
 
 
 def create_database():
@@ -8,41 +19,50 @@ def create_database():
     - Returns the connection and cursor to sparkifydb
     """
     
+    dbname = db.connect_params()['dbname']
+
     # connect to default database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=studentdb user=student password=student")
-    conn.set_session(autocommit=True)
+    conn = db.connect(db.ADMIN_DBNAME, autocommit=True)
     cur = conn.cursor()
     
     # create sparkify database with UTF8 encoding
-    cur.execute("DROP DATABASE IF EXISTS sparkifydb")
-    cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
+    cur.execute("DROP DATABASE IF EXISTS {}".format(dbname))
+    cur.execute("CREATE DATABASE {} WITH ENCODING 'utf8' TEMPLATE template0".format(dbname))
 
     # close connection to default database
-    conn.close()    
+    db.release(conn, db.ADMIN_DBNAME)
+    db.close_all()
     
     # connect to sparkify database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
+    conn = db.connect()
     cur = conn.cursor()
     
     return cur, conn
 
 
-def drop_tables(cur, conn):
+def drop_tables(cur, conn, policy=None):
     """
     Drops each table using the queries in `drop_table_queries` list.
+    Commits after each statement, or as the CommitPolicy says.
     """
+    policy = policy or db.CommitPolicy(conn, 'statement')
     for query in drop_table_queries:
         cur.execute(query)
-        conn.commit()
+    policy.stage_done()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, policy=None, layout='heap',
+                  first_month='2018-01', last_month='2019-12'):
     """
-    Creates each table using the queries in `create_table_queries` list. 
+    Creates each table using the queries in `create_table_queries` list,
+    or the partitioned layout's tables, indexes and rollup views with
+    the songplays partitions from first_month to last_month.
+    Commits after each statement, or as the CommitPolicy says.
     """
-    for query in create_table_queries:
+    policy = policy or db.CommitPolicy(conn, 'statement')
+    for query in layout_create_queries(layout, first_month, last_month):
         cur.execute(query)
-        conn.commit()
+    policy.stage_done()
 
 
 def main():
@@ -54,16 +74,49 @@ def main():
     
     - Drops all the tables.  
     
-    - Creates all tables needed. 
+    - Creates all tables needed. With --layout partitioned, songplays
+    is partitioned by month and the indexes and rollup views are added.
     
     - Finally, closes the connection. 
+
+    The connections come from db.py, which reads PGHOST, PGUSER, ...
+    from the environment.
+
+    - With --metrics, writes the time of each statement to a JSON-lines
+    or Prometheus .prom file.
     """
-    cur, conn = create_database()
+    parser = argparse.ArgumentParser(description='Create the sparkifydb tables.')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='append the statement timings to a JSON-lines '
+                        'file, or write a Prometheus .prom file')
+    parser.add_argument('--commit-policy', choices=['statement', 'stage', 'single'],
+                        default='statement',
+                        help='commit after every statement, after the drops '
+                        'and after the creates, or once at the end')
+    parser.add_argument('--layout', choices=LAYOUTS, default='heap',
+                        help='partitioned: monthly songplays partitions, '
+                        'lookup and analytics indexes and rollup views')
+    parser.add_argument('--first-month', default='2018-01', metavar='YYYY-MM',
+                        help='first songplays partition of the partitioned layout')
+    parser.add_argument('--last-month', default='2019-12', metavar='YYYY-MM',
+                        help='last songplays partition of the partitioned layout')
+    args = parser.parse_args()
+
+    with recorder.stage('create_database'):
+        cur, conn = create_database()
     
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    policy = db.CommitPolicy(conn, args.commit_policy)
+    with recorder.stage('drop_tables'):
+        drop_tables(cur, conn, policy)
+    with recorder.stage('create_tables'):
+        create_tables(cur, conn, policy, args.layout, args.first_month,
+                      args.last_month)
+    policy.finish()
 
-    conn.close()
+    db.release(conn)
+    db.close_all()
+    if args.metrics:
+        recorder.write(args.metrics)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,165 @@
+import os
+import threading
+from contextlib import contextmanager
+import psycopg2
+from metrics import recorder
+from common.db import Pool
+
+# connection settings and the libpq environment variables that override them
+SETTINGS = [('host', 'PGHOST', '127.0.0.1'),
+            ('port', 'PGPORT', '5432'),
+            ('dbname', 'PGDATABASE', 'sparkifydb'),
+            ('user', 'PGUSER', 'student'),
+            ('password', 'PGPASSWORD', 'student')]
+
+# database create_tables.py connects to while it recreates sparkifydb
+ADMIN_DBNAME = os.environ.get('SPARKIFY_ADMIN_DB', 'studentdb')
+
+# TCP keepalives, so a connection idling in the pool behind a NAT or load
+# balancer is noticed before a load tries to use it
+KEEPALIVES = {'keepalives': 1,
+              'keepalives_idle': int(os.environ.get('PGKEEPALIVESIDLE', 30)),
+              'keepalives_interval': 10,
+              'keepalives_count': 5}
+
+# statement timeout of every pooled connection, 0 for none
+STATEMENT_TIMEOUT_MS = int(os.environ.get('SPARKIFY_STATEMENT_TIMEOUT_MS', 0))
+
+# connections per process and database
+POOL_SIZE = int(os.environ.get('SPARKIFY_POOL_SIZE', 4))
+
+# when a load commits: after every statement (autocommit), every N files or
+# batches, at the end of each stage, or once at the end of the run
+COMMIT_POLICIES = ['statement', 'files', 'stage', 'single']
+
+# pools of this process by (pid, dbname); a forked worker gets its own
+_pools = {}
+_lock = threading.Lock()
+
+
+def connect_params(dbname=None):
+    """
+    Returns the psycopg2.connect keyword arguments for dbname (default
+    sparkifydb), with keepalives and the statement timeout.
+    """
+    params = {name: os.environ.get(env, default)
+              for name, env, default in SETTINGS}
+    if dbname:
+        params['dbname'] = dbname
+    params.update(KEEPALIVES)
+    if STATEMENT_TIMEOUT_MS:
+        params['options'] = '-c statement_timeout={}'.format(
+            STATEMENT_TIMEOUT_MS)
+    return params
+
+
+def get_pool(dbname=None):
+    """Returns this process's pool for dbname, creating it on first use."""
+    key = (os.getpid(), dbname)
+    with _lock:
+        if key not in _pools:
+            _pools[key] = Pool(POOL_SIZE, **connect_params(dbname))
+        return _pools[key]
+
+
+def connect(dbname=None, autocommit=False):
+    """
+    Returns a pooled connection to dbname (default sparkifydb) whose
+    cursors record into the metrics recorder. Hand it back with release.
+    """
+    conn = get_pool(dbname).getconn()
+    conn.autocommit = autocommit
+    return recorder.instrument(conn)
+
+
+def release(conn, dbname=None):
+    """Rolls back anything left uncommitted and returns conn to its pool."""
+    if not conn.closed:
+        try:
+            conn.rollback()
+            conn.autocommit = False
+        except psycopg2.Error:
+            pass
+    get_pool(dbname).putconn(conn)
+
+
+def close_all():
+    """Closes every pooled connection of this process."""
+    with _lock:
+        for key in [key for key in _pools if key[0] == os.getpid()]:
+            _pools.pop(key).closeall()
+
+
+class CommitPolicy:
+    """
+    Commits a load's transaction according to one of COMMIT_POLICIES.
+    With 'statement' the connection is switched to autocommit. Otherwise
+    each file or batch runs in a savepoint through `unit`, so a file that
+    fails is rolled back alone and the load carries on with the next one.
+    on_commit and on_rollback are called after the transaction commits
+    and after a unit is rolled back, to keep process-local caches such as
+    the time cache in step with the database.
+    """
+
+    def __init__(self, conn, policy='files', every=1, on_commit=(),
+                 on_rollback=()):
+        if policy not in COMMIT_POLICIES:
+            raise ValueError('unknown commit policy {!r}'.format(policy))
+        self.conn = conn
+        self.policy = policy
+        self.every = max(1, every)
+        self.on_commit = list(on_commit)
+        self.on_rollback = list(on_rollback)
+        self.units = 0
+        self.failed = []
+        conn.autocommit = policy == 'statement'
+
+    def commit(self):
+        if not self.conn.autocommit:
+            self.conn.commit()
+        for callback in self.on_commit:
+            callback()
+
+    @contextmanager
+    def unit(self, name):
+        """
+        Runs the block in a savepoint. If it raises, the savepoint is
+        rolled back, (name, error) is added to `failed` and the exception
+        is swallowed. With the 'statement' policy there is no transaction
+        to hold a savepoint, and the exception is raised.
+        """
+        if self.conn.autocommit:
+            yield
+            self.unit_done()
+            return
+
+        cur = self.conn.cursor()
+        cur.execute("SAVEPOINT load_unit")
+        try:
+            yield
+        except Exception as e:
+            cur.execute("ROLLBACK TO SAVEPOINT load_unit")
+            for callback in self.on_rollback:
+                callback()
+            self.failed.append((name, e))
+            print('{} rolled back: {}'.format(name, e))
+            return
+        cur.execute("RELEASE SAVEPOINT load_unit")
+        self.unit_done()
+
+    def unit_done(self):
+        self.units += 1
+        if self.policy == 'statement' or \
+                (self.policy == 'files' and self.units % self.every == 0):
+            self.commit()
+
+    def stage_done(self):
+        if self.policy != 'single':
+            self.commit()
+
+    def finish(self):
+        """Commits whatever is left and reports the failed units."""
+        self.commit()
+        if self.failed:
+            print('{} files rolled back: {}'.format(
+                len(self.failed), ', '.join(name for name, _ in self.failed)))
@@ -1,89 +1,169 @@
 import os
+import sys
+import io
 import glob
+import time
+import argparse
+import multiprocessing
+import multiprocessing.util
 import psycopg2
 import pandas as pd
+from functools import partial
+
+# the repository root, so the modules of this project can import the
+# shared modules of common/ whatever the order of their imports
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
 from sql_queries import *
+import db
+from song_index import SongIndex
+from readers import nulls_to_none, iter_log_chunks, SONG_SCHEMA, LOG_SCHEMA, \
+    LOG_CHUNK_SCHEMA
+from manifest import load_manifest, pending_files, record_files
+from time_dim import time_frame, time_cache
+from metrics import recorder
+from common.scheduler import Stage, Scheduler
+from staging_cache import staging_cache
+import quality
+
+# retries for a file whose transaction lost a deadlock in parallel mode
+DEADLOCK_RETRIES = 3
+
+# per-process connection and song index used by the worker pool
+_worker = {}
+
+# log columns the songplays stage of --parallel-stages needs
+SONGPLAY_COLUMNS = ['ts', 'userId', 'level', 'song', 'artist', 'length',
+                    'sessionId', 'location', 'userAgent']
 
 
-def process_song_file(cur, filepath):
+def process_song_file(cur, filepath, song_index=None):
     '''
-    Inputs cur: Database cursor, filepath: filepath of a song file
+    Inputs cur: Database cursor, filepath: filepath of a song file,
+    song_index: optional SongIndex to add the song to
     Reads a json song file into a pandas DataFrame
-    Extracts the song data record and inserts into the song table.
-    Extract the artist data record and inserts into the artist table.
+    Extracts the song data records and inserts into the song table.
+    Extract the artist data records and inserts into the artist table.
     '''
-    # open song file
-    df = pd.read_json(filepath, lines=True)
+    # open song file, or its parsed copy in the staging cache
+    df = staging_cache.read(filepath, SONG_SCHEMA)
 
-    # insert song record
-    song_data = df[['song_id', 'title', 'artist_id', 'year', 'duration']]\
-        .values[0].tolist()
-    cur.execute(song_table_insert, song_data)
-
-    # insert artist record
-    artist_df = df[['artist_id', 'artist_name', 'artist_location',
-                    'artist_latitude', 'artist_longitude']]
     # change nans to None, so that these records are NULL in the DB table
-    # https://stackoverflow.com/questions/32107558/how-do-i-convert-numpy-nan-objects-to-sql-nulls
-    artist_df = artist_df.where(pd.notnull(artist_df), None)
-    artist_data = artist_df.values[0].tolist()
-    cur.execute(artist_table_insert, artist_data)
+    records = nulls_to_none(df)
+
+    # insert song records
+    song_data = records[['song_id', 'title', 'artist_id', 'year',
+                         'duration']].values.tolist()
+    for row in song_data:
+        cur.execute(song_table_insert, row)
 
+    # insert artist records
+    artist_data = records[['artist_id', 'artist_name', 'artist_location',
+                           'artist_latitude', 'artist_longitude']]\
+        .values.tolist()
+    for row in artist_data:
+        cur.execute(artist_table_insert, row)
 
-def process_log_file(cur, filepath):
+    if song_index is not None:
+        song_index.add(df)
+
+
+def process_log_file(cur, filepath, song_index=None, chunksize=None):
     '''
-    Inputs cur: Database cursor, filepath: filepath of a log file
+    Inputs cur: Database cursor, filepath: filepath of a log file,
+    song_index: optional SongIndex used instead of a song_select per row,
+    chunksize: optional number of lines to read at a time
     Reads a json log file into a pandas DataFrame
     Filters the dataframe to only contain records where page == "NextSong"
-    Pulls the timestamp and inserts the time data into the time table
-    Inserts the user information into the user table.
-    Inserts songplay data into the songplay table.
+    and loads it with insert_log_frame. With chunksize, the file is
+    streamed in chunks of that many lines with compact dtypes, so memory
+    use does not grow with the file size.
+    '''
+    for df in read_log_frames(filepath, chunksize):
+        insert_log_frame(cur, df, song_index)
+
+
+def read_log_frames(filepath, chunksize=None):
     '''
+    Inputs filepath: filepath of a log file,
+    chunksize: optional number of lines to read at a time
+    Yields the NextSong records of the log file, as one DataFrame or, with
+    chunksize, one per chunk. Both are read through the staging cache.
+    '''
+    if chunksize:
+        yield from staging_cache.iter_chunks(
+            filepath, LOG_CHUNK_SCHEMA, chunksize,
+            partial(iter_log_chunks, chunksize=chunksize))
+        return
+
     # open log file
-    df = pd.read_json(filepath, lines=True)
+    df = staging_cache.read(filepath, LOG_SCHEMA)
 
     # filter by NextSong action
-    df = df[df.page == "NextSong"]
+    yield df[df.page == "NextSong"]
 
-    # convert timestamp column to datetime
-    t = pd.to_datetime(df['ts'], unit='ms')
 
-    # insert time data records
-    time_data = [t, t.dt.hour, t.dt.day, t.dt.week,
-                 t.dt.month, t.dt.year, t.dt.weekday]
-    column_labels = ['start_time', 'hour', 'day',
-                     'week', 'month', 'year', 'weekday']
+def insert_log_frame(cur, df, song_index=None):
+    '''
+    Inputs cur: Database cursor, df: NextSong records of a log file,
+    song_index: optional SongIndex used instead of a song_select per row
+    Inserts the time, user and songplay rows of the records.
+    '''
+    insert_log_dimensions(cur, df)
+    insert_songplays(cur, df, song_index)
 
-    # create dictionary where the key is the column label
-    # and the value is the time data
-    pandas_dict = {}
-    for i in range(len(time_data)):
-        pandas_dict[column_labels[i]] = time_data[i]
-    # convert the dictionary to a dataframe
-    time_df = time_df = pd.DataFrame(pandas_dict)[column_labels]
 
-    # insert each df row into the time table
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
+def insert_log_dimensions(cur, df):
+    '''
+    Inputs cur: Database cursor, df: NextSong records of a log file
+    Pulls the timestamp and inserts the time data into the time table
+    Inserts the user information into the user table.
+    Neither needs the songs, so --parallel-stages runs this while the
+    song files are still loading.
+    '''
+    # build the time rows for the distinct timestamps not loaded yet
+    time_df = time_cache.filter(time_frame(df['ts']))
+
+    # insert each time row, in key order so that
+    # concurrent loaders take row locks in the same order
+    for row in time_df.astype(object).values.tolist():
+        cur.execute(time_table_insert, row)
 
     # load user table
-    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level', 'ts']]
+    user_df = user_df.sort_values('userId', kind='mergesort')
 
     # insert user records
-    for i, row in user_df.iterrows():
+    for row in nulls_to_none(user_df).values.tolist():
         cur.execute(user_table_insert, row)
 
+
+def insert_songplays(cur, df, song_index=None):
+    '''
+    Inputs cur: Database cursor, df: NextSong records of a log file,
+    song_index: optional SongIndex used instead of a song_select per row
+    Inserts songplay data into the songplay table.
+    '''
+    # resolve songid and artistid for every row at once
+    if song_index is not None:
+        song_ids = song_index.resolve(df)
+
     # insert songplay records
     for index, row in df.iterrows():
 
         # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-
-        if results:
-            songid, artistid = results
+        if song_index is not None:
+            songid, artistid = song_ids.loc[index]
         else:
-            songid, artistid = None, None
+            cur.execute(song_select, (row.song, row.artist, row.length))
+            results = cur.fetchone()
+
+            if results:
+                songid, artistid = results
+            else:
+                songid, artistid = None, None
 
         # insert songplay record
         songplay_data = (pd.to_datetime(row['ts'], unit='ms'), row['userId'],
@@ -93,41 +173,545 @@ def process_log_file(cur, filepath):
         cur.execute(songplay_table_insert, songplay_data)
 
 
-def process_data(cur, conn, filepath, func):
+def get_files(filepath):
     '''
-    Inputs: cur - database cursor, conn - the datebase connection,
-    func - process_log_file or process_song_file
-    Iterate over every file and run the process_log_file or
-    process_song_file on it depending on which file it is.
-    Commits changes to the database.
+    Inputs: filepath - directory to search
+    Returns the absolute path of every json file under filepath, sorted,
+    so that the dated log files load oldest first.
     '''
-    # get all files matching extension from directory
     all_files = []
     for root, dirs, files in os.walk(filepath):
         files = glob.glob(os.path.join(root, '*.json'))
         for f in files:
             all_files.append(os.path.abspath(f))
 
+    return sorted(all_files)
+
+
+def get_pending_files(cur, filepath, incremental=False):
+    '''
+    Inputs: cur - database cursor, filepath - directory to search,
+    incremental - skip files already recorded in etl_manifest
+    Returns a manifest FileEntry for every json file under filepath
+    that should be loaded.
+    '''
+    all_files = get_files(filepath)
+    manifest = load_manifest(cur) if incremental else None
+    entries = pending_files(all_files, manifest)
+
+    print('{} files found in {}, {} to load'
+          .format(len(all_files), filepath, len(entries)))
+    return entries
+
+
+def commit_policy(conn, policy='files', every=1):
+    '''
+    Inputs: conn - the database connection, policy - one of
+    db.COMMIT_POLICIES, every - files or batches per commit
+    Returns a CommitPolicy that keeps the time cache in step with the
+    transaction.
+    '''
+    return db.CommitPolicy(conn, policy, every,
+                           on_commit=[time_cache.commit],
+                           on_rollback=[time_cache.rollback])
+
+
+def process_data(cur, conn, filepath, func, incremental=False, policy=None):
+    '''
+    Inputs: cur - database cursor, conn - the datebase connection,
+    func - process_log_file or process_song_file,
+    incremental - only load files that are new or changed since the
+    last run, policy - CommitPolicy, by default a commit per file
+    Iterate over every file and run the process_log_file or
+    process_song_file on it depending on which file it is.
+    Each file and its etl_manifest record are loaded in a savepoint,
+    so a file that fails is rolled back alone and retried by the next
+    incremental run. Commits as the policy says.
+    '''
+    policy = policy or commit_policy(conn)
+
+    # get all files matching extension from directory
+    entries = get_pending_files(cur, filepath, incremental)
+
     # get total number of files found
-    num_files = len(all_files)
-    print('{} files found in {}'.format(num_files, filepath))
+    num_files = len(entries)
 
     # iterate over files and process
-    for i, datafile in enumerate(all_files, 1):
-        func(cur, datafile)
-        conn.commit()
+    for i, entry in enumerate(entries, 1):
+        with policy.unit(entry.path):
+            with recorder.file(entry.path):
+                func(cur, entry.path)
+            record_files(cur, [entry])
         print('{}/{} files processed.'.format(i, num_files))
 
+    policy.stage_done()
+
+
+def init_worker(with_song_index=False, explain=None):
+    '''
+    Inputs: with_song_index - build a SongIndex,
+    explain - the metrics recorder's explain mode
+    Pool initializer: takes the worker process's own connection from its
+    db pool and, for the log phase, loads a SongIndex from the songs
+    already committed. The connections are closed by close_worker when
+    the worker exits.
+    '''
+    recorder.explain = explain
+    multiprocessing.util.Finalize(None, close_worker, exitpriority=10)
+    conn = db.connect()
+    _worker['conn'] = conn
+    _worker['cur'] = conn.cursor()
+    _worker['song_index'] = None
+
+    if with_song_index:
+        _worker['song_index'] = SongIndex()
+        _worker['song_index'].load(_worker['cur'])
+
+
+def close_worker():
+    '''
+    Pool finalizer: hands the worker's connection back and closes every
+    connection of the worker process's db pool.
+    '''
+    conn = _worker.pop('conn', None)
+    if conn is not None:
+        db.release(conn)
+    db.close_all()
+
+
+def process_files(task):
+    '''
+    Inputs: task - (func, list of manifest FileEntry)
+    Runs func on each file with the worker's connection, committing per
+    file with its etl_manifest record. A file that loses a deadlock is
+    rolled back and retried.
+    Returns the number of files processed and the worker's metrics
+    records since the previous task.
+    '''
+    func, entries = task
+    cur, conn = _worker['cur'], _worker['conn']
+    if _worker['song_index'] is not None:
+        func = partial(func, song_index=_worker['song_index'])
+
+    for entry in entries:
+        for attempt in range(DEADLOCK_RETRIES):
+            try:
+                with recorder.file(entry.path):
+                    func(cur, entry.path)
+                record_files(cur, [entry])
+                conn.commit()
+                time_cache.commit()
+                break
+            except psycopg2.extensions.TransactionRollbackError:
+                conn.rollback()
+                time_cache.rollback()
+                if attempt == DEADLOCK_RETRIES - 1:
+                    raise
+
+    return len(entries), recorder.drain()
+
+
+def process_data_parallel(filepath, func, workers,
+                          with_song_index=False, files_per_task=100,
+                          incremental=False):
+    '''
+    Inputs: filepath - directory of json files,
+    func - process_log_file or process_song_file, workers - pool size,
+    with_song_index - resolve songplays from a per-worker SongIndex,
+    files_per_task - files handed to a worker at a time,
+    incremental - only load files that are new or changed
+    Processes the files on a pool of worker processes, each with its own
+    connection. Returns once every file has been committed, so a song
+    phase is complete before a following log phase starts.
+    '''
+    conn = db.connect()
+    entries = get_pending_files(conn.cursor(), filepath, incremental)
+    db.release(conn)
+    num_files = len(entries)
+
+    tasks = [(func, entries[i:i + files_per_task])
+             for i in range(0, num_files, files_per_task)]
+
+    with multiprocessing.Pool(workers, initializer=init_worker,
+                              initargs=(with_song_index,
+                                        recorder.explain)) as pool:
+        done = 0
+        for num, records in pool.imap_unordered(process_files, tasks):
+            recorder.merge(records)
+            done += num
+            print('{}/{} files processed.'.format(done, num_files))
+        # let the workers exit, and run close_worker, rather than be
+        # terminated when the with block ends
+        pool.close()
+        pool.join()
+
+
+def song_staging_frames(df):
+    '''
+    Inputs: df - DataFrame of song file records
+    Returns (staging table, DataFrame) pairs for the songs and artists
+    staging tables.
+    '''
+    song_df = df[['song_id', 'title', 'artist_id', 'year', 'duration']]
+
+    artist_df = df[['artist_id', 'artist_name', 'artist_location',
+                    'artist_latitude', 'artist_longitude']]
+    artist_df.columns = ['artist_id', 'name', 'location',
+                         'latitude', 'longitude']
+
+    return [('songs_staging', song_df), ('artists_staging', artist_df)]
+
+
+def log_staging_frames(df):
+    '''
+    Inputs: df - DataFrame of log file records
+    Filters to NextSong events and returns (staging table, DataFrame)
+    pairs for the time, users and songplays staging tables.
+    '''
+    df = df[df.page == "NextSong"]
+    t = pd.to_datetime(df['ts'], unit='ms')
+
+    time_df = time_cache.filter(time_frame(df['ts']))
+
+    user_df = df[['ts', 'userId', 'firstName', 'lastName',
+                  'gender', 'level']]
+    user_df.columns = ['ts', 'user_id', 'first_name', 'last_name',
+                       'gender', 'level']
+
+    songplay_df = pd.DataFrame({'start_time': t, 'user_id': df['userId'],
+                                'level': df['level'], 'song': df['song'],
+                                'artist': df['artist'],
+                                'length': df['length'],
+                                'session_id': df['sessionId'],
+                                'location': df['location'],
+                                'user_agent': df['userAgent']})
+
+    return [('time_staging', time_df), ('users_staging', user_df),
+            ('songplays_staging', songplay_df)]
+
+
+def copy_dataframe(cur, df, table):
+    '''
+    Inputs: cur - database cursor, df - DataFrame, table - target table
+    Streams the DataFrame into the table with COPY ... FROM STDIN.
+    NaN and None are written as \\N, which COPY loads as NULL, so empty
+    strings stay empty strings as they do with the row inserts.
+    '''
+    buf = io.StringIO()
+    df.to_csv(buf, index=False, header=False, na_rep='\\N')
+    buf.seek(0)
+    cur.copy_expert("COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+                    .format(table, ', '.join(df.columns)), buf)
+
+
+def process_data_bulk(cur, conn, filepath, schema, frames_func,
+                      insert_queries, batch_size=500, policy=None,
+                      incremental=False):
+    '''
+    Inputs: cur - database cursor, conn - the database connection,
+    filepath - directory of json files, schema - SONG_SCHEMA or LOG_SCHEMA,
+    frames_func - song_staging_frames or log_staging_frames,
+    insert_queries - set-based upserts from the staging tables,
+    batch_size - number of files read per batch,
+    policy - CommitPolicy whose units are batches, by default a commit
+    per batch,
+    incremental - only load files that are new or changed
+    COPYs each batch of files into the staging tables, upserts the batch
+    into the star schema and empties the staging tables again. The
+    batch's etl_manifest records are committed with its rows, and a
+    batch that fails is rolled back alone.
+    Returns the number of staged rows.
+    '''
+    policy = policy or commit_policy(conn)
+    entries = get_pending_files(cur, filepath, incremental)
+    num_files = len(entries)
+
+    for query in staging_table_creates:
+        cur.execute(query)
+
+    num_rows = 0
+    for batch, start in enumerate(range(0, num_files, batch_size), 1):
+        files = entries[start:start + batch_size]
+        with policy.unit('batch {} ({})'.format(batch, files[0].path)):
+            with recorder.measure('stage', 'read_json_files') as stats:
+                df = staging_cache.read_files(
+                    [e.path for e in files], schema,
+                    {e.path: e.sha256 for e in files})
+                stats['rows'] = len(df)
+                stats['bytes'] = sum(e.size for e in files)
+
+            tables, batch_rows = [], 0
+            for table, frame in frames_func(df):
+                copy_dataframe(cur, frame, table)
+                tables.append(table)
+                batch_rows += len(frame)
+
+            for query in insert_queries:
+                cur.execute(query)
+            cur.execute("TRUNCATE {}".format(', '.join(tables)))
+            record_files(cur, files)
+            num_rows += batch_rows
+        print('{}/{} files processed.'.format(start + len(files), num_files))
+
+    policy.stage_done()
+    return num_rows
+
+
+def load_stages(args):
+    '''
+    Inputs: args - the parsed command line of main
+    Returns the scheduler Stages of a --parallel-stages load, each on its
+    own connection and commit policy. The song files load while the log
+    files are parsed and their time and user rows inserted, since neither
+    needs the other. The NextSong rows of the logs are kept in memory
+    until the songplays stage, which waits for both and resolves them
+    against the committed songs. A log file's etl_manifest record is
+    committed with its songplays, so an interrupted run loads it again.
+    '''
+    parsed = []
+
+    def song_data():
+        conn = db.connect()
+        try:
+            # the time cache follows the log stage's transaction only
+            policy = db.CommitPolicy(conn, args.commit_policy,
+                                     args.commit_every)
+            process_data(conn.cursor(), conn, filepath='data/song_data',
+                         func=process_song_file,
+                         incremental=args.incremental, policy=policy)
+            policy.finish()
+        finally:
+            db.release(conn)
+
+    def log_dimensions():
+        conn = db.connect()
+        try:
+            cur = conn.cursor()
+            policy = commit_policy(conn, args.commit_policy, args.commit_every)
+            entries = get_pending_files(cur, 'data/log_data', args.incremental)
+            for entry in entries:
+                with policy.unit(entry.path):
+                    with recorder.file(entry.path):
+                        frames = list(read_log_frames(entry.path))
+                        for df in frames:
+                            insert_log_dimensions(cur, df)
+                    parsed.append((entry, [df[SONGPLAY_COLUMNS]
+                                           for df in frames]))
+            policy.finish()
+        finally:
+            db.release(conn)
+
+    def songplays():
+        conn = db.connect()
+        try:
+            cur = conn.cursor()
+            policy = db.CommitPolicy(conn, args.commit_policy,
+                                     args.commit_every)
+            # index every song in the database, including earlier runs
+            song_index = SongIndex()
+            song_index.load(cur)
+            for i, (entry, frames) in enumerate(parsed, 1):
+                with policy.unit(entry.path):
+                    for df in frames:
+                        insert_songplays(cur, df, song_index)
+                    record_files(cur, [entry])
+                print('{}/{} log files resolved.'.format(i, len(parsed)))
+            policy.finish()
+            print(song_index.summary())
+        finally:
+            db.release(conn)
+
+    return [Stage('song_data', song_data, []),
+            Stage('log_dimensions', log_dimensions, []),
+            Stage('songplays', songplays, ['song_data', 'log_dimensions'])]
+
 
 def main():
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb \
-                            user=student password=student")
+    parser = argparse.ArgumentParser(description='Load the Sparkify json '
+                                     'files into the sparkifydb tables.')
+    parser.add_argument('--bulk', action='store_true',
+                        help='COPY batches of files through staging tables')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='files per COPY batch in bulk mode')
+    parser.add_argument('--commit-policy', choices=db.COMMIT_POLICIES,
+                        default='files',
+                        help='commit after every statement, every '
+                        '--commit-every files (batches in bulk mode), every '
+                        'stage, or once at the end')
+    parser.add_argument('--commit-every', type=int, default=1,
+                        help='files, or batches in bulk mode, per commit '
+                        'with the files policy')
+    parser.add_argument('--chunk-size', type=int, metavar='LINES',
+                        help='stream each log file this many lines at a time '
+                        'with compact dtypes instead of reading it whole')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='worker processes used to load the files')
+    parser.add_argument('--parallel-stages', action='store_true',
+                        help='load the song files while the log files are '
+                        'parsed and their users and time rows inserted, '
+                        'then the songplays')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only load files that are new or changed '
+                        'since the last run')
+    parser.add_argument('--cache-dir', metavar='DIR',
+                        help='keep the parsed song files, and the files of '
+                        'bulk mode, as Arrow files in DIR for later runs')
+    parser.add_argument('--cache-size-mb', type=int, default=1024,
+                        help='size of the staging cache before the least '
+                        'recently used files are evicted')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='append query, file and stage timings to a '
+                        'JSON-lines file, or write a Prometheus .prom file')
+    parser.add_argument('--explain', choices=['plan', 'analyze'],
+                        help='record the plan of each sql_queries statement '
+                        'the first time it runs')
+    parser.add_argument('--skip-checks', action='store_true',
+                        help='do not run the data quality checks after the load')
+    parser.add_argument('--max-null-ratio', type=float, default=0.0,
+                        help='largest share of NULLs allowed in the checked '
+                        'columns')
+    parser.add_argument('--min-match-rate', type=float, default=0.0,
+                        help='smallest share of song plays that must be '
+                        'matched to a song')
+    parser.add_argument('--strict-checks', action='store_true',
+                        help='exit with status 1 when a check fails')
+    args = parser.parse_args()
+    if args.bulk and args.workers > 1:
+        parser.error('--bulk loads through one connection; it cannot be '
+                     'combined with --workers')
+    if args.parallel_stages and (args.bulk or args.workers > 1
+                                 or args.chunk_size):
+        parser.error('--parallel-stages keeps the parsed log files in memory '
+                     'and runs in this process; it cannot be combined with '
+                     '--bulk, --workers or --chunk-size')
+    if args.parallel_stages and args.commit_policy == 'single':
+        parser.error('--parallel-stages commits each stage on its own '
+                     'connection; use the stage or files commit policy')
+    recorder.explain = args.explain
+    if args.cache_dir:
+        staging_cache.configure(args.cache_dir, args.cache_size_mb << 20)
+
+    try:
+        load(args)
+        with recorder.stage('refresh_rollups'):
+            refresh_rollups()
+        if not args.skip_checks:
+            with recorder.stage('quality_checks'):
+                failed = check_quality(args)
+            if failed and args.strict_checks:
+                raise SystemExit(1)
+    finally:
+        db.close_all()
+        if args.metrics:
+            recorder.write(args.metrics)
+
+
+def load(args):
+    '''
+    Inputs: args - the parsed command line of main
+    Runs the song and log phases in the mode selected by args. The
+    commit policy applies to the serial, bulk and --parallel-stages
+    loads; parallel workers commit each file.
+    '''
+    if args.parallel_stages:
+        Scheduler(load_stages(args), workers=2, recorder=recorder).run()
+        if staging_cache.enabled:
+            staging_cache.evict()
+            print(staging_cache.summary())
+        return
+
+    if args.workers > 1:
+        with recorder.stage('song_data'):
+            process_data_parallel('data/song_data', process_song_file,
+                                  args.workers, incremental=args.incremental)
+        with recorder.stage('log_data'):
+            process_data_parallel('data/log_data',
+                                  partial(process_log_file,
+                                          chunksize=args.chunk_size),
+                                  args.workers, with_song_index=True,
+                                  incremental=args.incremental)
+        return
+
+    conn = db.connect()
     cur = conn.cursor()
+    policy = commit_policy(conn, args.commit_policy, args.commit_every)
+
+    if args.bulk:
+        start = time.time()
+        with recorder.stage('song_data') as stats:
+            num_rows = process_data_bulk(cur, conn, 'data/song_data',
+                                         SONG_SCHEMA, song_staging_frames,
+                                         song_bulk_insert_queries,
+                                         args.batch_size, policy,
+                                         args.incremental)
+            stats['rows'] = num_rows
+        with recorder.stage('log_data') as stats:
+            stats['rows'] = process_data_bulk(cur, conn, 'data/log_data',
+                                              LOG_SCHEMA, log_staging_frames,
+                                              log_bulk_insert_queries,
+                                              args.batch_size, policy,
+                                              args.incremental)
+        num_rows += stats['rows']
+        elapsed = time.time() - start
+        print('{} rows loaded in {:.1f}s ({:.0f} rows/sec).'
+              .format(num_rows, elapsed, num_rows / max(elapsed, 1e-9)))
+    else:
+        song_index = SongIndex()
+        with recorder.stage('song_data'):
+            process_data(cur, conn, filepath='data/song_data',
+                         func=process_song_file,
+                         incremental=args.incremental, policy=policy)
 
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+        # index every song in the database, including earlier runs
+        with recorder.stage('song_index'):
+            song_index.load(cur)
+        with recorder.stage('log_data'):
+            process_data(cur, conn, filepath='data/log_data',
+                         func=partial(process_log_file,
+                                      song_index=song_index,
+                                      chunksize=args.chunk_size),
+                         incremental=args.incremental, policy=policy)
+        print(song_index.summary())
 
-    conn.close()
+    policy.finish()
+    if staging_cache.enabled:
+        staging_cache.evict()
+        print(staging_cache.summary())
+    db.release(conn)
+
+
+def refresh_rollups():
+    '''
+    Refreshes the rollup views of the partitioned layout, if they exist,
+    with REFRESH MATERIALIZED VIEW CONCURRENTLY so that readers are not
+    blocked while they are rebuilt.
+    '''
+    conn = db.connect(autocommit=True)
+    try:
+        cur = conn.cursor()
+        cur.execute(rollup_select, (ROLLUPS,))
+        for (name,) in cur.fetchall():
+            cur.execute(rollup_refresh.format(name))
+    finally:
+        db.release(conn)
+
+
+def check_quality(args):
+    '''
+    Inputs: args - the parsed command line of main
+    Runs the data quality checks on the loaded tables and returns the
+    ones that failed.
+    '''
+    conn = db.connect(autocommit=True)
+    try:
+        results = quality.run_checks(conn.cursor(), quality.default_checks(
+            args.max_null_ratio, args.min_match_rate))
+    finally:
+        db.release(conn)
+    failed = [check for check, _, passed in results if not passed]
+    print('{} of {} data quality checks failed.'.format(len(failed),
+                                                        len(results)))
+    return failed
 
 
 if __name__ == "__main__":
@@ -0,0 +1,54 @@
+import os
+import hashlib
+from collections import namedtuple
+from sql_queries import manifest_select, manifest_table_insert
+
+# one ingested input file, as recorded in the etl_manifest table
+FileEntry = namedtuple('FileEntry', ['path', 'size', 'mtime', 'sha256'])
+
+
+def file_hash(path, block_size=1 << 20):
+    """Returns the sha256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(cur):
+    """Returns the etl_manifest table as a dict of path -> FileEntry."""
+    cur.execute(manifest_select)
+    return {row[0]: FileEntry(*row) for row in cur.fetchall()}
+
+
+def pending_files(filepaths, manifest=None):
+    """
+    Returns a FileEntry for every file that is not in `manifest` or whose
+    contents changed since it was recorded. Files with the recorded size
+    and mtime are skipped without being read; the others are hashed, so
+    a file that was only touched is skipped too.
+    """
+    manifest = manifest or {}
+    entries = []
+    for path in filepaths:
+        stat = os.stat(path)
+        known = manifest.get(path)
+        if known and known.size == stat.st_size \
+                and known.mtime == stat.st_mtime:
+            continue
+
+        entry = FileEntry(path, stat.st_size, stat.st_mtime, file_hash(path))
+        if known and known.sha256 == entry.sha256:
+            continue
+        entries.append(entry)
+
+    return entries
+
+
+def record_files(cur, entries):
+    """
+    Upserts the entries into etl_manifest. Call it before the commit of
+    the data loaded from those files, so both land in one transaction.
+    """
+    cur.executemany(manifest_table_insert, [tuple(e) for e in entries])
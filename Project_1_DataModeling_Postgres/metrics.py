@@ -0,0 +1,95 @@
+import os
+import psycopg2.extensions
+import sql_queries
+import common.metrics
+
+QUERY_NAMES = common.metrics.query_names(sql_queries)
+
+# statements EXPLAIN accepts
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def query_name(query):
+    """
+    Returns the sql_queries constant a statement comes from, or its first
+    words for statements built elsewhere.
+    """
+    return common.metrics.query_name(query, QUERY_NAMES)
+
+
+def explain(cur, query, vars=None, mode='plan'):
+    """
+    Returns the JSON plan of a statement. With mode 'analyze' the
+    statement is run by EXPLAIN ANALYZE, with buffer counts, inside a
+    savepoint that is rolled back, so its changes are not kept. Without
+    an open transaction to hold the savepoint, only the plan is taken.
+    """
+    analyze = mode == 'analyze' and not cur.connection.autocommit
+    options = 'ANALYZE, BUFFERS, FORMAT JSON' if analyze else 'FORMAT JSON'
+    execute = psycopg2.extensions.cursor.execute
+
+    if analyze:
+        execute(cur, "SAVEPOINT metrics_explain")
+    try:
+        execute(cur, "EXPLAIN ({}) {}".format(options, query), vars)
+        plan = cur.fetchone()[0]
+    finally:
+        if analyze:
+            execute(cur, "ROLLBACK TO SAVEPOINT metrics_explain")
+    return plan
+
+
+class Recorder(common.metrics.Recorder):
+    """
+    Aggregates the wall time, rows and bytes of the queries, files and
+    stages of a run by (kind, name), with the plan of the first run of
+    each named query when `explain` is 'plan' or 'analyze'.
+    `write` appends the totals to a JSON-lines file, or replaces a
+    Prometheus text file when the path ends in .prom.
+    """
+
+    COUNTERS = [('rows', 'Rows affected or returned.'),
+                ('bytes', 'Bytes read from files or sent with COPY.')]
+
+    def __init__(self, pipeline='postgres', explain=None):
+        super().__init__(pipeline, explain)
+
+    def file(self, path):
+        return self.measure('file', path, os.path.getsize(path))
+
+    def cursor_factory(self):
+        """Returns a cursor class that records every statement it runs."""
+        recorder = self
+
+        class MeasuredCursor(psycopg2.extensions.cursor):
+
+            def execute(self, query, vars=None):
+                name = query_name(query)
+                if recorder.explain and name not in recorder.plans \
+                        and query in QUERY_NAMES \
+                        and query.lstrip().upper().startswith(EXPLAINABLE):
+                    recorder.plans[name] = explain(self, query, vars,
+                                                   recorder.explain)
+                with recorder.measure('query', name) as stats:
+                    result = super().execute(query, vars)
+                    stats['rows'] = self.rowcount
+                return result
+
+            def executemany(self, query, vars_list):
+                with recorder.measure('query', query_name(query)) as stats:
+                    result = super().executemany(query, vars_list)
+                    stats['rows'] = self.rowcount
+                return result
+
+            def copy_expert(self, sql, file, size=8192):
+                with recorder.measure('query', query_name(sql)) as stats:
+                    result = super().copy_expert(sql, file, size)
+                    stats['rows'] = self.rowcount
+                    stats['bytes'] = file.tell()
+                return result
+
+        return MeasuredCursor
+
+
+# recorder of this process; etl.py and create_tables.py configure it
+recorder = Recorder()
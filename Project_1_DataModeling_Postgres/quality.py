@@ -0,0 +1,37 @@
+from sql_queries import quality_table_counts, quality_songplays, \
+    quality_dimensions
+from metrics import recorder, query_name
+from common.quality import Check, run_query_checks
+
+
+def default_checks(max_null_ratio=0.0, min_match_rate=0.0):
+    """
+    Returns the checks run after a load: every table has rows, no song
+    play has a NULL or orphan key or is loaded twice, songs and artists
+    are matched together, and the NULL ratios and the songplay match rate
+    are within the given limits.
+    """
+    checks = [Check(quality_table_counts, '{}_rows'.format(table), '>', 0)
+              for table in ('songplays', 'users', 'songs', 'artists', 'time')]
+    checks += [Check(quality_songplays, 'match_rate', '>=', min_match_rate),
+               Check(quality_songplays, 'level_null_ratio', '<=',
+                     max_null_ratio)]
+    checks += [Check(quality_songplays, column, '==', 0)
+               for column in ('partial_matches', 'orphan_song_ids',
+                              'orphan_artist_ids', 'orphan_user_ids',
+                              'orphan_start_times', 'duplicate_plays')]
+    checks += [Check(quality_dimensions, 'orphan_song_artists', '==', 0)]
+    checks += [Check(quality_dimensions, column, '<=', max_null_ratio)
+               for column in ('song_title_null_ratio', 'artist_name_null_ratio',
+                              'user_level_null_ratio')]
+    return checks
+
+
+def run_checks(cur, checks):
+    """
+    Runs each query of the checks once and evaluates its checks on the
+    row it returns. Query times are added to the metrics recorder as
+    'check' records. Prints a report and returns (check, value, passed)
+    for every check.
+    """
+    return run_query_checks(cur, checks, recorder, query_name)
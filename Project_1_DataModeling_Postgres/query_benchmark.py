@@ -0,0 +1,128 @@
+import argparse
+import statistics
+import time
+import os
+import sys
+
+# the repository root, so the modules of this project can import the
+# shared modules of common/ whatever the order of their imports
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import db
+from sql_queries import layout_create_queries, analytic_queries, rollup_queries, \
+    ROLLUPS, LAYOUTS
+
+# columns copied from the loaded sparkifydb tables into each layout
+TABLE_COLUMNS = {
+    'users': 'user_id, first_name, last_name, gender, level',
+    'songs': 'song_id, title, artist_id, year, duration',
+    'artists': 'artist_id, name, location, latitude, longitude',
+    'time': 'start_time, hour, day, week, month, year, weekday',
+}
+SONGPLAY_COLUMNS = 'user_id, level, song_id, artist_id, session_id, location, user_agent'
+
+
+def build_layout(cur, conn, layout, months):
+    """
+    Recreates a layout in the schema bench_<layout> and copies the loaded
+    tables into it. songplays is copied `months` times, each copy shifted
+    by one more month, so the fact table spans several partitions.
+    Returns the load time.
+    """
+    schema = 'bench_{}'.format(layout)
+    cur.execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0};".format(schema))
+    cur.execute("SET search_path TO {}, public".format(schema))
+    # the loaded song plays are of November 2018
+    last = 10 + months - 1
+    last_month = '{}-{:02d}'.format(2018 + last // 12, last % 12 + 1)
+    for query in layout_create_queries(layout, '2018-01', last_month):
+        cur.execute(query)
+    conn.commit()
+
+    start = time.time()
+    for table, columns in TABLE_COLUMNS.items():
+        cur.execute("INSERT INTO {0}.{1} ({2}) SELECT {2} FROM public.{1}"
+                    .format(schema, table, columns))
+    cur.execute("INSERT INTO {0}.songplays (start_time, {1}) \
+                 SELECT start_time + shift * interval '1 month', {1} \
+                 FROM public.songplays, generate_series(0, %s) AS shift"
+                .format(schema, SONGPLAY_COLUMNS), (months - 1,))
+    if layout == 'partitioned':
+        for name in ROLLUPS:
+            cur.execute("REFRESH MATERIALIZED VIEW {}.{}".format(schema, name))
+    conn.commit()
+    elapsed = time.time() - start
+
+    cur.execute("ANALYZE")
+    conn.commit()
+    return elapsed
+
+
+def time_query(cur, query, repeats):
+    """Runs a query once to warm the cache, then returns the median time
+    of `repeats` runs."""
+    cur.execute(query)
+    cur.fetchall()
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        cur.execute(query)
+        cur.fetchall()
+        times.append(time.time() - start)
+    return statistics.median(times)
+
+
+def main():
+    """
+    - Builds each layout in its own schema from the loaded sparkifydb
+    tables. Run create_tables.py and etl.py first.
+
+    - Times the analytic queries on each layout, and on the partitioned
+    layout also the rollup views that answer the same question.
+
+    - Prints the median latencies side by side.
+    """
+    parser = argparse.ArgumentParser(description='Time the analytic queries on '
+                                     'the heap and partitioned layouts.')
+    parser.add_argument('--layouts', nargs='+', choices=LAYOUTS, default=LAYOUTS)
+    parser.add_argument('--months', type=int, default=12,
+                        help='months of song plays, copied from the loaded month')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the bench_<layout> schemas')
+    args = parser.parse_args()
+
+    conn = db.connect()
+    cur = conn.cursor()
+
+    results = {}
+    for layout in args.layouts:
+        results[layout] = {'load': build_layout(cur, conn, layout, args.months)}
+        for name, query in analytic_queries.items():
+            results[layout][name] = time_query(cur, query, args.repeats)
+        if layout == 'partitioned':
+            results['rollups'] = {name: time_query(cur, query, args.repeats)
+                                  for name, query in rollup_queries.items()}
+        conn.commit()
+        print("{} done".format(layout))
+
+    columns = ['load'] + list(analytic_queries)
+    print("{:<14}".format('layout') + ''.join('{:>15}'.format(c) for c in columns))
+    for layout, times in results.items():
+        print("{:<14}".format(layout) + ''.join(
+            '{:>14.4f}s'.format(times[c]) if c in times else '{:>15}'.format('-')
+            for c in columns))
+
+    cur.execute("RESET search_path")
+    if not args.keep:
+        for layout in args.layouts:
+            cur.execute("DROP SCHEMA IF EXISTS bench_{} CASCADE".format(layout))
+        conn.commit()
+    db.release(conn)
+    db.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import json
+import pandas as pd
+
+# use the fastest json parser that is installed
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        loads = ujson.loads
+    except ImportError:
+        loads = json.loads
+
+
+# Column dtypes of the song and log json files. Nullable 'Int64' is used
+# for the int columns of song_table_create/artist_table_create and the
+# log fields loaded into users/songplays, so a missing value stays NULL
+# instead of turning the column into floats.
+
+SONG_SCHEMA = {
+    'num_songs': 'Int64',
+    'artist_id': 'object',
+    'artist_latitude': 'float64',
+    'artist_longitude': 'float64',
+    'artist_location': 'object',
+    'artist_name': 'object',
+    'song_id': 'object',
+    'title': 'object',
+    'duration': 'float64',
+    'year': 'Int64',
+}
+
+LOG_SCHEMA = {
+    'artist': 'object',
+    'auth': 'object',
+    'firstName': 'object',
+    'gender': 'object',
+    'itemInSession': 'Int64',
+    'lastName': 'object',
+    'length': 'float64',
+    'level': 'object',
+    'location': 'object',
+    'method': 'object',
+    'page': 'object',
+    'registration': 'float64',
+    'sessionId': 'Int64',
+    'song': 'object',
+    'status': 'Int64',
+    'ts': 'int64',
+    'userAgent': 'object',
+    'userId': 'Int64',
+}
+
+
+# Compact dtypes of the log fields process_log_file uses, for reading
+# large files in chunks: the low-cardinality strings are categoricals and
+# the counters 32-bit. length stays float64 so it matches song durations.
+LOG_CHUNK_SCHEMA = {
+    'artist': 'object',
+    'firstName': 'object',
+    'gender': 'category',
+    'itemInSession': 'Int32',
+    'lastName': 'object',
+    'length': 'float64',
+    'level': 'category',
+    'location': 'object',
+    'page': 'category',
+    'sessionId': 'Int32',
+    'song': 'object',
+    'ts': 'int64',
+    'userAgent': 'object',
+    'userId': 'Int32',
+}
+
+
+def columns_frame(columns, schema):
+    """
+    Builds a DataFrame with the dtypes of `schema` from a dict of column
+    name -> list of raw json values.
+    """
+    data = {}
+    for name, dtype in schema.items():
+        values = pd.Series(columns[name], dtype=object)
+        if dtype not in ('object', 'category'):
+            # '' is used for a missing userId in the log files
+            values = pd.to_numeric(values.where(values != ''),
+                                   errors='coerce')
+        data[name] = values.astype(dtype)
+
+    return pd.DataFrame(data, columns=list(schema))
+
+
+def read_json_files(filepaths, schema):
+    """
+    Reads every record of the json-lines files into one DataFrame with
+    the columns and dtypes of `schema`. Fields missing from a record are
+    read as null; fields not in the schema are ignored.
+    """
+    columns = {name: [] for name in schema}
+    for filepath in filepaths:
+        with open(filepath, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = loads(line)
+                for name, values in columns.items():
+                    values.append(record.get(name))
+
+    return columns_frame(columns, schema)
+
+
+def iter_log_chunks(filepath, chunksize=10000, schema=LOG_CHUNK_SCHEMA,
+                    page='NextSong'):
+    """
+    Reads a json-lines log file `chunksize` lines at a time and yields a
+    DataFrame of the records of each chunk whose page is `page`, with the
+    dtypes of `schema`. Lines without the page name are skipped before
+    they are parsed, so other events are never materialized, and memory
+    use is bounded by the chunk size instead of the file size.
+    """
+    marker = '"{}"'.format(page).encode('utf8')
+    columns = {name: [] for name in schema}
+    lines = 0
+    with open(filepath, 'rb') as f:
+        for line in f:
+            lines += 1
+            if marker in line:
+                record = loads(line)
+                if record.get('page') == page:
+                    for name, values in columns.items():
+                        values.append(record.get(name))
+
+            if lines == chunksize:
+                if columns['ts']:
+                    yield columns_frame(columns, schema)
+                columns = {name: [] for name in schema}
+                lines = 0
+
+    if columns['ts']:
+        yield columns_frame(columns, schema)
+
+
+def nulls_to_none(df):
+    """
+    Converts NaN/NA to None across the whole DataFrame in one step, so
+    that these values are NULL when the rows are sent to the database.
+    """
+    df = df.astype(object)
+    return df.where(df.notnull(), None)
@@ -0,0 +1,79 @@
+import pandas as pd
+from sql_queries import song_lookup_select
+
+
+class SongIndex:
+    """
+    In-memory (title, artist name, duration) -> (song_id, artist_id) index.
+    Replaces the per-row `song_select` query when loading log files.
+    Durations are matched after rounding to `tolerance` seconds so that
+    float values read from json and from the database compare equal.
+    """
+
+    key_columns = ['title', 'artist_name', 'duration_key']
+
+    def __init__(self, tolerance=0.001):
+        self.tolerance = tolerance
+        self.hits = 0
+        self.misses = 0
+        self._index = pd.DataFrame(columns=self.key_columns +
+                                   ['song_id', 'artist_id'])
+
+    def __len__(self):
+        return len(self._index)
+
+    def _duration_key(self, duration):
+        return (pd.to_numeric(duration, errors='coerce') /
+                self.tolerance).round()
+
+    def add(self, df):
+        """
+        Adds song file records (song_id, title, artist_id, artist_name,
+        duration) to the index. Keys that are already indexed keep their
+        first song_id/artist_id, like `song_select` with fetchone.
+        """
+        new = pd.DataFrame({'title': df['title'].values,
+                            'artist_name': df['artist_name'].values,
+                            'duration_key':
+                                self._duration_key(df['duration']).values,
+                            'song_id': df['song_id'].values,
+                            'artist_id': df['artist_id'].values})
+        # concatenating the empty initial index is deprecated in pandas
+        frames = [new] if self._index.empty else [self._index, new]
+        self._index = pd.concat(frames, ignore_index=True)\
+            .astype({'duration_key': 'float64'})\
+            .drop_duplicates(self.key_columns, keep='first')\
+            .reset_index(drop=True)
+
+    def load(self, cur):
+        """Rebuilds the index from the songs and artists tables."""
+        cur.execute(song_lookup_select)
+        df = pd.DataFrame(cur.fetchall(), columns=['song_id', 'artist_id',
+                                                   'title', 'artist_name',
+                                                   'duration'])
+        self._index = self._index.iloc[0:0]
+        self.add(df)
+
+    def resolve(self, df, title='song', artist='artist', duration='length'):
+        """
+        Looks up every row of a log DataFrame with a single merge.
+        Returns a DataFrame of song_id and artist_id aligned with df's
+        index; rows without a match are None.
+        """
+        keys = pd.DataFrame({'title': df[title].values,
+                             'artist_name': df[artist].values,
+                             'duration_key':
+                                 self._duration_key(df[duration]).values})
+        merged = keys.merge(self._index, how='left', on=self.key_columns)
+        merged.index = df.index
+
+        found = merged['song_id'].notnull()
+        self.hits += int(found.sum())
+        self.misses += int((~found).sum())
+
+        result = merged[['song_id', 'artist_id']].astype(object)
+        return result.where(result.notnull(), None)
+
+    def summary(self):
+        return 'song lookup: {} songs indexed, {} hits, {} misses'\
+            .format(len(self), self.hits, self.misses)
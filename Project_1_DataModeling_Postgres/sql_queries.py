@@ -1,10 +1,12 @@
 # DROP TABLES
 
+rollup_drop = "DROP MATERIALIZED VIEW IF EXISTS plays_per_day, plays_per_user, plays_per_song;"
 songplay_table_drop = "DROP TABLE IF EXISTS songplays;"
 user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs"
 artist_table_drop = "DROP TABLE IF EXISTS artists"
 time_table_drop = "DROP TABLE IF EXISTS time"
+manifest_table_drop = "DROP TABLE IF EXISTS etl_manifest"
 
 # CREATE TABLES
 
@@ -15,9 +17,11 @@ songplay_table_create = ("CREATE TABLE IF NOT EXISTS songplays \
                         varchar, session_id int, location \
                         varchar, user_agent varchar);")
 
+# level_ts is the ts of the event the level was taken from, so that an
+# older event loaded later does not overwrite it
 user_table_create = ("CREATE TABLE IF NOT EXISTS users (user_id int PRIMARY KEY, \
                     first_name varchar, last_name varchar, \
-                    gender varchar, level varchar);")
+                    gender varchar, level varchar, level_ts bigint);")
 
 song_table_create = ("CREATE TABLE IF NOT EXISTS songs (song_id varchar PRIMARY KEY, \
                     title varchar, artist_id varchar NOT NULL, year int, \
@@ -31,15 +35,141 @@ time_table_create = ("CREATE TABLE IF NOT EXISTS time (start_time timestamp PRIM
                     hour int, day int, week int, month int, \
                     year int, weekday int);")
 
+# PARTITIONED LAYOUT (create_tables.py --layout partitioned)
+# songplays is range-partitioned by month of start_time. The primary key
+# has to include the partition key. Months outside the created partitions
+# go to songplays_default.
+
+songplay_partitioned_create = ("CREATE TABLE IF NOT EXISTS songplays \
+                              (songplay_id SERIAL, start_time \
+                              timestamp NOT NULL, user_id int NOT NULL, level \
+                              varchar, song_id varchar, artist_id \
+                              varchar, session_id int, location \
+                              varchar, user_agent varchar, \
+                              PRIMARY KEY (songplay_id, start_time)) \
+                              PARTITION BY RANGE (start_time);")
+
+songplay_partition_create = ("CREATE TABLE IF NOT EXISTS songplays_{year}_{month:02d} \
+                             PARTITION OF songplays FOR VALUES \
+                             FROM ('{year}-{month:02d}-01') TO ('{next}-01');")
+
+songplay_default_partition_create = ("CREATE TABLE IF NOT EXISTS songplays_default \
+                                     PARTITION OF songplays DEFAULT;")
+
+# indexes of the song lookup (song_select, song_lookup_select and the bulk
+# songplay insert) and of the usual time, user and song analytics. The
+# INCLUDE columns let the lookups be answered from the index alone.
+index_create_queries = [
+    "CREATE INDEX IF NOT EXISTS songplays_start_time_idx ON songplays (start_time);",
+    "CREATE INDEX IF NOT EXISTS songplays_user_id_idx ON songplays (user_id, start_time);",
+    "CREATE INDEX IF NOT EXISTS songplays_song_id_idx ON songplays (song_id);",
+    "CREATE INDEX IF NOT EXISTS songs_title_idx ON songs (title, duration) \
+     INCLUDE (song_id, artist_id);",
+    "CREATE INDEX IF NOT EXISTS artists_name_idx ON artists (name) INCLUDE (artist_id);",
+]
+
+# rollups of the song plays. REFRESH ... CONCURRENTLY needs a unique
+# index on each view, and lets queries read the view while it runs.
+rollup_create_queries = [
+    "CREATE MATERIALIZED VIEW IF NOT EXISTS plays_per_day AS \
+     SELECT start_time::date AS day, COUNT(*) AS plays, \
+     COUNT(DISTINCT user_id) AS users FROM songplays GROUP BY 1;",
+    "CREATE UNIQUE INDEX IF NOT EXISTS plays_per_day_idx ON plays_per_day (day);",
+    "CREATE MATERIALIZED VIEW IF NOT EXISTS plays_per_user AS \
+     SELECT user_id, COUNT(*) AS plays, MIN(start_time) AS first_play, \
+     MAX(start_time) AS last_play FROM songplays GROUP BY user_id;",
+    "CREATE UNIQUE INDEX IF NOT EXISTS plays_per_user_idx ON plays_per_user (user_id);",
+    "CREATE MATERIALIZED VIEW IF NOT EXISTS plays_per_song AS \
+     SELECT song_id, COUNT(*) AS plays FROM songplays \
+     WHERE song_id IS NOT NULL GROUP BY song_id;",
+    "CREATE UNIQUE INDEX IF NOT EXISTS plays_per_song_idx ON plays_per_song (song_id);",
+]
+
+ROLLUPS = ['plays_per_day', 'plays_per_user', 'plays_per_song']
+
+rollup_select = "SELECT matviewname FROM pg_matviews \
+                 WHERE schemaname = ANY (current_schemas(false)) \
+                 AND matviewname = ANY (%s)"
+
+rollup_refresh = "REFRESH MATERIALIZED VIEW CONCURRENTLY {}"
+
+LAYOUTS = ['heap', 'partitioned']
+
+
+def songplay_partition_creates(first_month='2018-01', last_month='2019-12'):
+    """
+    Returns the CREATE statements of the monthly songplays partitions from
+    first_month to last_month (YYYY-MM), inclusive.
+    """
+    year, month = map(int, first_month.split('-'))
+    last = tuple(map(int, last_month.split('-')))
+    queries = []
+    while (year, month) <= last:
+        next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+        queries.append(songplay_partition_create.format(
+            year=year, month=month,
+            next='{}-{:02d}'.format(next_year, next_month)))
+        year, month = next_year, next_month
+    return queries
+
+
+def layout_create_queries(layout='heap', first_month='2018-01',
+                          last_month='2019-12'):
+    """
+    Returns the CREATE statements of a layout: 'heap' is the original
+    schema, 'partitioned' adds the monthly songplays partitions, the
+    indexes and the rollup views.
+    """
+    if layout == 'heap':
+        return create_table_queries
+    return ([songplay_partitioned_create] +
+            songplay_partition_creates(first_month, last_month) +
+            [songplay_default_partition_create] +
+            [query for query in create_table_queries
+             if query != songplay_table_create] +
+            index_create_queries + rollup_create_queries)
+
+
+# ANALYTIC QUERIES
+# Song play analysis timed by query_benchmark.py. rollup_queries answer
+# the same questions from the rollup views of the partitioned layout.
+
+analytic_queries = {
+    'plays_per_day': "SELECT start_time::date, COUNT(*) FROM songplays \
+                      GROUP BY 1 ORDER BY 1",
+    'plays_in_week': "SELECT COUNT(*) FROM songplays \
+                      WHERE start_time >= '2018-11-01' AND start_time < '2018-11-08'",
+    'user_history': "SELECT start_time, song_id FROM songplays \
+                     WHERE user_id = 49 ORDER BY start_time",
+    'top_users': "SELECT user_id, COUNT(*) AS plays FROM songplays \
+                  GROUP BY user_id ORDER BY plays DESC LIMIT 10",
+    'top_songs': "SELECT song_id, COUNT(*) AS plays FROM songplays \
+                  WHERE song_id IS NOT NULL \
+                  GROUP BY song_id ORDER BY plays DESC LIMIT 10",
+    'song_lookup': "SELECT song_id, artists.artist_id FROM songs INNER JOIN artists \
+                    ON songs.artist_id = artists.artist_id \
+                    WHERE title = 'Setanta matins' AND name = 'Elena' \
+                    AND duration = 269.58322",
+}
+
+rollup_queries = {
+    'plays_per_day': "SELECT day, plays FROM plays_per_day ORDER BY day",
+    'top_users': "SELECT user_id, plays FROM plays_per_user \
+                  ORDER BY plays DESC LIMIT 10",
+    'top_songs': "SELECT song_id, plays FROM plays_per_song \
+                  ORDER BY plays DESC LIMIT 10",
+}
+
 # INSERT RECORDS
 
 songplay_table_insert = ("INSERT INTO songplays (start_time, user_id, level, song_id, \
                          artist_id, session_id, location, user_agent) \
                          VALUES (%s, %s, %s, %s, %s, %s, %s, %s)")
 
-user_table_insert = ("INSERT INTO users (user_id, first_name, last_name, gender, level) \
-                    VALUES (%s, %s, %s, %s, %s) ON CONFLICT (user_id) \
-                    DO UPDATE SET level = EXCLUDED.level")
+user_table_insert = ("INSERT INTO users (user_id, first_name, last_name, gender, level, \
+                    level_ts) VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (user_id) \
+                    DO UPDATE SET level = EXCLUDED.level, level_ts = EXCLUDED.level_ts \
+                    WHERE users.level_ts IS NULL OR users.level_ts < EXCLUDED.level_ts")
 
 song_table_insert = ("INSERT INTO songs (song_id, title, artist_id, year, duration) \
                     VALUES (%s, %s, %s, %s, %s) ON CONFLICT DO NOTHING")
@@ -51,16 +181,151 @@ artist_table_insert = ("INSERT INTO artists (artist_id, name, location, latitude
 time_table_insert = ("INSERT INTO time (start_time, hour, day, week, month, year, weekday) \
                   VALUES (%s, %s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING")
 
+# path, size, mtime and content hash of every input file already loaded
+manifest_table_create = ("CREATE TABLE IF NOT EXISTS etl_manifest \
+                        (path varchar PRIMARY KEY, size bigint NOT NULL, \
+                        mtime double precision NOT NULL, \
+                        sha256 char(64) NOT NULL, \
+                        loaded_at timestamp NOT NULL DEFAULT now());")
+
+# STAGING TABLES (bulk load mode)
+# Session-local tables that each batch of files is COPY'd into before the
+# set-based upserts below move the rows into the star schema.
+
+song_staging_create = ("CREATE TEMP TABLE IF NOT EXISTS songs_staging \
+                       (song_id varchar, title varchar, artist_id varchar, \
+                       year int, duration float);")
+
+artist_staging_create = ("CREATE TEMP TABLE IF NOT EXISTS artists_staging \
+                         (artist_id varchar, name varchar, location varchar, \
+                         latitude float, longitude float);")
+
+time_staging_create = ("CREATE TEMP TABLE IF NOT EXISTS time_staging \
+                       (start_time timestamp, hour int, day int, week int, \
+                       month int, year int, weekday int);")
+
+user_staging_create = ("CREATE TEMP TABLE IF NOT EXISTS users_staging \
+                       (ts bigint, user_id int, first_name varchar, \
+                       last_name varchar, gender varchar, level varchar);")
+
+songplay_staging_create = ("CREATE TEMP TABLE IF NOT EXISTS songplays_staging \
+                           (start_time timestamp, user_id int, level varchar, \
+                           song varchar, artist varchar, length float, \
+                           session_id int, location varchar, \
+                           user_agent varchar);")
+
+# BULK INSERT RECORDS
+# Same ON CONFLICT rules as the row inserts above, applied to a whole batch.
+
+song_table_bulk_insert = ("INSERT INTO songs (song_id, title, artist_id, year, duration) \
+                         SELECT song_id, title, artist_id, year, duration \
+                         FROM songs_staging ON CONFLICT DO NOTHING")
+
+artist_table_bulk_insert = ("INSERT INTO artists (artist_id, name, location, latitude, longitude) \
+                           SELECT artist_id, name, location, latitude, longitude \
+                           FROM artists_staging ON CONFLICT DO NOTHING")
+
+time_table_bulk_insert = ("INSERT INTO time (start_time, hour, day, week, month, year, weekday) \
+                         SELECT start_time, hour, day, week, month, year, weekday \
+                         FROM time_staging ON CONFLICT DO NOTHING")
+
+# DO UPDATE may only touch each user once per statement, so keep the
+# latest event for every user in the batch; it replaces the stored level
+# only when it is newer than the event that level came from.
+user_table_bulk_insert = ("INSERT INTO users (user_id, first_name, last_name, gender, level, \
+                         level_ts) SELECT DISTINCT ON (user_id) user_id, first_name, \
+                         last_name, gender, level, ts FROM users_staging \
+                         ORDER BY user_id, ts DESC ON CONFLICT (user_id) \
+                         DO UPDATE SET level = EXCLUDED.level, level_ts = EXCLUDED.level_ts \
+                         WHERE users.level_ts IS NULL OR users.level_ts < EXCLUDED.level_ts")
+
+songplay_table_bulk_insert = ("INSERT INTO songplays (start_time, user_id, level, song_id, \
+                             artist_id, session_id, location, user_agent) \
+                             SELECT sp.start_time, sp.user_id, sp.level, \
+                             s.song_id, s.artist_id, sp.session_id, \
+                             sp.location, sp.user_agent \
+                             FROM songplays_staging sp LEFT JOIN \
+                             (SELECT DISTINCT ON (title, name, duration) \
+                             song_id, artists.artist_id, title, name, duration \
+                             FROM songs INNER JOIN artists \
+                             ON songs.artist_id = artists.artist_id) s \
+                             ON sp.song = s.title AND sp.artist = s.name \
+                             AND sp.length = s.duration")
+
+manifest_table_insert = ("INSERT INTO etl_manifest (path, size, mtime, sha256) \
+                        VALUES (%s, %s, %s, %s) ON CONFLICT (path) \
+                        DO UPDATE SET size = EXCLUDED.size, \
+                        mtime = EXCLUDED.mtime, sha256 = EXCLUDED.sha256, \
+                        loaded_at = now()")
+
 # FIND SONGS
 
 song_select = "SELECT song_id, artists.artist_id FROM songs INNER JOIN artists \
                ON songs.artist_id = artists.artist_id \
                WHERE title =%s and name=%s and duration=%s"
 
+manifest_select = "SELECT path, size, mtime, sha256 FROM etl_manifest"
+
+song_lookup_select = "SELECT song_id, artists.artist_id, title, name, duration \
+                      FROM songs INNER JOIN artists \
+                      ON songs.artist_id = artists.artist_id"
+
+# DATA QUALITY CHECKS
+# Each query returns a single row of metrics over whole tables; quality.py
+# compares them with the thresholds of its checks.
+
+quality_table_counts = ("SELECT (SELECT COUNT(*) FROM songplays) AS songplays_rows, \
+                        (SELECT COUNT(*) FROM users) AS users_rows, \
+                        (SELECT COUNT(*) FROM songs) AS songs_rows, \
+                        (SELECT COUNT(*) FROM artists) AS artists_rows, \
+                        (SELECT COUNT(*) FROM time) AS time_rows")
+
+# match_rate is the share of song plays matched to a song; an orphan is a
+# key with no row in its dimension table
+quality_songplays = ("SELECT COALESCE(AVG(CASE WHEN sp.song_id IS NOT NULL \
+                     THEN 1.0 ELSE 0 END), 0) AS match_rate, \
+                     COALESCE(AVG(CASE WHEN sp.level IS NULL THEN 1.0 ELSE 0 END), 0) \
+                     AS level_null_ratio, \
+                     COALESCE(SUM(CASE WHEN (sp.song_id IS NULL) <> (sp.artist_id IS NULL) \
+                     THEN 1 ELSE 0 END), 0) AS partial_matches, \
+                     COALESCE(SUM(CASE WHEN sp.song_id IS NOT NULL AND s.song_id IS NULL \
+                     THEN 1 ELSE 0 END), 0) AS orphan_song_ids, \
+                     COALESCE(SUM(CASE WHEN sp.artist_id IS NOT NULL AND a.artist_id IS NULL \
+                     THEN 1 ELSE 0 END), 0) AS orphan_artist_ids, \
+                     COALESCE(SUM(CASE WHEN u.user_id IS NULL THEN 1 ELSE 0 END), 0) \
+                     AS orphan_user_ids, \
+                     COALESCE(SUM(CASE WHEN t.start_time IS NULL THEN 1 ELSE 0 END), 0) \
+                     AS orphan_start_times, \
+                     COUNT(*) - COUNT(DISTINCT (sp.user_id, sp.session_id, sp.start_time)) \
+                     AS duplicate_plays \
+                     FROM songplays sp \
+                     LEFT JOIN songs s ON sp.song_id = s.song_id \
+                     LEFT JOIN artists a ON sp.artist_id = a.artist_id \
+                     LEFT JOIN users u ON sp.user_id = u.user_id \
+                     LEFT JOIN time t ON sp.start_time = t.start_time")
+
+quality_dimensions = ("SELECT (SELECT COUNT(*) FROM songs s LEFT JOIN artists a \
+                      ON s.artist_id = a.artist_id WHERE a.artist_id IS NULL) \
+                      AS orphan_song_artists, \
+                      (SELECT COALESCE(AVG(CASE WHEN title IS NULL THEN 1.0 ELSE 0 END), 0) \
+                      FROM songs) AS song_title_null_ratio, \
+                      (SELECT COALESCE(AVG(CASE WHEN name IS NULL THEN 1.0 ELSE 0 END), 0) \
+                      FROM artists) AS artist_name_null_ratio, \
+                      (SELECT COALESCE(AVG(CASE WHEN level IS NULL THEN 1.0 ELSE 0 END), 0) \
+                      FROM users) AS user_level_null_ratio")
+
 # QUERY LISTS
 
 create_table_queries = [songplay_table_create, user_table_create,
                         song_table_create, artist_table_create,
-                        time_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop,
-                      song_table_drop, artist_table_drop, time_table_drop]
+                        time_table_create, manifest_table_create]
+drop_table_queries = [rollup_drop, songplay_table_drop, user_table_drop,
+                      song_table_drop, artist_table_drop, time_table_drop,
+                      manifest_table_drop]
+
+staging_table_creates = [song_staging_create, artist_staging_create,
+                         time_staging_create, user_staging_create,
+                         songplay_staging_create]
+song_bulk_insert_queries = [song_table_bulk_insert, artist_table_bulk_insert]
+log_bulk_insert_queries = [time_table_bulk_insert, user_table_bulk_insert,
+                           songplay_table_bulk_insert]
@@ -0,0 +1,202 @@
+import os
+import json
+import hashlib
+import pandas as pd
+from readers import read_json_files
+
+# the cache needs pyarrow; without it every file is parsed from json
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+
+# Arrow types of the readers dtypes, for chunks written a part at a time
+ARROW_TYPES = {
+    'object': pa.string(),
+    'category': pa.string(),
+    'float64': pa.float64(),
+    'int64': pa.int64(),
+    'Int64': pa.int64(),
+    'Int32': pa.int32(),
+} if pa is not None else {}
+
+
+def schema_key(schema):
+    """Short digest of a readers schema, so a file cached with one schema
+    is not read back with another."""
+    text = json.dumps(sorted(schema.items()))
+    return hashlib.sha1(text.encode('utf8')).hexdigest()[:8]
+
+
+class StagingCache:
+    """
+    Local cache of parsed json files, one Arrow IPC file per source file
+    and schema. A chunk is used when the source still has the recorded
+    size and mtime, or the sha256 the caller passes. Chunks are read
+    through a memory map, so the Arrow buffers are not copied; pandas
+    still builds Python objects for the string columns. When the chunks
+    take more than `max_bytes`, the least recently used are deleted.
+    """
+
+    def __init__(self, directory=None, max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return bool(self.directory) and pa is not None
+
+    def configure(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    def chunk_path(self, path, schema):
+        digest = hashlib.sha1(os.path.abspath(path).encode('utf8')).hexdigest()
+        return os.path.join(self.directory, '{}-{}.arrow'.format(
+            digest, schema_key(schema)))
+
+    def _load(self, chunk, stat, sha256):
+        """Returns the cached table of a source file, or None if there is
+        no chunk or it was written from other contents."""
+        try:
+            source = pa.memory_map(chunk, 'r')
+        except (FileNotFoundError, OSError):
+            return None
+        table = pa.ipc.open_file(source).read_all()
+        meta = {k.decode(): v.decode()
+                for k, v in (table.schema.metadata or {}).items()}
+        if meta.get('size') == str(stat.st_size) and \
+                meta.get('mtime_ns') == str(stat.st_mtime_ns):
+            return table
+        if sha256 and meta.get('sha256') == sha256:
+            return table
+        source.close()
+        return None
+
+    def _store(self, chunk, df, stat, sha256):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        meta = dict(table.schema.metadata or {})
+        meta.update({b'size': str(stat.st_size).encode(),
+                     b'mtime_ns': str(stat.st_mtime_ns).encode(),
+                     b'sha256': (sha256 or '').encode()})
+        table = table.replace_schema_metadata(meta)
+        tmp = chunk + '.tmp'
+        with pa.OSFile(tmp, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, chunk)
+
+    def read(self, path, schema, sha256=None):
+        """
+        Returns the file's records as read_json_files([path], schema)
+        would, from the cache when possible. A parsed file is added to
+        the cache.
+        """
+        if not self.enabled:
+            return read_json_files([path], schema)
+
+        stat = os.stat(path)
+        chunk = self.chunk_path(path, schema)
+        table = self._load(chunk, stat, sha256)
+        if table is not None:
+            self.hits += 1
+            # mark the chunk as recently used
+            os.utime(chunk)
+            return table.to_pandas().astype(schema)
+
+        self.misses += 1
+        df = read_json_files([path], schema)
+        self._store(chunk, df, stat, sha256)
+        return df
+
+    def iter_chunks(self, path, schema, chunksize, parse, sha256=None):
+        """
+        Yields the file's records in DataFrames of at most chunksize rows,
+        as parse(path) yields them, from the cache when possible. A parsed
+        file is written to the cache one chunk at a time, and a cached one
+        is read a slice at a time from its memory map, so neither holds
+        the whole file in memory.
+        """
+        if not self.enabled:
+            yield from parse(path)
+            return
+
+        stat = os.stat(path)
+        chunk = self.chunk_path(path, schema)
+        table = self._load(chunk, stat, sha256)
+        if table is not None:
+            self.hits += 1
+            os.utime(chunk)
+            for offset in range(0, table.num_rows, chunksize):
+                yield table.slice(offset, chunksize).to_pandas().astype(schema)
+            return
+
+        self.misses += 1
+        # categories are stored as strings, since every chunk has its own
+        # dictionary; astype(schema) restores them on read
+        arrow_schema = pa.schema(
+            [(name, ARROW_TYPES[dtype]) for name, dtype in schema.items()],
+            metadata={b'size': str(stat.st_size).encode(),
+                      b'mtime_ns': str(stat.st_mtime_ns).encode(),
+                      b'sha256': (sha256 or '').encode()})
+        tmp = chunk + '.tmp'
+        complete = False
+        try:
+            with pa.OSFile(tmp, 'wb') as sink:
+                with pa.ipc.new_file(sink, arrow_schema) as writer:
+                    for df in parse(path):
+                        writer.write_table(pa.Table.from_pandas(
+                            df.astype({name: 'object' for name, dtype in schema.items()
+                                       if dtype == 'category'}),
+                            schema=arrow_schema, preserve_index=False))
+                        yield df
+            os.replace(tmp, chunk)
+            complete = True
+        finally:
+            # a file whose chunks were not all read is not cached
+            if not complete and os.path.exists(tmp):
+                os.remove(tmp)
+
+    def read_files(self, paths, schema, hashes=None):
+        """Reads many files through the cache into one DataFrame, then
+        evicts chunks beyond max_bytes."""
+        hashes = hashes or {}
+        frames = [self.read(path, schema, hashes.get(path)) for path in paths]
+        if self.enabled:
+            self.evict()
+        if not frames:
+            return read_json_files([], schema)
+        return pd.concat(frames, ignore_index=True)
+
+    def evict(self):
+        """Deletes the least recently used chunks until the cache holds at
+        most max_bytes."""
+        chunks = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.arrow'):
+                stat = entry.stat()
+                chunks.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in chunks)
+        for _, size, path in sorted(chunks):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # evicted by another worker process
+                pass
+            total -= size
+
+    def summary(self):
+        return 'staging cache: {} hits, {} misses'.format(self.hits,
+                                                           self.misses)
+
+
+# cache shared by the loaders of this process; etl.py configures it
+staging_cache = StagingCache()
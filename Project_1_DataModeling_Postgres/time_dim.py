@@ -0,0 +1,60 @@
+import pandas as pd
+
+TIME_COLUMNS = ['start_time', 'hour', 'day', 'week', 'month', 'year',
+                'weekday']
+
+
+def time_frame(ts):
+    """
+    Builds the time dimension rows for an array of epoch-millisecond
+    timestamps in one vectorized pass. Duplicate timestamps are dropped
+    before any conversion; rows are sorted by start_time. `week` is the
+    ISO week number and `weekday` counts from Monday = 0.
+    """
+    ts = pd.Series(pd.unique(pd.Series(ts).dropna())).sort_values()
+    t = pd.to_datetime(ts, unit='ms')
+
+    return pd.DataFrame({'start_time': t.values,
+                         'hour': t.dt.hour.values,
+                         'day': t.dt.day.values,
+                         'week': t.dt.isocalendar().week.astype('int64').values,
+                         'month': t.dt.month.values,
+                         'year': t.dt.year.values,
+                         'weekday': t.dt.weekday.values},
+                        columns=TIME_COLUMNS)
+
+
+class TimeCache:
+    """
+    Process-local set of the start_time keys already written to the time
+    table, so repeated timestamps across files are only sent once.
+    Keys filtered since the last commit stay pending until `commit` is
+    called, and are forgotten again by `rollback`.
+    """
+
+    def __init__(self):
+        self._loaded = set()
+        self._pending = set()
+
+    def __len__(self):
+        return len(self._loaded)
+
+    def filter(self, time_df):
+        """Returns the rows of time_df whose start_time is not cached yet
+        and marks them as pending."""
+        start_time = time_df['start_time']
+        new = time_df[~(start_time.isin(self._loaded) |
+                        start_time.isin(self._pending))]
+        self._pending.update(new['start_time'])
+        return new
+
+    def commit(self):
+        self._loaded |= self._pending
+        self._pending = set()
+
+    def rollback(self):
+        self._pending = set()
+
+
+# cache shared by every log file loaded in this process
+time_cache = TimeCache()
@@ -0,0 +1,178 @@
+"""Loads event_datafile_new.csv into the three query tables of the notebook.
+
+Each INSERT is prepared once and rows are written with execute_async,
+keeping at most `concurrency` requests in flight. Prepared statements let
+the token-aware load balancing policy send every write straight to a
+replica of its partition. All three tables are written from a single pass
+over the CSV.
+
+    python cassandra_loader.py event_datafile_new.csv --concurrency 128
+
+check_loader.py loads a sample of the csv into a scratch keyspace of a
+local node and checks the row counts and keys of the three tables.
+"""
+import argparse
+import csv
+import threading
+import time
+from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
+from cassandra.policies import TokenAwarePolicy, DCAwareRoundRobinPolicy
+
+KEYSPACE = "music_keyspace"
+
+keyspace_create = ("CREATE KEYSPACE IF NOT EXISTS {} "
+                   "WITH REPLICATION = "
+                   "{ 'class' : 'SimpleStrategy', 'replication_factor' : 1 }")
+
+# query 1: artist, song and length for a sessionId and itemInSession
+session_table_create = ("CREATE TABLE IF NOT EXISTS session_table "
+                        "(sessionId int, itemInSession int, artist text, song text, "
+                        "length float, PRIMARY KEY (sessionId, itemInSession))")
+
+# query 2: artist, song (sorted by itemInSession) and user for a userId and sessionId
+user_session_create = ("CREATE TABLE IF NOT EXISTS user_session "
+                       "(userId int, sessionId int, itemInSession int, artist text, "
+                       "song text, firstName text, lastName text, "
+                       "PRIMARY KEY ((userId, sessionId), itemInSession))")
+
+# query 3: every user who listened to a song
+listened_to_song_create = ("CREATE TABLE IF NOT EXISTS listened_to_song "
+                           "(song text, userId int, firstName text, lastName text, "
+                           "PRIMARY KEY (song, userId))")
+
+session_table_insert = ("INSERT INTO session_table (sessionId, itemInSession, artist, song, length) "
+                        "VALUES (?, ?, ?, ?, ?)")
+
+user_session_insert = ("INSERT INTO user_session (userId, sessionId, itemInSession, artist, song, "
+                       "firstName, lastName) VALUES (?, ?, ?, ?, ?, ?, ?)")
+
+# A user's name is the same in every row, so a plain upsert stores the same
+# row as the notebook's IF NOT EXISTS without a lightweight transaction.
+listened_to_song_insert = ("INSERT INTO listened_to_song (song, userId, firstName, lastName) "
+                           "VALUES (?, ?, ?, ?)")
+
+create_table_queries = [session_table_create, user_session_create, listened_to_song_create]
+
+
+def table_params(line):
+    """Maps one event_datafile_new.csv row to the values of each insert, in
+    the order of `insert_queries`."""
+    artist, first_name, _, item, last_name, length, _, _, session_id, song, user_id = line
+    item, session_id, user_id = int(item), int(session_id), int(user_id)
+    return [(session_id, item, artist, song, float(length)),
+            (user_id, session_id, item, artist, song, first_name, last_name),
+            (song, user_id, first_name, last_name)]
+
+
+insert_queries = [session_table_insert, user_session_insert, listened_to_song_insert]
+
+
+def connect(hosts=('127.0.0.1',), keyspace=KEYSPACE):
+    """Connects with token-aware routing and sets up the keyspace and tables.
+    Returns the cluster and session."""
+    profile = ExecutionProfile(
+        load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()))
+    cluster = Cluster(list(hosts), execution_profiles={EXEC_PROFILE_DEFAULT: profile})
+    session = cluster.connect()
+    session.execute(keyspace_create.format(keyspace))
+    session.set_keyspace(keyspace)
+    for query in create_table_queries:
+        session.execute(query)
+    return cluster, session
+
+
+class ConcurrentWriter:
+    """Runs execute_async with at most `concurrency` requests in flight and
+    records the latency of each write."""
+
+    def __init__(self, session, concurrency=100):
+        self.session = session
+        self.concurrency = concurrency
+        self.latencies = []
+        self.errors = []
+        self._slots = threading.Semaphore(concurrency)
+
+    def submit(self, statement, params):
+        self._slots.acquire()
+        start = time.perf_counter()
+        future = self.session.execute_async(statement, params)
+        future.add_callbacks(self._done, self._failed,
+                             callback_args=(start,), errback_args=(start,))
+
+    def _done(self, rows, start):
+        self.latencies.append(time.perf_counter() - start)
+        self._slots.release()
+
+    def _failed(self, exc, start):
+        self.errors.append(exc)
+        self._slots.release()
+
+    def wait(self):
+        """Blocks until every submitted write has finished."""
+        for _ in range(self.concurrency):
+            self._slots.acquire()
+        for _ in range(self.concurrency):
+            self._slots.release()
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def load_rows(session, rows, concurrency=100):
+    """Writes every row to the three tables. rows is an iterable of
+    event_datafile_new.csv rows without the header.
+    Raises the first failed write, if any, once all writes have finished.
+    Returns a dict of rows, writes, seconds, rows_per_sec and p99_ms."""
+    statements = [session.prepare(query) for query in insert_queries]
+    writer = ConcurrentWriter(session, concurrency)
+
+    start = time.perf_counter()
+    num_rows = 0
+    for line in rows:
+        for statement, params in zip(statements, table_params(line)):
+            writer.submit(statement, params)
+        num_rows += 1
+    writer.wait()
+    elapsed = time.perf_counter() - start
+
+    if writer.errors:
+        raise writer.errors[0]
+
+    return {'rows': num_rows,
+            'writes': len(writer.latencies),
+            'seconds': elapsed,
+            'rows_per_sec': num_rows / max(elapsed, 1e-9),
+            'p99_ms': percentile(writer.latencies, 99) * 1000}
+
+
+def load_csv(session, filepath, concurrency=100):
+    """Loads event_datafile_new.csv, see load_rows."""
+    with open(filepath, encoding='utf8') as f:
+        csvreader = csv.reader(f)
+        next(csvreader)  # skip header
+        return load_rows(session, csvreader, concurrency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load the event data csv into Cassandra.')
+    parser.add_argument('filepath', nargs='?', default='event_datafile_new.csv')
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'])
+    parser.add_argument('--concurrency', type=int, default=100,
+                        help='maximum number of writes in flight')
+    args = parser.parse_args()
+
+    cluster, session = connect(args.hosts)
+    stats = load_csv(session, args.filepath, args.concurrency)
+    print('{rows} rows ({writes} writes) in {seconds:.1f}s: '
+          '{rows_per_sec:.0f} rows/sec, p99 write latency {p99_ms:.1f} ms'.format(**stats))
+
+    session.shutdown()
+    cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""Integration check of cassandra_loader against a local single-node Cassandra.
+
+Loads the first --rows rows of event_datafile_new.csv with load_rows into
+a scratch keyspace, then checks that each of the three query tables holds
+one row per distinct primary key of the csv rows, and exactly those keys.
+Exits with status 1 when a table does not match, and skips (status 0) when
+no Cassandra node answers on --hosts.
+
+    python check_loader.py --rows 1000
+"""
+import argparse
+import csv
+import sys
+from itertools import islice
+from cassandra.cluster import NoHostAvailable
+
+import cassandra_loader
+
+CHECK_KEYSPACE = "music_keyspace_check"
+
+# table, its primary key columns, and the number of leading values of its
+# table_params tuple that form the key
+KEYS = [("session_table", "sessionId, itemInSession", 2),
+        ("user_session", "userId, sessionId, itemInSession", 3),
+        ("listened_to_song", "song, userId", 2)]
+
+
+def expected_keys(rows):
+    """Returns the set of primary keys each table should hold after rows
+    are loaded, in the order of KEYS."""
+    keys = [set() for _ in KEYS]
+    for line in rows:
+        for table_keys, params, (_, _, width) in zip(keys, cassandra_loader.table_params(line),
+                                                    KEYS):
+            table_keys.add(params[:width])
+    return keys
+
+
+def check_tables(session, expected):
+    """Compares the row count and the keys of each table with expected.
+    Prints a line per table and returns the names of the tables that do
+    not match."""
+    failed = []
+    for (table, columns, _), keys in zip(KEYS, expected):
+        count = session.execute("SELECT COUNT(*) FROM {}".format(table)).one()[0]
+        loaded = {tuple(row) for row in session.execute(
+            "SELECT {} FROM {}".format(columns, table))}
+        passed = count == len(keys) and loaded == keys
+        print("{:<4} {}: {} rows, {} expected, {} missing keys, {} unexpected keys".format(
+            "ok" if passed else "FAIL", table, count, len(keys),
+            len(keys - loaded), len(loaded - keys)))
+        if not passed:
+            failed.append(table)
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check cassandra_loader against a '
+                                     'local Cassandra node.')
+    parser.add_argument('filepath', nargs='?', default='event_datafile_new.csv')
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'])
+    parser.add_argument('--rows', type=int, default=1000,
+                        help='csv rows to load (default: 1000)')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the {} keyspace'.format(CHECK_KEYSPACE))
+    args = parser.parse_args()
+
+    with open(args.filepath, encoding='utf8') as f:
+        csvreader = csv.reader(f)
+        next(csvreader)  # skip header
+        rows = list(islice(csvreader, args.rows))
+
+    try:
+        cluster, session = cassandra_loader.connect(args.hosts, CHECK_KEYSPACE)
+    except NoHostAvailable as e:
+        print('skipped: no Cassandra node at {}: {}'.format(' '.join(args.hosts), e))
+        return
+
+    try:
+        for table, _, _ in KEYS:
+            session.execute("TRUNCATE {}".format(table))
+        stats = cassandra_loader.load_rows(session, rows, args.concurrency)
+        print('{rows} rows ({writes} writes) in {seconds:.1f}s: '
+              '{rows_per_sec:.0f} rows/sec, p99 write latency {p99_ms:.1f} ms'.format(**stats))
+        failed = check_tables(session, expected_keys(rows))
+    finally:
+        if not args.keep:
+            session.execute("DROP KEYSPACE IF EXISTS {}".format(CHECK_KEYSPACE))
+        session.shutdown()
+        cluster.shutdown()
+
+    if failed:
+        print('{} of {} tables do not match'.format(len(failed), len(KEYS)))
+        sys.exit(1)
+    print('all {} tables match'.format(len(KEYS)))
+
+
+if __name__ == "__main__":
+    main()
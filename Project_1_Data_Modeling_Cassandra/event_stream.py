@@ -0,0 +1,110 @@
+"""Streams the event_data csv files as the rows of event_datafile_new.csv.
+
+Rows are projected to the 11 columns used by the Cassandra tables and rows
+without an artist are dropped while the files are read, so memory is
+bounded by the files being read at a time rather than by the total event
+volume. The consolidated csv can be written as a side output and the same
+stream can feed cassandra_loader directly.
+
+    python event_stream.py event_data --output event_datafile_new.csv --load
+"""
+import argparse
+import csv
+import glob
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+HEADER = ['artist', 'firstName', 'gender', 'itemInSession', 'lastName', 'length',
+          'level', 'location', 'sessionId', 'song', 'userId']
+
+# positions of the HEADER columns in the event_data files
+COLUMNS = (0, 2, 3, 4, 5, 6, 7, 8, 12, 13, 16)
+
+csv.register_dialect('myDialect', quoting=csv.QUOTE_ALL, skipinitialspace=True)
+
+
+def event_files(directory):
+    """Returns the sorted paths of the csv files under directory."""
+    file_path_list = []
+    for root, dirs, files in os.walk(directory):
+        file_path_list += glob.glob(os.path.join(root, '*.csv'))
+    return sorted(set(file_path_list))
+
+
+def read_event_file(filepath):
+    """Yields the projected rows of one event file, skipping the header and
+    rows with an empty artist."""
+    with open(filepath, 'r', encoding='utf8', newline='') as csvfile:
+        csvreader = csv.reader(csvfile)
+        next(csvreader)
+        for line in csvreader:
+            if line[0] == '':
+                continue
+            yield [line[i] for i in COLUMNS]
+
+
+def _read_file(filepath):
+    return list(read_event_file(filepath))
+
+
+def stream_events(filepaths, workers=1):
+    """Yields the projected rows of every file, in file order. With more than
+    one worker the files are parsed in parallel processes, with at most
+    2 * workers files read ahead of the consumer."""
+    if workers <= 1:
+        for filepath in filepaths:
+            yield from read_event_file(filepath)
+        return
+
+    with ProcessPoolExecutor(workers) as executor:
+        pending = deque()
+        for filepath in filepaths:
+            pending.append(executor.submit(_read_file, filepath))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def tee_to_csv(rows, filepath):
+    """Writes the rows to a consolidated csv with the HEADER as they pass
+    through, and yields them on."""
+    with open(filepath, 'w', encoding='utf8', newline='') as f:
+        writer = csv.writer(f, dialect='myDialect')
+        writer.writerow(HEADER)
+        for row in rows:
+            writer.writerow(row)
+            yield row
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Consolidate the event data files.')
+    parser.add_argument('directory', nargs='?', default='event_data')
+    parser.add_argument('--output', help='also write the consolidated csv here')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='processes reading the daily files')
+    parser.add_argument('--load', action='store_true',
+                        help='load the rows into Cassandra with cassandra_loader')
+    parser.add_argument('--hosts', nargs='+', default=['127.0.0.1'])
+    parser.add_argument('--concurrency', type=int, default=100)
+    args = parser.parse_args()
+
+    rows = stream_events(event_files(args.directory), args.workers)
+    if args.output:
+        rows = tee_to_csv(rows, args.output)
+
+    if args.load:
+        import cassandra_loader
+        cluster, session = cassandra_loader.connect(args.hosts)
+        stats = cassandra_loader.load_rows(session, rows, args.concurrency)
+        print('{rows} rows ({writes} writes) in {seconds:.1f}s: '
+              '{rows_per_sec:.0f} rows/sec, p99 write latency {p99_ms:.1f} ms'.format(**stats))
+        session.shutdown()
+        cluster.shutdown()
+    else:
+        print('{} rows'.format(sum(1 for _ in rows)))
+
+
+if __name__ == "__main__":
+    main()
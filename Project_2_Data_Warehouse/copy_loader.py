@@ -0,0 +1,181 @@
+import gzip
+import io
+import json
+import os
+import time
+import boto3
+import db
+from concurrent.futures import ThreadPoolExecutor
+from sql_queries import staging_table_copy, load_commits_select, load_errors_select, \
+    staging_events_table_create, staging_songs_table_create, staging_clear_queries, \
+    LOG_DATA, SONG_DATA, LOG_JSON_PATH, MANIFEST_PREFIX
+from manifest import list_s3_objects, write_copy_manifest
+
+# staging table columns and the json field each one is loaded from, in the
+# order of the log jsonpaths file and of 'auto' for the song files
+STAGING_FIELDS = {
+    'staging_events': [('artist', 'artist'), ('auth', 'auth'), ('firstName', 'firstName'),
+                       ('gender', 'gender'), ('itemInSession', 'itemInSession'),
+                       ('lastName', 'lastName'), ('length', 'length'), ('level', 'level'),
+                       ('location', 'location'), ('method', 'method'), ('page', 'page'),
+                       ('registration', 'registration'), ('sessionid', 'sessionId'),
+                       ('song', 'song'), ('status', 'status'), ('ts', 'ts'),
+                       ('userAgent', 'userAgent'), ('user_id', 'userId')],
+    'staging_songs': [(name, name) for name in
+                      ['num_songs', 'artist_id', 'artist_latitude', 'artist_longitude',
+                       'artist_location', 'artist_name', 'song_id', 'title', 'duration',
+                       'year']],
+}
+
+
+def copy_options(config):
+    """Builds the COPY options clause from the [COPY] section of dwh.cfg."""
+    section = config['COPY']
+    options = []
+    if section.get('COMPRESSION'):
+        options.append(section['COMPRESSION'].upper())
+    options.append('COMPUPDATE {}'.format(section.get('COMPUPDATE', 'OFF')))
+    options.append('STATUPDATE {}'.format(section.get('STATUPDATE', 'OFF')))
+    options.append('MAXERROR {}'.format(section.getint('MAXERROR', 0)))
+    return ' '.join(options)
+
+
+def list_local_files(directory):
+    """Returns (path, size) of every json file under a local directory."""
+    files = []
+    for root, dirs, names in os.walk(directory):
+        for name in names:
+            if name.endswith('.json') or name.endswith('.json.gz'):
+                path = os.path.join(root, name)
+                files.append((path, os.path.getsize(path)))
+    return sorted(files)
+
+
+def redshift_copy(conn, table, manifest_url, options):
+    """COPYs the files of a manifest into a staging table. Redshift splits
+    the files of a single COPY across the slices of the cluster."""
+    if table == 'staging_events':
+        data_format = 'json {}'.format(LOG_JSON_PATH)
+    else:
+        data_format = "json 'auto' truncatecolumns"
+
+    cur = conn.cursor()
+    cur.execute(staging_table_copy.format(table=table, manifest=manifest_url,
+                                          format=data_format, options=options))
+
+
+def copy_report(conn):
+    """Returns the per-file rows and commit times of the session's last
+    COPY from stl_load_commits and its rejected rows from
+    stl_load_errors."""
+    cur = conn.cursor()
+    cur.execute(load_commits_select)
+    files = [(name, rows, str(curtime)) for name, rows, curtime in cur.fetchall()]
+    cur.execute(load_errors_select)
+    errors = cur.fetchall()
+    return files, errors
+
+
+def local_copy(conn, table, paths, max_errors):
+    """Local stand-in for a Redshift COPY: parses the json files and streams
+    them into the staging table with COPY FROM STDIN. Records that cannot be
+    parsed are rejected like stl_load_errors rows, up to max_errors."""
+    fields = STAGING_FIELDS[table]
+    files, errors = [], []
+    buf = io.StringIO()
+    for path in paths:
+        start = time.time()
+        opener = gzip.open if path.endswith('.gz') else open
+        rows = 0
+        with opener(path, 'rt', encoding='utf8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    errors.append((path, line_number, None, str(e)))
+                    continue
+                values = ['' if record.get(key) is None else str(record[key])
+                          for _, key in fields]
+                buf.write('\t'.join(v.replace('\\', '\\\\').replace('\t', '\\t')
+                                    .replace('\n', '\\n') for v in values))
+                buf.write('\n')
+                rows += 1
+        files.append((path, rows, '{:.3f}s'.format(time.time() - start)))
+
+    if len(errors) > max_errors:
+        raise ValueError('{} load errors in {}, MAXERROR is {}'
+                         .format(len(errors), table, max_errors))
+
+    buf.seek(0)
+    cur = conn.cursor()
+    cur.copy_expert("COPY {} ({}) FROM STDIN WITH NULL ''".format(
+        table, ', '.join(column for column, _ in fields)), buf)
+    return files, errors
+
+
+def copy_table(backend, table, clear_query, objects, manifest_url, config):
+    """Empties a staging table and COPYs its files in one transaction on
+    its own pooled connection, so a failed COPY leaves the table as it
+    was. Returns its report."""
+    conn = db.connect()
+    try:
+        start = time.time()
+        conn.cursor().execute(clear_query)
+        if backend == 'local':
+            files, errors = local_copy(conn, table, [obj[0] for obj in objects],
+                                       config['COPY'].getint('MAXERROR', 0))
+            conn.commit()
+        else:
+            redshift_copy(conn, table, manifest_url, copy_options(config))
+            conn.commit()
+            files, errors = copy_report(conn)
+        return table, time.time() - start, files, errors
+    finally:
+        db.release(conn)
+
+
+def load_staging_parallel(config):
+    """Loads the log and song files into the staging tables with one COPY
+    per table, the two tables side by side on separate pooled
+    connections. Each COPY reads all the files of its table from a single
+    manifest, which Redshift already spreads across the slices;
+    concurrent COPYs into one table would only be serialized.
+    Prints the rows and timing of every file and the rejected rows."""
+    backend = config.get('COPY', 'BACKEND', fallback='redshift')
+    sources = [('staging_events', 'LOG_DATA', LOG_DATA),
+               ('staging_songs', 'SONG_DATA', SONG_DATA)]
+
+    if backend == 'local':
+        conn = db.connect()
+        conn.cursor().execute(staging_events_table_create + staging_songs_table_create)
+        conn.commit()
+        db.release(conn)
+    else:
+        s3 = boto3.client('s3')
+
+    jobs = []
+    for (table, key, prefix), clear_query in zip(sources, staging_clear_queries):
+        manifest_url = None
+        if backend == 'local':
+            objects = list_local_files(config['LOCAL'][key])
+        else:
+            objects = list_s3_objects(s3, prefix)
+            manifest_url = write_copy_manifest(s3, '{}/{}.manifest'.format(
+                MANIFEST_PREFIX.strip("'\""), table), objects)
+        jobs.append((table, clear_query, objects, manifest_url))
+
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = [executor.submit(copy_table, backend, table, clear_query, objects, url, config)
+                   for table, clear_query, objects, url in jobs]
+        reports = [future.result() for future in futures]
+
+    for table, elapsed, files, errors in reports:
+        print("COPY {}: {} files, {} rows in {:.1f}s, {} rejected".format(
+            table, len(files), sum(f[1] for f in files), elapsed, len(errors)))
+        for name, rows, committed in files:
+            print("    {} {} rows ({})".format(name, rows, committed))
+        for name, line_number, column, reason in errors:
+            print("    rejected {}:{} {} {}".format(name, line_number, column or '', reason))
+    return reports
@@ -1,36 +1,57 @@
 import configparser
-import psycopg2
+import os
+import sys
+
+# the repository root, so the modules of this project can import the
+# shared modules of common/ whatever the order of their imports
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import db
 from sql_queries import create_table_queries, drop_table_queries
+from metrics import recorder
 
 
-def drop_tables(cur, conn):
+def drop_tables(cur, conn, policy=None):
     """Drop the staging, fact, and dimension tables if they exist."""
+    policy = policy or db.CommitPolicy(conn, 'statement')
     for query in drop_table_queries:
         cur.execute(query)
-        conn.commit()
+    policy.stage_done()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, policy=None):
     """Create the staging, fact, and dimension tables."""
+    policy = policy or db.CommitPolicy(conn, 'statement')
     for query in create_table_queries:
         cur.execute(query)
-        conn.commit()
+    policy.stage_done()
 
 
 def main():
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+    recorder.configure(config)
+    db.configure(config)
+    conn = db.connect()
     cur = conn.cursor()
+    policy = db.CommitPolicy(conn, config.get('LOAD', 'DDL_COMMIT_POLICY', fallback='statement'))
    
     
-    drop_tables(cur, conn)
+    with recorder.stage('drop_tables'):
+        drop_tables(cur, conn, policy)
     print("Drop tables run successfully")
-    create_tables(cur, conn)
+    with recorder.stage('create_tables'):
+        create_tables(cur, conn, policy)
+    policy.finish()
     print("Create tables run successfully")
 
-    conn.close()
+    db.release(conn)
+    db.close_all()
+    if config.get('METRICS', 'FILE', fallback=''):
+        recorder.write(config['METRICS']['FILE'])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,114 @@
+import os
+import threading
+import psycopg2
+from psycopg2.extensions import parse_dsn
+from metrics import recorder
+from common.db import Pool
+
+# [CLUSTER] keys in dwh.cfg order, the connect() parameter each one sets and
+# the libpq environment variable that overrides it
+CLUSTER_SETTINGS = [('HOST', 'host', 'PGHOST'),
+                    ('DB_NAME', 'dbname', 'PGDATABASE'),
+                    ('DB_USER', 'user', 'PGUSER'),
+                    ('DB_PASSWORD', 'password', 'PGPASSWORD'),
+                    ('DB_PORT', 'port', 'PGPORT')]
+
+# when a load commits: after every statement (autocommit), at the end of
+# each stage, or once at the end of the run
+COMMIT_POLICIES = ['statement', 'stage', 'single']
+
+_pool = None
+_statement_timeout = 0
+_lock = threading.Lock()
+
+
+def connect_params(config):
+    """Returns the psycopg2.connect keyword arguments for the [CLUSTER]
+    section of dwh.cfg, or the [LOCAL] DSN when [COPY] BACKEND is local.
+    PGHOST, PGDATABASE, PGUSER, PGPASSWORD and PGPORT override them, and
+    [POOL] KEEPALIVES_IDLE sets the TCP keepalives."""
+    if config.get('COPY', 'BACKEND', fallback='redshift') == 'local':
+        params = parse_dsn(config['LOCAL']['DSN'])
+    else:
+        params = {name: config['CLUSTER'][key].strip("'\"")
+                  for key, name, _ in CLUSTER_SETTINGS}
+
+    for _, name, env in CLUSTER_SETTINGS:
+        if os.environ.get(env):
+            params[name] = os.environ[env]
+
+    params.update(keepalives=1,
+                  keepalives_idle=config.getint('POOL', 'KEEPALIVES_IDLE', fallback=30),
+                  keepalives_interval=10,
+                  keepalives_count=5)
+    return params
+
+
+def configure(config):
+    """Creates the pool from dwh.cfg. [POOL] MAXCONN caps the connections,
+    by default enough for the stages of a --parallel-stages load, and
+    STATEMENT_TIMEOUT (ms, 0 for none) is set on every checkout."""
+    global _pool, _statement_timeout
+    maxconn = config.getint('POOL', 'MAXCONN',
+                            fallback=config.getint('LOAD', 'STAGE_WORKERS', fallback=4) + 1)
+    with _lock:
+        if _pool is not None:
+            _pool.closeall()
+        _pool = Pool(maxconn, **connect_params(config))
+        _statement_timeout = config.getint('POOL', 'STATEMENT_TIMEOUT', fallback=0)
+
+
+def connect(autocommit=False):
+    """Returns a pooled connection whose cursors record into the metrics
+    recorder. Hand it back with release."""
+    if _pool is None:
+        raise RuntimeError('db.configure(config) has not been called')
+    conn = _pool.getconn()
+    conn.autocommit = autocommit
+    cur = conn.cursor()
+    cur.execute("SET statement_timeout TO {};".format(_statement_timeout))
+    if not autocommit:
+        conn.commit()
+    return recorder.instrument(conn)
+
+
+def release(conn):
+    """Rolls back anything left uncommitted and returns conn to the pool."""
+    if not conn.closed:
+        try:
+            conn.rollback()
+            conn.autocommit = False
+        except psycopg2.Error:
+            pass
+    _pool.putconn(conn)
+
+
+def close_all():
+    """Closes every pooled connection."""
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+class CommitPolicy:
+    """Commits a load's transaction according to one of COMMIT_POLICIES.
+    With 'statement' the connection is switched to autocommit. Redshift
+    has no savepoints, so a failed statement fails the uncommitted part of
+    the run, which the idempotent merge queries can simply rerun."""
+
+    def __init__(self, conn, policy='statement'):
+        if policy not in COMMIT_POLICIES:
+            raise ValueError('unknown commit policy {!r}'.format(policy))
+        self.conn = conn
+        self.policy = policy
+        conn.autocommit = policy == 'statement'
+
+    def stage_done(self):
+        if self.policy == 'stage':
+            self.conn.commit()
+
+    def finish(self):
+        if not self.conn.autocommit:
+            self.conn.commit()
@@ -0,0 +1,103 @@
+import argparse
+import configparser
+import statistics
+import time
+import os
+import sys
+
+# the repository root, so the modules of this project can import the
+# shared modules of common/ whatever the order of their imports
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import db
+from sql_queries import star_table_creates, analytic_queries, insert_table_queries
+
+# schema the profiles are built in, ahead of public on the search_path, so
+# the merges read the live staging tables but never touch the star schema
+BENCH_SCHEMA = 'design_benchmark'
+
+
+def profiles(config):
+    """Returns the names of the [PROFILE <name>] sections of dwh.cfg."""
+    return [section.split(' ', 1)[1] for section in config.sections()
+            if section.startswith('PROFILE ')]
+
+
+def build_star_schema(cur, conn, profile):
+    """Recreates the fact and dimension tables with a design profile in
+    BENCH_SCHEMA and loads them from the staging tables. Returns the load
+    time."""
+    cur.execute("DROP SCHEMA IF EXISTS {0} CASCADE; CREATE SCHEMA {0};".format(BENCH_SCHEMA))
+    cur.execute("SET search_path TO {}, public;".format(BENCH_SCHEMA))
+    for query in star_table_creates(profile):
+        cur.execute(query)
+    conn.commit()
+
+    start = time.time()
+    for query in insert_table_queries:
+        cur.execute(query)
+    conn.commit()
+    return time.time() - start
+
+
+def time_query(cur, query, repeats):
+    """Runs a query once to compile it, then returns the median time of
+    `repeats` runs."""
+    cur.execute(query)
+    cur.fetchall()
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        cur.execute(query)
+        cur.fetchall()
+        times.append(time.time() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the analytic queries under '
+                                     'each table design profile in dwh.cfg. The tables are '
+                                     'built from the loaded staging tables in the scratch '
+                                     'schema {}, which is dropped and recreated for every '
+                                     'profile; the live star schema is not changed.'
+                                     .format(BENCH_SCHEMA))
+    parser.add_argument('--profiles', nargs='+', help='profiles to run (default: all)')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the {} schema with the last profile'.format(BENCH_SCHEMA))
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+
+    db.configure(config)
+    conn = db.connect()
+    cur = conn.cursor()
+    # measure the layout, not Redshift's result cache
+    cur.execute("SET enable_result_cache_for_session TO off;")
+
+    results = {}
+    for profile in args.profiles or profiles(config):
+        load_time = build_star_schema(cur, conn, profile)
+        results[profile] = {'load': load_time}
+        for name, query in analytic_queries.items():
+            results[profile][name] = time_query(cur, query, args.repeats)
+        print("{} done".format(profile))
+
+    columns = ['load'] + list(analytic_queries)
+    print("{:<24}".format('profile') + ''.join('{:>22}'.format(c) for c in columns))
+    for profile, times in results.items():
+        print("{:<24}".format(profile) + ''.join('{:>21.3f}s'.format(times[c]) for c in columns))
+
+    cur.execute("RESET search_path;")
+    if not args.keep:
+        cur.execute("DROP SCHEMA IF EXISTS {} CASCADE;".format(BENCH_SCHEMA))
+    conn.commit()
+    db.release(conn)
+    db.close_all()
+
+
+if __name__ == "__main__":
+    main()
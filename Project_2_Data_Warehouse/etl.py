@@ -1,34 +1,265 @@
+import argparse
 import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
+import boto3
+import os
+import sys
 
+# the repository root, so the modules of this project can import the
+# shared modules of common/ whatever the order of their imports
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
 
-def load_staging_tables(cur, conn):
-    """Loads data from S3 buckets into staging tables."""
-    for query in copy_table_queries:
+import db
+from sql_queries import copy_table_queries, insert_table_queries, \
+    staging_events_copy, staging_songs_copy, staging_events_manifest_copy, \
+    staging_songs_manifest_copy, staging_clear_queries, staging_stages, \
+    insert_table_stages, LOG_DATA, SONG_DATA, MANIFEST_PREFIX
+from manifest import list_s3_objects, pending_objects, write_copy_manifest, \
+    record_objects, replace_manifest
+from copy_loader import load_staging_parallel
+from metrics import recorder
+from common.scheduler import Stage, Scheduler
+import quality
+
+
+def load_staging_tables(cur, conn, policy=None):
+    """Loads data from S3 buckets into staging tables, committing after
+    each statement or as the CommitPolicy says. TRUNCATE commits on
+    Redshift, so a single-transaction load empties the staging tables
+    with DELETE instead."""
+    policy = policy or db.CommitPolicy(conn, 'statement')
+    queries = copy_table_queries
+    if policy.policy == 'single':
+        queries = staging_clear_queries + [staging_events_copy, staging_songs_copy]
+    for query in queries:
         cur.execute(query)
-        conn.commit()
+    policy.stage_done()
 
 
-def insert_tables(cur, conn):
-    """Loads data from staging tables into the fact and dimension tables."""
+def insert_tables(cur, conn, policy=None, objects=None):
+    """Merges the staging tables into the fact and dimension tables, by
+    default in a single transaction. With the 'statement' policy each
+    delete and insert commits on its own, and a failed run leaves the
+    tables partly merged until it is rerun. The objects of a full load
+    replace load_manifest in the same transaction as the merge."""
+    policy = policy or db.CommitPolicy(conn, 'stage')
     for query in insert_table_queries:
         cur.execute(query)
-        conn.commit()
+    if objects is not None:
+        replace_manifest(cur, objects)
+    policy.stage_done()
+
+
+def load_incremental(cur, conn, s3, merge=True):
+    """Loads only the S3 files that are new or changed since the last run.
+
+    The new files of each prefix are listed in a COPY manifest under
+    MANIFEST_PREFIX and COPY'd into the staging tables. The fact and
+    dimension inserts and the load_manifest records are committed in the
+    same transaction, so a failed run leaves nothing half loaded. Without
+    merge only the staging tables are loaded, and the files stay pending
+    for the next run."""
+    for query in staging_clear_queries:
+        cur.execute(query)
+
+    sources = [('log_data', LOG_DATA, staging_events_manifest_copy),
+               ('song_data', SONG_DATA, staging_songs_manifest_copy)]
+    for name, prefix, copy_query in sources:
+        objects = pending_objects(cur, list_s3_objects(s3, prefix))
+        print("{} new or changed files in {}".format(len(objects), name))
+        if not objects:
+            continue
+
+        url = write_copy_manifest(s3, '{}/{}.manifest'.format(
+            MANIFEST_PREFIX.strip("'\""), name), objects)
+        cur.execute(copy_query.format(manifest=url))
+        if merge:
+            record_objects(cur, objects)
+
+    if merge:
+        for query in insert_table_queries:
+            cur.execute(query)
+    conn.commit()
+
+
+def list_full_load(config):
+    """Lists the S3 files of a full load before it starts, to be recorded
+    in load_manifest once the load has finished. A file added during the
+    load is then loaded again by the next incremental run, which the merge
+    queries make harmless. Returns None for the local backend, which has
+    no S3 files and no incremental runs."""
+    if config.get('COPY', 'BACKEND', fallback='redshift') == 'local':
+        return None
+    s3 = boto3.client('s3')
+    return list_s3_objects(s3, LOG_DATA) + list_s3_objects(s3, SONG_DATA)
+
+
+def manifest_stage(objects):
+    """Returns a stage function that replaces load_manifest with the
+    objects of a full load on its own pooled connection."""
+    def run():
+        conn = db.connect()
+        try:
+            replace_manifest(conn.cursor(), objects)
+            conn.commit()
+        finally:
+            db.release(conn)
+    return run
+
+
+def query_stage(queries):
+    """Returns a stage function that runs the queries on its own pooled
+    connection and commits them together."""
+    def run():
+        conn = db.connect()
+        try:
+            cur = conn.cursor()
+            for query in queries:
+                cur.execute(query)
+            conn.commit()
+        finally:
+            db.release(conn)
+    return run
+
+
+def load_stages(args, config, objects=None):
+    """Returns the scheduler Stages of a full load: the staging loads of
+    staging_stages, or a single copy_loader stage with --parallel-copy,
+    followed by the merges of insert_table_stages and, once every merge
+    has finished, the load_manifest update for the listed objects."""
+    if args.parallel_copy:
+        # copy_loader loads both staging tables in one stage
+        staging = [Stage('staging', lambda: load_staging_parallel(config), [])]
+        alias = {name: 'staging' for name, _, _ in staging_stages}
+    else:
+        staging = [Stage(name, query_stage(queries), needs)
+                   for name, queries, needs in staging_stages]
+        alias = {}
+    if args.staging_only:
+        return staging
+
+    merges = [Stage(name, query_stage(queries), [alias.get(need, need) for need in needs])
+              for name, queries, needs in insert_table_stages]
+    if objects is None:
+        return staging + merges
+    record = Stage('load_manifest', manifest_stage(objects),
+                   [name for name, _, _ in insert_table_stages])
+    return staging + merges + [record]
 
 
 def main():
+    parser = argparse.ArgumentParser(description='Load the Sparkify S3 data '
+                                     'into the Redshift star schema.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only load files not yet in load_manifest')
+    parser.add_argument('--parallel-copy', action='store_true',
+                        help='COPY the events and songs side by side from manifests '
+                        'and report load errors')
+    parser.add_argument('--staging-only', action='store_true',
+                        help='stop after loading the staging tables')
+    parser.add_argument('--commit-policy', choices=db.COMMIT_POLICIES,
+                        help='commit after every statement, after the staging load '
+                        'and after the merge, or once at the end '
+                        '(default: [LOAD] COMMIT_POLICY)')
+    parser.add_argument('--metrics', metavar='PATH',
+                        help='append query and stage timings to a JSON-lines file, '
+                        'or write a Prometheus .prom file (default: [METRICS] FILE)')
+    parser.add_argument('--parallel-stages', action='store_true',
+                        help='run the staging loads and table merges as soon as the '
+                        'stages they need have finished, each committing on its own '
+                        'connection')
+    parser.add_argument('--stage-workers', type=int,
+                        help='stages run at the same time with --parallel-stages '
+                        '(default: [LOAD] STAGE_WORKERS)')
+    parser.add_argument('--resume', action='store_true',
+                        help='with --parallel-stages, skip the stages that finished '
+                        'in the last failed run')
+    parser.add_argument('--skip-checks', action='store_true',
+                        help='do not run the data quality checks after the load '
+                        '(default: [QUALITY] ENABLED)')
+    args = parser.parse_args()
+    if args.parallel_stages and args.incremental:
+        parser.error('--incremental loads always run in one transaction')
+
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
+    metrics_file = args.metrics or config.get('METRICS', 'FILE', fallback='')
+    recorder.configure(config, metrics_file)
+    db.configure(config)
+
+    try:
+        load(args, config)
+        if config.getboolean('QUALITY', 'ENABLED', fallback=True) and \
+                not args.skip_checks and not args.staging_only:
+            with recorder.stage('quality_checks'):
+                failed = check_quality(config)
+            if failed and config.getboolean('QUALITY', 'STRICT', fallback=False):
+                raise SystemExit(1)
+    finally:
+        db.close_all()
+        if metrics_file:
+            recorder.write(metrics_file)
 
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
+
+def load(args, config):
+    """Runs the staging and star schema loads selected by args. Full
+    loads record the files they listed in load_manifest once merged."""
+    objects = None
+    if not args.incremental and not args.staging_only:
+        objects = list_full_load(config)
+
+    if args.parallel_stages:
+        scheduler = Scheduler(load_stages(args, config, objects),
+                              args.stage_workers or
+                              config.getint('LOAD', 'STAGE_WORKERS', fallback=4),
+                              config.get('LOAD', 'STATE_FILE', fallback='.etl_state.json'),
+                              recorder)
+        scheduler.run(args.resume)
+        return
+
+    if args.parallel_copy:
+        with recorder.stage('load_staging_parallel'):
+            load_staging_parallel(config)
+        if args.staging_only:
+            return
+
+    conn = db.connect()
     cur = conn.cursor()
+    policy = db.CommitPolicy(conn, args.commit_policy or
+                             config.get('LOAD', 'COMMIT_POLICY', fallback='stage'))
     
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    if args.parallel_copy:
+        with recorder.stage('insert_tables'):
+            insert_tables(cur, conn, policy, objects)
+    elif args.incremental:
+        # always one transaction, together with the load_manifest records
+        conn.autocommit = False
+        with recorder.stage('load_incremental'):
+            load_incremental(cur, conn, boto3.client('s3'), not args.staging_only)
+    else:
+        with recorder.stage('load_staging_tables'):
+            load_staging_tables(cur, conn, policy)
+        if not args.staging_only:
+            with recorder.stage('insert_tables'):
+                insert_tables(cur, conn, policy, objects)
+
+    policy.finish()
+    db.release(conn)
+
 
-    conn.close()
+def check_quality(config):
+    """Runs the data quality checks on the loaded tables and returns the
+    ones that failed."""
+    conn = db.connect(autocommit=True)
+    try:
+        results = quality.run_checks(conn.cursor(), quality.default_checks(config))
+    finally:
+        db.release(conn)
+    failed = [check for check, _, passed in results if not passed]
+    print('{} of {} data quality checks failed.'.format(len(failed), len(results)))
+    return failed
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
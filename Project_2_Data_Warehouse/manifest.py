@@ -0,0 +1,61 @@
+import json
+from psycopg2.extras import execute_values
+from sql_queries import load_manifest_select, load_manifest_delete, \
+    load_manifest_insert, load_manifest_clear
+
+
+def split_s3_uri(uri):
+    """Splits 's3://bucket/prefix' (quoted as in dwh.cfg or not) into
+    (bucket, prefix)."""
+    uri = uri.strip().strip("'\"")
+    bucket, _, prefix = uri[len('s3://'):].partition('/')
+    return bucket, prefix
+
+
+def list_s3_objects(s3, uri):
+    """Returns (url, size, etag, last_modified) of every object under an
+    S3 prefix. The etag is the object's content hash as reported by S3."""
+    bucket, prefix = split_s3_uri(uri)
+    objects = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('/'):
+                continue
+            objects.append(('s3://{}/{}'.format(bucket, obj['Key']),
+                            obj['Size'], obj['ETag'].strip('"'),
+                            obj['LastModified']))
+    return objects
+
+
+def pending_objects(cur, objects):
+    """Returns the objects that are not in load_manifest or whose size or
+    etag changed since they were loaded."""
+    cur.execute(load_manifest_select)
+    loaded = {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+    return [obj for obj in objects if loaded.get(obj[0]) != (obj[1], obj[2])]
+
+
+def write_copy_manifest(s3, uri, objects):
+    """Writes a Redshift COPY manifest listing the objects to `uri`."""
+    bucket, key = split_s3_uri(uri)
+    body = {'entries': [{'url': obj[0], 'mandatory': True}
+                        for obj in objects]}
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(body))
+    return 's3://{}/{}'.format(bucket, key)
+
+
+def record_objects(cur, objects):
+    """Records the objects in load_manifest. Runs in the caller's
+    transaction so it commits together with the loaded rows."""
+    cur.execute(load_manifest_delete, (tuple(obj[0] for obj in objects),))
+    execute_values(cur, load_manifest_insert, objects)
+
+
+def replace_manifest(cur, objects):
+    """Replaces load_manifest with the objects of a full load, so the
+    next incremental run only loads the files added after it. Runs in the
+    caller's transaction."""
+    cur.execute(load_manifest_clear)
+    if objects:
+        execute_values(cur, load_manifest_insert, objects)
@@ -0,0 +1,79 @@
+import psycopg2.extensions
+import sql_queries
+import common.metrics
+
+QUERY_NAMES = common.metrics.query_names(sql_queries)
+
+# statements EXPLAIN accepts
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+# bytes scanned by the last query and bytes read from S3 by the last COPY
+scan_bytes_select = "SELECT COALESCE(SUM(bytes), 0) FROM stl_scan WHERE query = pg_last_query_id();"
+copy_bytes_select = "SELECT COALESCE(SUM(transfer_size), 0) FROM stl_s3client WHERE query = pg_last_copy_id();"
+
+
+def query_name(query):
+    """Returns the sql_queries constant a statement comes from, or its
+    first words for statements built elsewhere."""
+    return common.metrics.query_name(query, QUERY_NAMES)
+
+
+class Recorder(common.metrics.Recorder):
+    """Aggregates the wall time, rows and bytes of the queries and stages
+    of a run by (kind, name).
+
+    With explain, the EXPLAIN plan of each named query is kept the first
+    time it runs; Redshift has no EXPLAIN ANALYZE, so this is the plan
+    only. With scan_bytes, the bytes each statement scanned are read from
+    stl_scan, or from stl_s3client for a COPY, with one more query after
+    each statement. Both system tables only exist on Redshift. `write`
+    appends the totals to a JSON-lines file, or replaces a Prometheus
+    text file when the path ends in .prom."""
+
+    COUNTERS = [('rows', 'Rows affected or returned.'),
+                ('bytes', 'Bytes scanned, or read from S3 by COPY.')]
+
+    def __init__(self, pipeline='redshift', explain=False, scan_bytes=False):
+        super().__init__(pipeline, explain)
+        self.scan_bytes = scan_bytes
+
+    def configure(self, config, path=None):
+        """Reads EXPLAIN and SCAN_BYTES from the [METRICS] section of
+        dwh.cfg. path is the file the run's metrics are written to, by
+        default [METRICS] FILE. SCAN_BYTES defaults to on for the Redshift
+        backend, but only when there is such a file, so a run whose
+        metrics are not kept does not query the system tables."""
+        path = path or config.get('METRICS', 'FILE', fallback='')
+        redshift = config.get('COPY', 'BACKEND', fallback='redshift') == 'redshift'
+        self.explain = config.getboolean('METRICS', 'EXPLAIN', fallback=False)
+        self.scan_bytes = bool(path) and \
+            config.getboolean('METRICS', 'SCAN_BYTES', fallback=redshift)
+
+    def cursor_factory(self):
+        """Returns a cursor class that records every statement it runs."""
+        recorder = self
+
+        class MeasuredCursor(psycopg2.extensions.cursor):
+
+            def execute(self, query, vars=None):
+                name = query_name(query)
+                if recorder.explain and name not in recorder.plans \
+                        and query in QUERY_NAMES \
+                        and query.lstrip().upper().startswith(EXPLAINABLE):
+                    super().execute("EXPLAIN " + query, vars)
+                    recorder.plans[name] = '\n'.join(row[0] for row in self.fetchall())
+
+                with recorder.measure('query', name) as stats:
+                    result = super().execute(query, vars)
+                    stats['rows'] = self.rowcount
+                if recorder.scan_bytes and not self.description:
+                    is_copy = str(query).lstrip().upper().startswith('COPY')
+                    super().execute(copy_bytes_select if is_copy else scan_bytes_select)
+                    recorder.add('query', name, 0.0, bytes_read=self.fetchone()[0], calls=0)
+                return result
+
+        return MeasuredCursor
+
+
+# recorder of this process; etl.py and create_tables.py configure it
+recorder = Recorder()
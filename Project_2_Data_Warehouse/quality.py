@@ -0,0 +1,38 @@
+from sql_queries import quality_table_counts, quality_duplicate_keys, \
+    quality_songplay, quality_match_rate, quality_dimensions
+from metrics import recorder, query_name
+from common.quality import Check, run_query_checks
+
+
+def default_checks(config):
+    """Returns the checks run after a load, with the thresholds of the
+    [QUALITY] section of dwh.cfg: every table has rows, no key is
+    duplicated or orphaned, and the NULL ratios and the match rate of the
+    staged song plays are within MAX_NULL_RATIO and MIN_MATCH_RATE."""
+    max_null_ratio = config.getfloat('QUALITY', 'MAX_NULL_RATIO', fallback=0.0)
+    min_match_rate = config.getfloat('QUALITY', 'MIN_MATCH_RATE', fallback=0.0)
+
+    checks = [Check(quality_table_counts, '{}_rows'.format(table), '>', 0)
+              for table in ('songplay', 'users', 'songs', 'artists', 'time')]
+    checks += [Check(quality_duplicate_keys, column, '==', 0)
+               for column in ('duplicate_user_ids', 'duplicate_song_ids',
+                              'duplicate_artist_ids', 'duplicate_start_times',
+                              'duplicate_plays')]
+    checks += [Check(quality_songplay, 'level_null_ratio', '<=', max_null_ratio)]
+    checks += [Check(quality_songplay, column, '==', 0)
+               for column in ('orphan_song_ids', 'orphan_artist_ids',
+                              'orphan_user_ids', 'orphan_start_times')]
+    checks += [Check(quality_match_rate, 'match_rate', '>=', min_match_rate),
+               Check(quality_dimensions, 'orphan_song_artists', '==', 0)]
+    checks += [Check(quality_dimensions, column, '<=', max_null_ratio)
+               for column in ('song_title_null_ratio', 'artist_name_null_ratio',
+                              'user_level_null_ratio')]
+    return checks
+
+
+def run_checks(cur, checks):
+    """Runs each query of the checks once and evaluates its checks on the
+    row it returns. Query times are added to the metrics recorder as
+    'check' records. Prints a report and returns (check, value, passed)
+    for every check."""
+    return run_query_checks(cur, checks, recorder, query_name)
@@ -14,6 +14,7 @@ user_table_drop = "DROP TABLE IF EXISTS users;"
 song_table_drop = "DROP TABLE IF EXISTS songs;"
 artist_table_drop = "DROP TABLE IF EXISTS artists;"
 time_table_drop = "DROP TABLE IF EXISTS time;"
+load_manifest_table_drop = "DROP TABLE IF EXISTS load_manifest;"
 
 # CREATE TABLES
 
@@ -50,51 +51,116 @@ staging_songs_table_create = ("CREATE TABLE IF NOT EXISTS staging_songs( \
                                   duration float, \
                                   year int);")
 
-songplay_table_create = ("CREATE TABLE IF NOT EXISTS songplay( \
+# TABLE DESIGN
+# The distribution style and sort keys of the star schema come from a
+# [PROFILE <name>] section of dwh.cfg; [DESIGN] PROFILE picks the one used.
+
+DESIGN_PROFILE = config.get('DESIGN', 'PROFILE', fallback='all')
+
+# the local backend ([COPY] BACKEND=local) is a Postgres database, which has
+# no distribution or sort keys, no IDENTITY and no getdate()
+LOCAL_BACKEND = config.get('COPY', 'BACKEND', fallback='redshift') == 'local'
+
+# current design: every table replicated, sorted on its key
+default_table_design = {
+    'songplay': 'diststyle all sortkey(start_time)',
+    'users': 'diststyle all sortkey(user_id)',
+    'songs': 'diststyle all sortkey(song_id)',
+    'artists': 'diststyle all sortkey(artist_id)',
+    'time': 'diststyle all sortkey(start_time)',
+}
+
+
+def table_design(profile):
+    """Returns the table attributes (distribution and sort keys) of each
+    star schema table for a design profile. The local backend has none."""
+    if LOCAL_BACKEND:
+        return dict.fromkeys(default_table_design, '')
+    design = dict(default_table_design)
+    section = 'PROFILE {}'.format(profile)
+    if config.has_section(section):
+        design.update(config[section])
+    return design
+
+
+songplay_table_columns = ("CREATE TABLE IF NOT EXISTS songplay( \
                             songplay_id int IDENTITY(1,1) PRIMARY KEY, \
-                            start_time timestamp NOT NULL REFERENCES time(start_time) sortkey, \
+                            start_time timestamp NOT NULL REFERENCES time(start_time), \
                             user_id int NOT NULL REFERENCES users(user_id), \
                             level varchar, \
                             song_id varchar NOT NULL REFERENCES songs(song_id), \
                             artist_id varchar NOT NULL REFERENCES artists(artist_id), \
                             session_id int, \
                             location varchar, \
-                            user_agent varchar) \
-                        diststyle all;")
+                            user_agent varchar) ")
+
+# Postgres enforces REFERENCES, which would reject the delete-then-insert
+# merge of a dimension whose keys songplay uses, so the local table has none
+if LOCAL_BACKEND:
+    songplay_table_columns = ("CREATE TABLE IF NOT EXISTS songplay( \
+                                songplay_id SERIAL PRIMARY KEY, \
+                                start_time timestamp NOT NULL, \
+                                user_id int NOT NULL, \
+                                level varchar, \
+                                song_id varchar NOT NULL, \
+                                artist_id varchar NOT NULL, \
+                                session_id int, \
+                                location varchar, \
+                                user_agent varchar) ")
 
-user_table_create = ("CREATE TABLE IF NOT EXISTS users ( \
-                        user_id int PRIMARY KEY sortkey, \
+user_table_columns = ("CREATE TABLE IF NOT EXISTS users ( \
+                        user_id int PRIMARY KEY, \
                         first_name varchar, \
                         last_name varchar, \
                         gender varchar, \
-                        level varchar) \
-                    diststyle all;")
+                        level varchar) ")
 
-song_table_create = ("CREATE TABLE IF NOT EXISTS songs ( \
-                        song_id varchar PRIMARY KEY sortkey, \
+song_table_columns = ("CREATE TABLE IF NOT EXISTS songs ( \
+                        song_id varchar PRIMARY KEY, \
                         title varchar, \
                         artist_id varchar NOT NULL, \
                         year int, \
-                        duration float) \
-                    diststyle all;")
+                        duration float) ")
 
-artist_table_create = ("CREATE TABLE IF NOT EXISTS artists ( \
-                            artist_id varchar PRIMARY KEY sortkey, \
+artist_table_columns = ("CREATE TABLE IF NOT EXISTS artists ( \
+                            artist_id varchar PRIMARY KEY, \
                             name varchar, \
                             location varchar, \
                             latitude float, \
-                            longitude float) \
-                        diststyle all;")
+                            longitude float) ")
 
-time_table_create = ("CREATE TABLE IF NOT EXISTS time ( \
-                        start_time timestamp PRIMARY KEY sortkey, \
+time_table_columns = ("CREATE TABLE IF NOT EXISTS time ( \
+                        start_time timestamp PRIMARY KEY, \
                         hour int, \
                         day int, \
                         week int, \
                         month int, \
                         year int, \
-                        weekday int) \
-                    diststyle all;")
+                        weekday int) ")
+
+
+def star_table_creates(profile):
+    """Returns the CREATE statements of the dimension and fact tables for a
+    design profile, dimensions first."""
+    design = table_design(profile)
+    return [user_table_columns + design['users'] + ";",
+            song_table_columns + design['songs'] + ";",
+            artist_table_columns + design['artists'] + ";",
+            time_table_columns + design['time'] + ";",
+            songplay_table_columns + design['songplay'] + ";"]
+
+
+user_table_create, song_table_create, artist_table_create, time_table_create, \
+    songplay_table_create = star_table_creates(DESIGN_PROFILE)
+
+load_manifest_table_create = ("CREATE TABLE IF NOT EXISTS load_manifest ( \
+                                  s3_path varchar(1024) PRIMARY KEY, \
+                                  size bigint, \
+                                  etag varchar(64), \
+                                  last_modified timestamp, \
+                                  loaded_at timestamp DEFAULT {}) {};").format(
+                                  'now()' if LOCAL_BACKEND else 'getdate()',
+                                  '' if LOCAL_BACKEND else 'diststyle all')
 
 # STAGING TABLES
 
@@ -108,74 +174,255 @@ staging_events_copy = ("copy staging_events from {} iam_role {} region 'us-west-
 
 staging_songs_copy = ("""copy staging_songs from {} iam_role {} region 'us-west-2' json 'auto' truncatecolumns""").format(SONG_DATA, ARN)
 
+# incremental runs COPY only the new files, listed in a COPY manifest
+MANIFEST_PREFIX = config.get('S3', 'MANIFEST_PREFIX', fallback=None)
+
+staging_events_manifest_copy = ("copy staging_events from '{{manifest}}' iam_role {} region 'us-west-2' json {} manifest").format(ARN, LOG_JSON_PATH)
+
+staging_songs_manifest_copy = ("copy staging_songs from '{{manifest}}' iam_role {} region 'us-west-2' json 'auto' truncatecolumns manifest").format(ARN)
+
+# one COPY per staging table of the parallel loader, options from [COPY]
+staging_table_copy = ("copy {{table}} from '{{manifest}}' iam_role {} region 'us-west-2' {{format}} manifest {{options}}").format(ARN)
+
+# per-file rows and rejected rows of the last COPY in this session
+load_commits_select = ("SELECT TRIM(filename), lines_scanned, curtime FROM stl_load_commits \
+                        WHERE query = pg_last_copy_id() ORDER BY filename;")
+
+load_errors_select = ("SELECT TRIM(filename), line_number, TRIM(colname), TRIM(err_reason) \
+                       FROM stl_load_errors WHERE query = pg_last_copy_id() \
+                       ORDER BY filename, line_number;")
+
+# staging tables hold only the files of the current load. Full loads
+# TRUNCATE them; incremental loads DELETE, which unlike TRUNCATE does not
+# commit the transaction.
+staging_events_truncate = "TRUNCATE staging_events;"
+staging_songs_truncate = "TRUNCATE staging_songs;"
+staging_clear_queries = ["DELETE FROM staging_events;", "DELETE FROM staging_songs;"]
+
+# LOAD MANIFEST
+
+load_manifest_select = "SELECT s3_path, size, etag FROM load_manifest;"
+
+load_manifest_delete = "DELETE FROM load_manifest WHERE s3_path IN %s;"
+
+# a full load replaces the whole manifest with the files it listed
+load_manifest_clear = "DELETE FROM load_manifest;"
+
+load_manifest_insert = ("INSERT INTO load_manifest (s3_path, size, etag, last_modified) \
+                         VALUES %s")
+
 
 # FINAL TABLES
+# Redshift does not enforce primary keys, so each table is merged from the
+# staging delta: the keys present in staging are deleted, then the latest
+# staged row per key (ROW_NUMBER) is inserted. insert_tables runs all of
+# them in one transaction, so reruns and reloads never duplicate rows.
 
-songplay_table_insert = ("""INSERT INTO songplay( \
-                                start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) \
-                            SELECT timestamp 'epoch' + ts/1000* interval '1 second', \
-                                user_id, \
-                                level, \
-                                song_id, \
-                                artist_id, \
-                                sessionid, \
-                                location, \
-                                userAgent \
-                            FROM staging_events \
-                            JOIN staging_songs \
-                            ON staging_events.artist = staging_songs.artist_name \
-                                AND staging_events.song = staging_songs.title \
-                            WHERE staging_events.page = 'NextSong'""")
+user_table_delete = ("""DELETE FROM users \
+                        USING staging_events e \
+                        WHERE e.page = 'NextSong' \
+                        AND users.user_id = e.user_id;""")
 
 user_table_insert = ("""INSERT INTO users (user_id, first_name, last_name, gender, level) \
-                        SELECT DISTINCT user_id, \
-                            firstName, \
-                            lastName, \
-                            gender, \
-                            level \
-                        FROM staging_events \
-                        WHERE page='NextSong';""")
-
-song_table_insert = ("""INSERT INTO songs (song_id, title, artist_id, year, duration)\
-                        SELECT DISTINCT song_id, \
-                            title, \
-                            artist_id, \
-                            year, \
-                            duration \
-                        FROM staging_songs;""")
+                        SELECT user_id, firstName, lastName, gender, level \
+                        FROM (SELECT user_id, firstName, lastName, gender, level, \
+                                  ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY ts DESC) AS rn \
+                              FROM staging_events \
+                              WHERE page = 'NextSong' AND user_id IS NOT NULL) AS latest \
+                        WHERE latest.rn = 1;""")
+
+song_table_delete = ("""DELETE FROM songs \
+                        USING staging_songs s \
+                        WHERE songs.song_id = s.song_id;""")
+
+song_table_insert = ("""INSERT INTO songs (song_id, title, artist_id, year, duration) \
+                        SELECT song_id, title, artist_id, year, duration \
+                        FROM (SELECT song_id, title, artist_id, year, duration, \
+                                  ROW_NUMBER() OVER (PARTITION BY song_id \
+                                                     ORDER BY year DESC, duration DESC) AS rn \
+                              FROM staging_songs \
+                              WHERE song_id IS NOT NULL) AS latest \
+                        WHERE latest.rn = 1;""")
+
+artist_table_delete = ("""DELETE FROM artists \
+                          USING staging_songs s \
+                          WHERE artists.artist_id = s.artist_id;""")
 
 artist_table_insert = ("""INSERT INTO artists (artist_id, name, location, latitude, longitude) \
-                          SELECT DISTINCT artist_id, \
-                              artist_name, \
-                              artist_location, \
-                              artist_latitude, \
-                              artist_longitude \
-                          FROM staging_songs;""")
+                          SELECT artist_id, artist_name, artist_location, \
+                              artist_latitude, artist_longitude \
+                          FROM (SELECT artist_id, artist_name, artist_location, \
+                                    artist_latitude, artist_longitude, \
+                                    ROW_NUMBER() OVER (PARTITION BY artist_id \
+                                                       ORDER BY artist_latitude IS NULL, \
+                                                                artist_location, artist_name) AS rn \
+                                FROM staging_songs \
+                                WHERE artist_id IS NOT NULL) AS latest \
+                          WHERE latest.rn = 1;""")
+
+# time rows come from the staged events, not from songplay after the fact.
+# weekday counts from Monday = 0, as in the other projects; dow counts
+# from Sunday = 0
+time_table_delete = ("""DELETE FROM time \
+                        USING staging_events e \
+                        WHERE e.page = 'NextSong' \
+                        AND time.start_time = timestamp 'epoch' + e.ts/1000 * interval '1 second';""")
 
 time_table_insert = ("""INSERT INTO time (start_time, hour, day, week, month, year, weekday) \
-                        SELECT DISTINCT start_time,
+                        SELECT start_time,
                             EXTRACT (hour FROM start_time),
                             EXTRACT (day FROM start_time),
                             EXTRACT (week FROM start_time),
                             EXTRACT (month FROM start_time),
                             EXTRACT (year FROM start_time),
-                            EXTRACT (weekday FROM start_time)
-                        FROM songplay;""")
+                            (EXTRACT (dow FROM start_time) + 6) % 7
+                        FROM (SELECT DISTINCT timestamp 'epoch' + ts/1000 * interval '1 second' AS start_time \
+                              FROM staging_events \
+                              WHERE page = 'NextSong') AS starts;""")
+
+# a play is identified by its user, session and timestamp
+songplay_table_delete = ("""DELETE FROM songplay \
+                            USING staging_events e \
+                            WHERE e.page = 'NextSong' \
+                            AND songplay.user_id = e.user_id \
+                            AND songplay.session_id = e.sessionid \
+                            AND songplay.start_time = timestamp 'epoch' + e.ts/1000 * interval '1 second';""")
+
+# songs and artists are matched from the merged dimensions, so the staging
+# tables only need to hold the files of the current load. A play matches on
+# title, artist and duration, since an artist can have two songs of the
+# same title
+songplay_table_insert = ("""INSERT INTO songplay( \
+                                start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) \
+                            SELECT start_time, user_id, level, song_id, artist_id, sessionid, location, userAgent \
+                            FROM (SELECT timestamp 'epoch' + e.ts/1000 * interval '1 second' AS start_time, \
+                                      e.user_id, \
+                                      e.level, \
+                                      s.song_id, \
+                                      s.artist_id, \
+                                      e.sessionid, \
+                                      e.location, \
+                                      e.userAgent, \
+                                      ROW_NUMBER() OVER (PARTITION BY e.user_id, e.sessionid, e.ts \
+                                                         ORDER BY s.song_id) AS rn \
+                                  FROM staging_events e \
+                                  JOIN songs s ON e.song = s.title AND e.length = s.duration \
+                                  JOIN artists a ON s.artist_id = a.artist_id AND e.artist = a.name \
+                                  WHERE e.page = 'NextSong') AS latest \
+                            WHERE latest.rn = 1;""")
+
+# ANALYTIC QUERIES
+# Standard song play analysis used to compare table design profiles.
+
+analytic_queries = {
+    'plays_per_hour': """SELECT t.hour, COUNT(*) FROM songplay sp \
+                         JOIN time t ON sp.start_time = t.start_time \
+                         GROUP BY t.hour ORDER BY t.hour;""",
+    'top_songs': """SELECT s.title, COUNT(*) AS plays FROM songplay sp \
+                    JOIN songs s ON sp.song_id = s.song_id \
+                    GROUP BY s.title ORDER BY plays DESC LIMIT 10;""",
+    'top_artists_paid': """SELECT a.name, COUNT(*) AS plays FROM songplay sp \
+                           JOIN artists a ON sp.artist_id = a.artist_id \
+                           WHERE sp.level = 'paid' \
+                           GROUP BY a.name ORDER BY plays DESC LIMIT 10;""",
+    'user_activity_by_day': """SELECT sp.user_id, t.day, COUNT(*) FROM songplay sp \
+                               JOIN time t ON sp.start_time = t.start_time \
+                               JOIN users u ON sp.user_id = u.user_id \
+                               WHERE sp.start_time BETWEEN '2018-11-01' AND '2018-11-15' \
+                               GROUP BY sp.user_id, t.day;""",
+    'single_user_history': """SELECT sp.start_time, s.title FROM songplay sp \
+                              JOIN songs s ON sp.song_id = s.song_id \
+                              WHERE sp.user_id = 49 ORDER BY sp.start_time;""",
+}
+
+# DATA QUALITY CHECKS
+# Each query returns a single row of metrics over whole tables, which
+# quality.py compares with the thresholds of its checks. Redshift does not
+# enforce the REFERENCES and PRIMARY KEY constraints declared above, so
+# orphan and duplicate keys are counted here.
+
+quality_table_counts = ("""SELECT (SELECT COUNT(*) FROM songplay) AS songplay_rows, \
+                               (SELECT COUNT(*) FROM users) AS users_rows, \
+                               (SELECT COUNT(*) FROM songs) AS songs_rows, \
+                               (SELECT COUNT(*) FROM artists) AS artists_rows, \
+                               (SELECT COUNT(*) FROM time) AS time_rows;""")
+
+quality_duplicate_keys = ("""SELECT (SELECT COUNT(*) - COUNT(DISTINCT user_id) FROM users) AS duplicate_user_ids, \
+                                 (SELECT COUNT(*) - COUNT(DISTINCT song_id) FROM songs) AS duplicate_song_ids, \
+                                 (SELECT COUNT(*) - COUNT(DISTINCT artist_id) FROM artists) AS duplicate_artist_ids, \
+                                 (SELECT COUNT(*) - COUNT(DISTINCT start_time) FROM time) AS duplicate_start_times, \
+                                 (SELECT COUNT(*) FROM songplay) \
+                                 - (SELECT COUNT(*) FROM (SELECT DISTINCT user_id, session_id, start_time \
+                                                          FROM songplay) plays) AS duplicate_plays;""")
+
+# the dimension keys are made distinct first, so duplicate keys do not
+# multiply the song plays counted
+quality_songplay = ("""SELECT COALESCE(AVG(CASE WHEN sp.level IS NULL THEN 1.0 ELSE 0 END), 0) AS level_null_ratio, \
+                           COALESCE(SUM(CASE WHEN s.song_id IS NULL THEN 1 ELSE 0 END), 0) AS orphan_song_ids, \
+                           COALESCE(SUM(CASE WHEN a.artist_id IS NULL THEN 1 ELSE 0 END), 0) AS orphan_artist_ids, \
+                           COALESCE(SUM(CASE WHEN u.user_id IS NULL THEN 1 ELSE 0 END), 0) AS orphan_user_ids, \
+                           COALESCE(SUM(CASE WHEN t.start_time IS NULL THEN 1 ELSE 0 END), 0) AS orphan_start_times \
+                       FROM songplay sp \
+                       LEFT JOIN (SELECT DISTINCT song_id FROM songs) s ON sp.song_id = s.song_id \
+                       LEFT JOIN (SELECT DISTINCT artist_id FROM artists) a ON sp.artist_id = a.artist_id \
+                       LEFT JOIN (SELECT DISTINCT user_id FROM users) u ON sp.user_id = u.user_id \
+                       LEFT JOIN (SELECT DISTINCT start_time FROM time) t ON sp.start_time = t.start_time;""")
+
+# share of the staged NextSong events that songplay_table_insert can match
+# to a song and artist, i.e. the match rate of the current load
+quality_match_rate = ("""SELECT COUNT(*) AS next_song_events, \
+                             COALESCE(AVG(CASE WHEN m.title IS NOT NULL THEN 1.0 ELSE 0 END), 0) AS match_rate \
+                         FROM staging_events e \
+                         LEFT JOIN (SELECT DISTINCT s.title, a.name, s.duration FROM songs s \
+                                    JOIN artists a ON s.artist_id = a.artist_id) m \
+                         ON e.song = m.title AND e.artist = m.name AND e.length = m.duration \
+                         WHERE e.page = 'NextSong';""")
+
+quality_dimensions = ("""SELECT (SELECT COUNT(*) FROM songs s \
+                                 LEFT JOIN (SELECT DISTINCT artist_id FROM artists) a \
+                                 ON s.artist_id = a.artist_id \
+                                 WHERE a.artist_id IS NULL) AS orphan_song_artists, \
+                             (SELECT COALESCE(AVG(CASE WHEN title IS NULL THEN 1.0 ELSE 0 END), 0) \
+                              FROM songs) AS song_title_null_ratio, \
+                             (SELECT COALESCE(AVG(CASE WHEN name IS NULL THEN 1.0 ELSE 0 END), 0) \
+                              FROM artists) AS artist_name_null_ratio, \
+                             (SELECT COALESCE(AVG(CASE WHEN level IS NULL THEN 1.0 ELSE 0 END), 0) \
+                              FROM users) AS user_level_null_ratio;""")
 
 # QUERY LISTS
 
 create_table_queries = [staging_events_table_create, staging_songs_table_create, 
                          user_table_create, song_table_create, 
-                        artist_table_create, time_table_create, songplay_table_create]
+                        artist_table_create, time_table_create, songplay_table_create,
+                        load_manifest_table_create]
 
 drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, 
                       songplay_table_drop, user_table_drop, song_table_drop, 
-                      artist_table_drop, time_table_drop]
+                      artist_table_drop, time_table_drop, load_manifest_table_drop]
+
+copy_table_queries = [staging_events_truncate, staging_songs_truncate,
+                      staging_events_copy, staging_songs_copy]
+
+# STAGES
+# (name, queries, stages it needs) of a full load, for etl.py
+# --parallel-stages. Stages whose needs have finished run concurrently,
+# each committing on its own connection. songplay is matched against the
+# merged songs and artists; time comes from the staged events, so it does
+# not wait for songplay.
 
-copy_table_queries = [staging_events_copy, staging_songs_copy]
+staging_stages = [('staging_events', [staging_events_truncate, staging_events_copy], []),
+                  ('staging_songs', [staging_songs_truncate, staging_songs_copy], [])]
 
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, 
-                        artist_table_insert, time_table_insert]
+insert_table_stages = [('users', [user_table_delete, user_table_insert], ['staging_events']),
+                       ('songs', [song_table_delete, song_table_insert], ['staging_songs']),
+                       ('artists', [artist_table_delete, artist_table_insert], ['staging_songs']),
+                       ('time', [time_table_delete, time_table_insert], ['staging_events']),
+                       ('songplay', [songplay_table_delete, songplay_table_insert],
+                        ['staging_events', 'songs', 'artists'])]
 
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, 
-                        artist_table_insert, time_table_insert]
\ No newline at end of file
+# dimensions before songplay, which is matched against songs and artists
+insert_table_queries = [user_table_delete, user_table_insert,
+                        song_table_delete, song_table_insert,
+                        artist_table_delete, artist_table_insert,
+                        time_table_delete, time_table_insert,
+                        songplay_table_delete, songplay_table_insert]
@@ -0,0 +1,145 @@
+"""Local benchmark of process_log_data on synthetic Sparkify logs.
+
+Generates a dataset with benchmark/generate.py at several multiples of a
+base number of songs and events, runs the log pipeline on it in local[*]
+mode and compares the native ms_to_timestamp conversion with the Python
+UDF it replaced.
+
+    python benchmark.py --scales 1 10 100 --events 10000
+
+With --profiles, the songplays join is also timed at every scale under
+each job profile, shuffled instead of broadcast. Song popularity follows
+generate.py's Zipf distribution, and a larger --song-skew puts more of
+the plays on a few hit songs:
+
+    python benchmark.py --scales 10 --song-skew 2 --profiles static adaptive salted --summary
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import udf
+from pyspark.sql.types import TimestampType
+
+import etl
+from job_profile import job_profile, PROFILES
+from metrics import recorder
+
+# the dataset generator shared by all benchmarks
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                'benchmark'))
+import generate
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def convert_with_udf(df):
+    """The UDF conversion used before ms_to_timestamp."""
+    get_timestamp = udf(lambda ts: datetime.fromtimestamp(ts / 1000.0), TimestampType())
+    df.withColumn("start_time", get_timestamp('ts')).write.format('noop').mode('overwrite').save()
+
+
+def convert_native(df):
+    df.withColumn("start_time", etl.ms_to_timestamp('ts')).write.format('noop').mode('overwrite').save()
+
+
+def time_profile(spark, profile, input_data, output_data):
+    """Times write_songplays with the job profile, with the song lookup
+    read back from the written tables and joined without broadcast."""
+    for key in ("spark.sql.adaptive.enabled", "spark.sql.shuffle.partitions"):
+        spark.conf.unset(key)
+    job_profile.name = profile
+    job_profile.apply(spark, etl.input_size(spark, output_data))
+    df, new_files = etl.read_log_events(spark, input_data, output_data)
+    recorder.metrics.clear()
+    recorder.details.clear()
+    seconds = timed(etl.write_songplays, spark, output_data)
+    if recorder.summarize:
+        print(recorder.summary())
+    df.unpersist()
+    return seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark process_log_data in local mode.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--events', type=int, default=10000, help='log events at scale 1')
+    parser.add_argument('--songs', type=int, default=1000, help='songs at scale 1')
+    parser.add_argument('--users', type=int, default=100, help='users at scale 1')
+    parser.add_argument('--song-skew', type=float, default=1.1,
+                        help='Zipf exponent of song popularity, 0 for uniform')
+    parser.add_argument('--match-rate', type=float, default=0.5,
+                        help='share of song plays whose song is in song_data')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--profiles', nargs='+', choices=PROFILES, default=[],
+                        help='also time the shuffled songplays join under these profiles')
+    parser.add_argument('--partition-mb', type=float, default=1.0,
+                        help='shuffle partition and skew threshold size of the profiles')
+    parser.add_argument('--summary', action='store_true',
+                        help='print the plan and per-stage metrics of the songplays '
+                        'write under each profile')
+    args = parser.parse_args()
+
+    # the local datasets are small, so partitions count as skewed far below
+    # the sizes used on a cluster
+    job_profile.partition_bytes = int(args.partition_mb * 2 ** 20)
+    job_profile.skew_threshold_bytes = job_profile.partition_bytes
+    recorder.summarize = args.summary
+
+    spark = SparkSession.builder.master('local[*]') \
+        .config("spark.sql.session.timeZone", etl.SPARK_TIMEZONE) \
+        .getOrCreate()
+
+    print('{:>6} {:>10} {:>16} {:>10} {:>12} {:>8}'.format(
+        'scale', 'events', 'process_log_data', 'udf', 'native', 'speedup'))
+    for scale in args.scales:
+        workdir = tempfile.mkdtemp(prefix='sparkify_bench_')
+        try:
+            input_data = os.path.join(workdir, 'data') + '/'
+            output_data = os.path.join(workdir, 'output') + '/'
+            counts = generate.generate(workdir, scale, args.songs, args.events, args.users,
+                                       song_skew=args.song_skew, match_rate=args.match_rate,
+                                       seed=args.seed)
+
+            song_dim = etl.process_song_data(spark, input_data, output_data)
+            log_time = timed(etl.process_log_data, spark, input_data, output_data,
+                             False, song_dim)
+            song_dim.unpersist()
+
+            df = spark.read.json(input_data + "log_data/*/*/*.json", etl.log_data_schema)
+            udf_time = timed(convert_with_udf, df)
+            native_time = timed(convert_native, df)
+
+            print('{:>6} {:>10} {:>15.2f}s {:>9.2f}s {:>11.2f}s {:>7.1f}x'.format(
+                scale, counts['events'], log_time, udf_time, native_time,
+                udf_time / max(native_time, 1e-9)))
+
+            if args.profiles:
+                # shuffle the songplays join so its skew shows
+                broadcast_max_rows = etl.BROADCAST_MAX_ROWS
+                etl.BROADCAST_MAX_ROWS = -1
+                spark.conf.set("spark.sql.autoBroadcastJoinThreshold", "-1")
+                try:
+                    for profile in args.profiles:
+                        print('{:>6} {:>10} songplays join, {} profile: {:.2f}s'.format(
+                            scale, counts['events'], profile,
+                            time_profile(spark, profile, input_data, output_data)))
+                finally:
+                    etl.BROADCAST_MAX_ROWS = broadcast_max_rows
+                    spark.conf.unset("spark.sql.autoBroadcastJoinThreshold")
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    spark.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,27 @@
+import argparse
 import configparser
-from datetime import datetime
 import os
+import sys
+
+# the repository root, so the modules of this project can import the
+# shared modules of common/ whatever the order of their imports
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import udf, col
-from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format, from_unixtime
+from pyspark.sql.functions import col
+from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, dayofweek
 from pyspark.sql.types import StructType, IntegerType, StringType, FloatType, StructField, LongType, TimestampType
-from datetime import datetime
+from manifest import list_input_files, read_manifest, pending_files, \
+    record_files, manifest_path
+from writer import write_table, compact_table, read_table, TABLES
+from metrics import recorder
+from common.scheduler import Stage, Scheduler
+from staging_cache import staging_cache
+from input_compaction import input_compactor
+from job_profile import job_profile, PROFILES, SALT
+import quality
 
 
 config = configparser.ConfigParser()
@@ -14,41 +30,205 @@ config.read('dl.cfg')
 os.environ['AWS_ACCESS_KEY_ID']=config['KEYS']['AWS_ACCESS_KEY_ID']
 os.environ['AWS_SECRET_ACCESS_KEY']=config['KEYS']['AWS_SECRET_ACCESS_KEY']
 
+# time zone used to derive hour/day/... from the epoch timestamps, so the
+# output does not depend on the time zone of the machines running the job
+SPARK_TIMEZONE = config.get('SPARK', 'TIMEZONE', fallback='UTC')
+
+# song dimensions up to this many rows are broadcast to every executor for
+# the songplays join instead of being shuffled
+BROADCAST_MAX_ROWS = config.getint('SPARK', 'BROADCAST_MAX_ROWS', fallback=1000000)
+
+# target number of rows per output parquet file
+ROWS_PER_FILE = config.getint('SPARK', 'ROWS_PER_FILE', fallback=1000000)
+
+# df.explain mode of the plans kept with the metrics, and the JSON-lines or
+# Prometheus .prom file the metrics are written to; empty to disable
+recorder.explain = config.get('METRICS', 'EXPLAIN', fallback='') or None
+METRICS_FILE = config.get('METRICS', 'FILE', fallback='')
+
+# stages run at the same time with --parallel-stages, and the file the
+# finished stages are recorded in for --resume
+STAGE_WORKERS = config.getint('SPARK', 'STAGE_WORKERS', fallback=2)
+STATE_FILE = config.get('SPARK', 'STATE_FILE', fallback='.etl_state.json')
+
+# data quality checks run after the load, their thresholds, and whether a
+# failed check makes etl.py exit with status 1
+QUALITY_ENABLED = config.getboolean('QUALITY', 'ENABLED', fallback=True)
+MAX_NULL_RATIO = config.getfloat('QUALITY', 'MAX_NULL_RATIO', fallback=0.0)
+MIN_MATCH_RATE = config.getfloat('QUALITY', 'MIN_MATCH_RATE', fallback=0.0)
+QUALITY_STRICT = config.getboolean('QUALITY', 'STRICT', fallback=False)
+
+# directory of the parquet copies of the parsed input files, empty to read
+# the json every run, the size the least recently used are evicted at, and
+# the size of the files the newly parsed input is packed into
+staging_cache.configure(config.get('CACHE', 'DIR', fallback=''),
+                        config.getint('CACHE', 'MAX_BYTES', fallback=10 << 30),
+                        config.getint('CACHE', 'TARGET_MB', fallback=128) << 20)
+
+# directory of the compacted parquet copy of the whole input written by
+# --compact-input, the size of its files and of the splits the small json
+# files are packed into, the cost of opening a file counted while packing,
+# and the threads listing the input
+input_compactor.configure(config.get('COMPACTION', 'DIR', fallback=''),
+                          config.getint('COMPACTION', 'TARGET_MB', fallback=128) << 20,
+                          config.getint('COMPACTION', 'OPEN_COST_KB', fallback=64) << 10,
+                          config.getint('COMPACTION', 'THREADS', fallback=16))
+
+# job profile of the shuffles: static keeps Spark's settings, adaptive
+# enables adaptive query execution with skew join splitting, salted salts
+# the hot keys of the songplays join. Shuffle partitions are sized at one per
+# PARTITION_MB of input, and song/artist/length keys holding HOT_KEY_SHARE
+# of the events are salted into SALT_BUCKETS when adaptive execution is off
+job_profile.name = config.get('PROFILE', 'NAME', fallback='adaptive')
+job_profile.partition_bytes = config.getint('PROFILE', 'PARTITION_MB', fallback=64) << 20
+job_profile.min_partitions = config.getint('PROFILE', 'MIN_PARTITIONS', fallback=8)
+job_profile.max_partitions = config.getint('PROFILE', 'MAX_PARTITIONS', fallback=2000)
+job_profile.skew_factor = config.getint('PROFILE', 'SKEW_FACTOR', fallback=5)
+job_profile.skew_threshold_bytes = config.getint('PROFILE', 'SKEW_THRESHOLD_MB',
+                                                 fallback=256) << 20
+job_profile.salt_buckets = config.getint('PROFILE', 'SALT_BUCKETS', fallback=16)
+job_profile.hot_key_share = config.getfloat('PROFILE', 'HOT_KEY_SHARE', fallback=0.01)
+
+# print the plan and per-stage task metrics of every write after the run
+recorder.summarize = config.getboolean('METRICS', 'SUMMARY', fallback=False)
+
+# input files below the --input location
+SONG_DATA = "song_data/*/*/*/*.json"
+LOG_DATA = "log_data/*/*/*.json"
+
+# song_data schema
+song_data_schema = StructType([
+    StructField('num_songs', IntegerType(), True),
+    StructField('artist_id', StringType(), True),
+    StructField('artist_latitude', FloatType(), True),
+    StructField('artist_longitude', FloatType(), True),
+    StructField('artist_location', StringType(), True),
+    StructField('artist_name', StringType(), True),
+    StructField('song_id', StringType(), True),
+    StructField('title', StringType(), True),
+    StructField('duration', FloatType(), True),
+    StructField('year', IntegerType(), True)
+])
+
+# log_data schema
+log_data_schema = StructType([
+    StructField('artist', StringType(), True),
+    StructField('auth', StringType(), True),
+    StructField('firstName', StringType(), True),
+    StructField('gender', StringType(), True),
+    StructField('itemInSession', IntegerType(), True),
+    StructField('lastName', StringType(), True),
+    StructField('length', FloatType(), True),
+    StructField('level', StringType(), True),
+    StructField('location', StringType(), True),
+    StructField('method', StringType(), True),
+    StructField('page', StringType(), True),
+    StructField('registration', FloatType(), True),
+    StructField('sessionId', IntegerType(), True),
+    StructField('song', StringType(), True),
+    StructField('status', StringType(), True),
+    StructField('ts', LongType(), True),
+    StructField('userAgent', StringType(), True),
+    StructField('user_id', IntegerType(), True)
+])
+
 
 def create_spark_session():
     """Create the spark session"""
     spark = SparkSession \
         .builder \
         .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
+        .config("spark.sql.session.timeZone", SPARK_TIMEZONE) \
+        .config("spark.scheduler.mode", "FAIR") \
         .getOrCreate()
     return spark
 
 
-def process_song_data(spark, input_data, output_data):
+def ms_to_timestamp(column):
+    """Converts epoch milliseconds to a timestamp with a native cast, keeping
+    the milliseconds and avoiding a Python UDF round trip per row."""
+    return (col(column) / 1000).cast(TimestampType())
+
+
+def build_time_table(df):
+    """Builds the time table from the distinct start_time values of df in a
+    single projection: hour, day, ISO week, month, year and weekday. As in
+    the Postgres and Redshift schemas, weekday is an int counting from
+    Monday = 0; Spark's dayofweek counts from Sunday = 1."""
+    return df.select("start_time").dropDuplicates() \
+             .select("start_time",
+                     hour("start_time").alias("hour"),
+                     dayofmonth("start_time").alias("day"),
+                     weekofyear("start_time").alias("week"),
+                     month("start_time").alias("month"),
+                     year("start_time").alias("year"),
+                     ((dayofweek("start_time") + 5) % 7).alias("weekday"))
+
+
+def read_song_dim(spark, output_data):
+    """Builds the songplays lookup (song_id, artist_id, title, artist_name,
+    duration) from the songs and artists tables already written."""
+    songs = read_table(spark, os.path.join(output_data, "songtable"))
+    artists = read_table(spark, os.path.join(output_data, "artists_table"))
+    return songs.join(artists.select("artist_id", col("name").alias("artist_name")),
+                      "artist_id") \
+                .select("song_id", "artist_id", "title", "artist_name", "duration") \
+                .dropDuplicates(["title", "artist_name", "duration"])
+
+
+def select_input(spark, pattern, output_data, name, incremental):
+    """Returns the input paths to read and the files to record in the
+    manifest afterwards. Full runs read every file and replace the
+    manifest with them; incremental runs read only the files that are not
+    in the dataset's manifest. Both fetch checksums only for the files
+    whose size or mtime differ from the manifest, and full runs that can
+    read the compacted copy, checked against this listing, fetch none."""
+    manifest = read_manifest(spark, manifest_path(output_data, name))
+    checksums = incremental or not input_compactor.compacted(spark, pattern, name)
+    with recorder.stage("list " + name):
+        files = list_input_files(spark, pattern, manifest, input_compactor.threads,
+                                 checksums)
+    if not incremental:
+        return pattern, files
+
+    files = pending_files(files, manifest)
+    print("{} new or changed files in {}".format(len(files), name))
+    return [f[0] for f in files], files
+
+
+def read_input(spark, paths, files, schema, name, incremental=False):
+    """Reads the json input files with the schema. Full runs read the
+    compacted copy of the input when --compact-input wrote one for these
+    paths; otherwise the files are read through the staging cache when one
+    is configured."""
+    if not incremental and input_compactor.enabled:
+        df = input_compactor.read(spark, paths, name, schema, files)
+        if df is not None:
+            print("reading the compacted copy of {}".format(name))
+            return df
+    if not staging_cache.enabled:
+        return spark.read.json(paths, schema)
+    return staging_cache.read_json(spark, files, schema, name)
+
+
+def process_song_data(spark, input_data, output_data, incremental=False):
     
     """Imports the song data. Generates the song table and saves it to parquet files. \
-        Generates the artists table and saves it to parquest files."""
+        Generates the artists table and saves it to parquest files.
+        With incremental, only song files not yet in the manifest are read.
+        Returns the cached songplays lookup keyed on (title, artist_name,
+        duration) for process_log_data, or None for incremental runs, whose
+        input holds only the new songs."""
     
     # get filepath to song data file
-    song_data = input_data + "song_data/*/*/*/*.json"
-    
-    #define song_data schema
-    song_data_schema = StructType([
-        StructField('num_songs', IntegerType(), True),
-        StructField('artist_id', StringType(), True),
-        StructField('artist_latitude', FloatType(), True),
-        StructField('artist_longitude', FloatType(), True),
-        StructField('artist_location', StringType(), True),
-        StructField('artist_name', StringType(), True),
-        StructField('song_id', StringType(), True),
-        StructField('title', StringType(), True),
-        StructField('duration', FloatType(), True),
-        StructField('year', IntegerType(), True)
-    ])
-    
+    song_data = input_data + SONG_DATA
+    song_data, new_files = select_input(spark, song_data, output_data,
+                                        "song_data", incremental)
+    if not song_data:
+        return
     
     # read song data file
-    df = spark.read.json(song_data, song_data_schema)
+    df = read_input(spark, song_data, new_files, song_data_schema, "song_data", incremental)
     
     # create a view of the sond_data
     df.createOrReplaceTempView("df_song_data")
@@ -58,9 +238,8 @@ def process_song_data(spark, input_data, output_data):
                                              year, duration FROM df_song_data")
     
       
-    # write songs table to parquet files partitioned by year and artist
-    songs_table.write.partitionBy("year", "artist_id")\
-                .mode('overwrite').parquet(os.path.join(output_data, "songtable"))
+    # write songs table to parquet files partitioned by year
+    write_table(spark, songs_table, output_data, "songtable", ROWS_PER_FILE, incremental)
     
     
 
@@ -75,112 +254,281 @@ def process_song_data(spark, input_data, output_data):
     
     
     # write artists table to parquet files
-    artists_table.write.mode('overwrite')\
-                 .parquet(os.path.join(output_data, "artists_table"))
-    
+    write_table(spark, artists_table, output_data, "artists_table", ROWS_PER_FILE, incremental)
 
-def process_log_data(spark, input_data, output_data):
-    
-    """Imports the log data. Generates user table, time table, and songplay table and
-        saves them to parquest files."""
+    record_files(spark, manifest_path(output_data, "song_data"), new_files,
+                 overwrite=not incremental)
+
+    if incremental:
+        return None
+
+    # keep the songplays lookup in memory for process_log_data
+    song_dim = spark.sql("SELECT song_id, artist_id, title, artist_name, duration \
+                          FROM df_song_data") \
+                    .dropDuplicates(["title", "artist_name", "duration"])
+    return song_dim.cache()
     
+
+def read_log_events(spark, input_data, output_data, incremental=False):
+    """Reads the NextSong events of the log data, cached, as the view
+    df_log_data. Returns the events and the files to record in the log
+    manifest, or (None, []) when an incremental run has no new files."""
+
     # get filepath to log data file
-    log_data = input_data + "log_data/*/*/*.json"
-
-    # define log_data_schema
-    log_data_schema = StructType([
-        StructField('artist', StringType(), True),
-        StructField('auth', StringType(), True),
-        StructField('firstName', StringType(), True),
-        StructField('gender', StringType(), True),
-        StructField('itemInSession', IntegerType(), True),
-        StructField('lastName', StringType(), True),
-        StructField('length', FloatType(), True),
-        StructField('level', StringType(), True),
-        StructField('location', StringType(), True),
-        StructField('method', StringType(), True),
-        StructField('page', StringType(), True),
-        StructField('registration', FloatType(), True),
-        StructField('sessionId', IntegerType(), True),
-        StructField('song', StringType(), True),
-        StructField('status', StringType(), True),
-        StructField('ts', LongType(), True),
-        StructField('userAgent', StringType(), True),
-        StructField('user_id', IntegerType(), True)
-    ])    
-    
-    
+    log_data = input_data + LOG_DATA
+    log_data, new_files = select_input(spark, log_data, output_data,
+                                       "log_data", incremental)
+    if not log_data:
+        return None, []
+
     # read log data file
-    df = spark.read.json(log_data, log_data_schema)
+    df = read_input(spark, log_data, new_files, log_data_schema, "log_data", incremental)
     
     
-    # filter by actions for song plays
-    df = df.filter(df.page == "NextSong")
+    # filter by actions for song plays, and create timestamp column from
+    # original timestamp column. The result is cached so the users, time and
+    # songplays tables are built from a single scan of the log files.
+    df = df.filter(df.page == "NextSong") \
+           .withColumn("start_time", ms_to_timestamp('ts')) \
+           .cache()
 
     #create a spark sql view of the log data
     df.createOrReplaceTempView("df_log_data")
+    return df, new_files
+
+
+def write_log_dimensions(spark, df, output_data, incremental=False):
+    """Generates the users and time tables from the log events and saves
+    them to parquet files."""
     
     # extract columns for users table    
     users_table = spark.sql("SELECT DISTINCT user_id, firstName, lastName, \
                                              gender, level FROM df_log_data")
     
     # write users table to parquet files
-    users_table.write.mode('overwrite').parquet(os.path.join(output_data, "users_table"))
-    
-    # create timestamp column from original timestamp column
-    get_timestamp = udf(lambda ts: datetime.fromtimestamp(ts/1000.0), TimestampType())
-    df = df.withColumn("start_time", get_timestamp('ts'))
-
-    # set df_log_data table to new newly modified version
-    df.createOrReplaceTempView("df_log_data")
+    write_table(spark, users_table, output_data, "users_table", ROWS_PER_FILE, incremental)
     
     # extract columns to create time table using pyspark sql functions
-    time_table = spark.sql("SELECT DISTINCT start_time FROM df_log_data")
-    time_table = time_table.withColumn("hour", hour("start_time")) \
-                           .withColumn("day", dayofmonth("start_time")) \
-                           .withColumn("week", weekofyear("start_time")) \
-                           .withColumn("month", month("start_time")) \
-                           .withColumn("year", year("start_time")) \
-                           .withColumn("weekday", date_format('start_time','E'))
+    time_table = build_time_table(df)
     
     
     # write time table to parquet files partitioned by year and month
-    time_table.write.partitionBy("year", "month")\
-              .mode('overwrite').parquet(os.path.join(output_data, "timetable"))
-    
-    # read in song data to use for songplays table
-    song_df = spark.read.parquet(os.path.join(output_data, "songtable"))
-    song_df.createOrReplaceTempView("songs_table")
+    write_table(spark, time_table, output_data, "timetable", ROWS_PER_FILE, incremental)
+
+
+def write_songplays(spark, output_data, incremental=False, song_dim=None):
+    """Generates the songplays table from the df_log_data view and the song
+    lookup and saves it to parquet files. Without song_dim the lookup is
+    read back from the songs and artists tables."""
     
-    artist_df = spark.read.parquet(os.path.join(output_data, "artists_table"))
-    artist_df.createOrReplaceTempView("artists_table")
+    # song data to use for songplays table, one row per (title, artist, duration)
+    if song_dim is None:
+        song_dim = read_song_dim(spark, output_data)
+    events = spark.table("df_log_data")
+    salt = ""
+    if song_dim.count() <= BROADCAST_MAX_ROWS:
+        hint = "/*+ BROADCAST(song_dim) */"
+    else:
+        # a shuffled join puts every play of a song in one task; without
+        # adaptive skew join splitting, the hot songs are salted
+        hint = ""
+        events, song_dim = job_profile.salt_join(events, song_dim,
+                                                 ["song", "artist", "length"],
+                                                 ["title", "artist_name", "duration"],
+                                                 ["sessionId", "itemInSession", "ts"])
+        if job_profile.salted:
+            salt = "AND log_events.{0} = song_dim.{0}".format(SALT)
+    events.createOrReplaceTempView("log_events")
+    song_dim.createOrReplaceTempView("song_dim")
     
     # extract columns from joined song and log datasets to create songplays table 
-    songplays_table = spark.sql("SELECT ts, user_id, level, songs_table.song_id, \
-                                songs_table.artist_id, sessionid, df_log_data.location, userAgent\
-                                FROM df_log_data \
-                                JOIN songs_table \
-                                ON df_log_data.song = songs_table.title\
-                                JOIN artists_table \
-                                ON df_log_data.artist = artists_table.name")
+    songplays_table = spark.sql("SELECT {} start_time, user_id, level, song_dim.song_id, \
+                                song_dim.artist_id, sessionid, log_events.location, userAgent\
+                                FROM log_events \
+                                JOIN song_dim \
+                                ON log_events.song = song_dim.title \
+                                AND log_events.artist = song_dim.artist_name \
+                                AND log_events.length = song_dim.duration {}".format(hint, salt))
                                 
-    songplays_table = songplays_table.withColumn("start_time", get_timestamp('ts'))
     songplays_table = songplays_table.withColumn("month", month("start_time")) \
                                      .withColumn("year", year("start_time"))
-    
-    # drop ts column
-    songplays_table.drop("ts")
     # write songplays table to parquet files partitioned by year and month
-    songplays_table.write.partitionBy("year", "month").mode('overwrite')\
-                         .parquet(os.path.join(output_data, "songplays_table"))
+    write_table(spark, songplays_table, output_data, "songplays_table", ROWS_PER_FILE, incremental)
+
+
+def finish_log_data(spark, df, output_data, new_files, incremental=False):
+    """Records the log files in the manifest once every table built from
+    them is written, and releases the cached events. Returns the number
+    of NextSong events read."""
+    record_files(spark, manifest_path(output_data, "log_data"), new_files,
+                 overwrite=not incremental)
+    next_song_events = df.count()
+    df.unpersist()
+    return next_song_events
+
+
+def process_log_data(spark, input_data, output_data, incremental=False, song_dim=None):
+    
+    """Imports the log data. Generates user table, time table, and songplay table and
+        saves them to parquest files.
+        With incremental, only log files not yet in the manifest are read.
+        song_dim is the lookup returned by process_song_data; without it the
+        lookup is read back from the songs and artists tables.
+        Returns the number of NextSong events read."""
+    df, new_files = read_log_events(spark, input_data, output_data, incremental)
+    if df is None:
+        return
+    write_log_dimensions(spark, df, output_data, incremental)
+    write_songplays(spark, output_data, incremental, song_dim)
+    return finish_log_data(spark, df, output_data, new_files, incremental)
+
+
+def load_stages(spark, input_data, output_data, incremental=False):
+    """Returns the scheduler Stages of a run. The song tables and the users
+    and time tables do not depend on each other and run concurrently as
+    separate Spark jobs; songplays needs both. After a resume, songplays
+    reads the log events and the song lookup again."""
+    state = {}
+
+    def song_data():
+        state["song_dim"] = process_song_data(spark, input_data, output_data, incremental)
+
+    def log_data():
+        state["log"] = read_log_events(spark, input_data, output_data, incremental)
+        if state["log"][0] is not None:
+            write_log_dimensions(spark, state["log"][0], output_data, incremental)
+
+    def songplays():
+        if "log" not in state:
+            state["log"] = read_log_events(spark, input_data, output_data, incremental)
+        df, new_files = state["log"]
+        if df is not None:
+            write_songplays(spark, output_data, incremental, state.get("song_dim"))
+            state["events"] = finish_log_data(spark, df, output_data, new_files,
+                                              incremental)
+
+    stages = [Stage("song_data", song_data, []),
+              Stage("log_data", log_data, []),
+              Stage("songplays", songplays, ["song_data", "log_data"])]
+    return stages, state
+
+
+def check_quality(spark, output_data, next_song_events=None):
+    """Runs the data quality checks on the written tables and returns the
+    ones that failed. The songplays match rate is only checked when the
+    NextSong events of the whole table are known, i.e. after a full run."""
+    results = quality.run_checks(spark, output_data,
+                                 quality.default_checks(MAX_NULL_RATIO, MIN_MATCH_RATE),
+                                 next_song_events)
+    failed = [check for check, _, passed in results if not passed]
+    print("{} of {} data quality checks failed.".format(len(failed), len(results)))
+    return failed
+
+
+def input_size(spark, output_data):
+    """Returns the bytes of input recorded in the manifests of the last
+    run, or else in the listing of the last --compact-input, or None when
+    there is neither. The job profile is sized from these so the whole
+    input is not listed again for it."""
+    total = 0
+    for name in ("song_data", "log_data"):
+        manifest = read_manifest(spark, manifest_path(output_data, name))
+        if manifest:
+            total += sum(size for size, _, _ in manifest.values())
+        elif input_compactor.enabled:
+            total += sum(f[1] for f in input_compactor.listing(spark, name))
+    return total or None
+
+
+def compact_input(spark, input_data):
+    """Lists the song and log data and writes the compacted copies that
+    the next full runs read."""
+    if not input_compactor.enabled:
+        raise SystemExit("--compact-input needs [COMPACTION] DIR in dl.cfg "
+                         "or --compaction-dir")
+    for name, pattern, schema in (("song_data", SONG_DATA, song_data_schema),
+                                  ("log_data", LOG_DATA, log_data_schema)):
+        input_compactor.compact(spark, input_data + pattern, name, schema)
+
 
 def main():
+    parser = argparse.ArgumentParser(description='Build the Sparkify data lake tables.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only process input files not yet in the manifests')
+    parser.add_argument('--compact', nargs='+', choices=sorted(TABLES), metavar='TABLE',
+                        help='merge the small files of these tables instead of running the ETL')
+    parser.add_argument('--metrics', metavar='PATH', default=METRICS_FILE,
+                        help='append action and stage timings to a JSON-lines file, '
+                        'or write a Prometheus .prom file')
+    parser.add_argument('--input', default="s3a://udacity-dend/",
+                        help='location of song_data/ and log_data/')
+    parser.add_argument('--output', default="s3a://jph-bucket-2/",
+                        help='location the tables are written to')
+    parser.add_argument('--parallel-stages', action='store_true',
+                        help='build the song tables and the users and time tables '
+                        'concurrently, then songplays')
+    parser.add_argument('--resume', action='store_true',
+                        help='with --parallel-stages, skip the stages that finished '
+                        'in the last failed run')
+    parser.add_argument('--skip-checks', action='store_true',
+                        help='do not run the data quality checks after the load')
+    parser.add_argument('--cache-dir', default=staging_cache.directory,
+                        help='keep parquet copies of the parsed input files here')
+    parser.add_argument('--compact-input', action='store_true',
+                        help='pack the small input files into a compacted parquet copy '
+                        'before the ETL, which later full runs read')
+    parser.add_argument('--compaction-dir', default=input_compactor.directory,
+                        help='location of the compacted copy of the input')
+    parser.add_argument('--profile', choices=PROFILES, default=job_profile.name,
+                        help='shuffle and skew handling of the joins')
+    parser.add_argument('--summary', action='store_true', default=recorder.summarize,
+                        help='print the plan and per-stage metrics of every write '
+                        'after the run')
+    args = parser.parse_args()
+
     spark = create_spark_session()
-    input_data = "s3a://udacity-dend/"
-    output_data = "s3a://jph-bucket-2/"
-    
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    input_data = args.input
+    output_data = args.output
+    staging_cache.configure(args.cache_dir, staging_cache.max_bytes, staging_cache.target_bytes)
+    input_compactor.directory = args.compaction_dir
+    job_profile.name = args.profile
+    recorder.summarize = args.summary
+
+    try:
+        if args.compact:
+            for name in args.compact:
+                compact_table(spark, output_data, name, ROWS_PER_FILE)
+            return
+
+        if args.compact_input:
+            with recorder.stage("compact_input"):
+                compact_input(spark, input_data)
+
+        job_profile.apply(spark, input_size(spark, output_data))
+
+        if args.parallel_stages:
+            stages, state = load_stages(spark, input_data, output_data, args.incremental)
+            Scheduler(stages, STAGE_WORKERS, STATE_FILE, recorder).run(args.resume)
+            events = state.get("events")
+        else:
+            with recorder.stage("process_song_data"):
+                song_dim = process_song_data(spark, input_data, output_data, args.incremental)
+            with recorder.stage("process_log_data"):
+                events = process_log_data(spark, input_data, output_data, args.incremental, song_dim)
+        if staging_cache.enabled:
+            # only now that every table is written can the run's packs go
+            with recorder.stage("evict_cache"):
+                staging_cache.evict(spark)
+        if QUALITY_ENABLED and not args.skip_checks:
+            with recorder.stage("quality_checks"):
+                failed = check_quality(spark, output_data, None if args.incremental else events)
+            if failed and QUALITY_STRICT:
+                raise SystemExit(1)
+    finally:
+        if args.metrics:
+            recorder.write(args.metrics)
+        if args.summary:
+            print(recorder.summary())
 
 
 if __name__ == "__main__":
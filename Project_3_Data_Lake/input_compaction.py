@@ -0,0 +1,150 @@
+import json
+import os
+import time
+import uuid
+from manifest import file_system, list_files_parallel
+from metrics import recorder
+
+# written in a dataset's directory once its compacted copy is complete
+MARKER_FILE = "_COMPACTED"
+LISTING_FILE = "_LISTING"
+
+
+def read_text(spark, path):
+    """Returns the contents of a small text file, or None if it does not
+    exist."""
+    fs, hadoop_path = file_system(spark, path)
+    if not fs.exists(hadoop_path):
+        return None
+    jvm = spark.sparkContext._jvm
+    reader = jvm.java.io.BufferedReader(jvm.java.io.InputStreamReader(fs.open(hadoop_path), "UTF-8"))
+    text = reader.readLine()
+    reader.close()
+    return text
+
+
+def write_text(spark, path, text):
+    """Replaces a small text file, writing it to a temporary file first."""
+    fs, hadoop_path = file_system(spark, path)
+    tmp = spark.sparkContext._jvm.org.apache.hadoop.fs.Path(path + ".tmp")
+    out = fs.create(tmp, True)
+    out.write(bytearray(text.encode("utf-8")))
+    out.close()
+    fs.delete(hadoop_path, False)
+    fs.rename(tmp, hadoop_path)
+
+
+class InputCompactor:
+    """Compacted columnar copies of the raw json input, one per dataset
+    under <directory>/<dataset>/.
+
+    compact lists the input once with list_files_parallel and keeps the
+    listing in _LISTING. It reads the files with Spark's small-file
+    packing tuned so that many tiny files share a split of about
+    target_bytes, and writes them as parquet files of about that size to
+    a new data-<id> directory. The _COMPACTED marker, written last,
+    names that directory and records the input pattern and the number,
+    total size and newest modification time of the files it covered.
+    Full runs of etl.py read the parquet copy instead of opening every
+    json file, as long as their own listing of the input still matches
+    the marker; incremental runs still read the new json files listed
+    against the manifests."""
+
+    def __init__(self, directory=None, target_bytes=128 << 20, open_cost_bytes=64 << 10,
+                 threads=16):
+        self.directory = directory
+        self.target_bytes = target_bytes
+        self.open_cost_bytes = open_cost_bytes
+        self.threads = threads
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def configure(self, directory, target_bytes, open_cost_bytes, threads):
+        self.directory = directory
+        self.target_bytes = target_bytes
+        self.open_cost_bytes = open_cost_bytes
+        self.threads = threads
+
+    def _path(self, dataset, *parts):
+        return os.path.join(self.directory, dataset, *parts)
+
+    def listing(self, spark, dataset):
+        """Returns the (path, size, mtime) files of the dataset's last
+        compaction, or [] if it was never compacted."""
+        cached = read_text(spark, self._path(dataset, LISTING_FILE))
+        return [tuple(f) for f in json.loads(cached)["files"]] if cached else []
+
+    def compact(self, spark, pattern, dataset, schema):
+        """Rewrites the json files matching pattern as a new parquet copy of
+        the dataset, then points the marker at it and deletes the older
+        copies. Returns the number of files compacted."""
+        with recorder.stage("list " + dataset):
+            files = list_files_parallel(spark, pattern, self.threads)
+        if not files:
+            return 0
+        write_text(spark, self._path(dataset, LISTING_FILE), json.dumps(
+            {"pattern": pattern, "listed_at": time.time(), "files": files}))
+        total_bytes = sum(f[1] for f in files)
+
+        conf = spark.conf
+        saved = {key: conf.get(key, None) for key in
+                 ("spark.sql.files.maxPartitionBytes", "spark.sql.files.openCostInBytes")}
+        # by default every file counts as 4MB, so a split holds few tiny files
+        conf.set("spark.sql.files.maxPartitionBytes", str(self.target_bytes))
+        conf.set("spark.sql.files.openCostInBytes", str(self.open_cost_bytes))
+        try:
+            num_files = max(1, -(-total_bytes // self.target_bytes))
+            df = spark.read.json([f[0] for f in files], schema).coalesce(num_files)
+            data = "data-{}".format(uuid.uuid4().hex)
+            with recorder.action(spark, "compact " + dataset, df):
+                df.write.parquet(self._path(dataset, data))
+        finally:
+            for key, value in saved.items():
+                if value is None:
+                    conf.unset(key)
+                else:
+                    conf.set(key, value)
+
+        # until the marker is replaced, readers keep using the old copy
+        write_text(spark, self._path(dataset, MARKER_FILE), json.dumps(
+            {"pattern": pattern, "data": data, "files": len(files), "bytes": total_bytes,
+             "newest_mtime": max(f[2] for f in files), "compacted_at": time.time()}))
+        fs, dataset_path = file_system(spark, self._path(dataset))
+        for status in fs.listStatus(dataset_path):
+            name = status.getPath().getName()
+            if status.isDirectory() and name.startswith("data-") and name != data:
+                fs.delete(status.getPath(), True)
+        print("compacted {} {} files ({} bytes) into {} parquet files".format(
+            len(files), dataset, total_bytes, num_files))
+        return len(files)
+
+    def compacted(self, spark, pattern, dataset):
+        """Returns whether the dataset has a compacted copy of pattern."""
+        if not self.enabled:
+            return False
+        marker = read_text(spark, self._path(dataset, MARKER_FILE))
+        return bool(marker) and json.loads(marker)["pattern"] == pattern
+
+    def read(self, spark, pattern, dataset, schema, files):
+        """Returns the dataset's parquet copy if one was compacted from
+        pattern and the listed (path, size, mtime, ...) files have the
+        count, total size and newest modification time recorded in the
+        marker, else None."""
+        marker = read_text(spark, self._path(dataset, MARKER_FILE))
+        if not marker:
+            return None
+        marker = json.loads(marker)
+        if marker["pattern"] != pattern:
+            return None
+        listed = (len(files), sum(f[1] for f in files), max(f[2] for f in files) if files else 0)
+        if listed != (marker["files"], marker["bytes"], marker.get("newest_mtime")):
+            print("the input of {} changed since it was compacted, reading the json "
+                  "files; run --compact-input again".format(dataset))
+            return None
+        return spark.read.schema(schema).parquet(self._path(dataset, marker["data"]))
+
+
+# compactor of the driver; etl.py configures it from dl.cfg
+input_compactor = InputCompactor()
@@ -0,0 +1,128 @@
+from pyspark.sql.functions import array, broadcast, col, explode, hash, lit, pmod, when
+
+# static leaves the shuffle settings of the session as they are, adaptive
+# turns on adaptive query execution with skew join splitting and falls back
+# to salting when the Spark version has no skew join, and salted always
+# salts the hot keys of the songplays join
+PROFILES = ['static', 'adaptive', 'salted']
+
+# column of the salt added to both sides of a salted join
+SALT = "_salt"
+
+
+def aqe_available(spark):
+    """Skew join splitting came with adaptive query execution in Spark 3.0."""
+    major = int(spark.version.split(".")[0])
+    return major >= 3
+
+
+class JobProfile:
+    """Shuffle and join settings of a run.
+
+    apply sizes spark.sql.shuffle.partitions from the input volume, one
+    partition per partition_bytes within [min_partitions, max_partitions],
+    when the volume is known.
+    With the adaptive profile on Spark 3, it also enables adaptive query
+    execution: shuffle partitions are coalesced to partition_bytes, and a
+    partition skew_factor times the median and above skew_threshold_bytes
+    is split across several tasks. Otherwise the join keys that hold at
+    least hot_key_share of the rows are salted into salt_buckets buckets
+    by salt_join. Only those keys are salted, so the rows of the other
+    keys are not copied."""
+
+    def __init__(self, name='adaptive', partition_bytes=64 << 20, min_partitions=8,
+                 max_partitions=2000, skew_factor=5, skew_threshold_bytes=256 << 20,
+                 salt_buckets=16, hot_key_share=0.01, max_hot_keys=100):
+        self.name = name
+        self.partition_bytes = partition_bytes
+        self.min_partitions = min_partitions
+        self.max_partitions = max_partitions
+        self.skew_factor = skew_factor
+        self.skew_threshold_bytes = skew_threshold_bytes
+        self.salt_buckets = salt_buckets
+        self.hot_key_share = hot_key_share
+        self.max_hot_keys = max_hot_keys
+        self.adaptive = False
+
+    @property
+    def salted(self):
+        """Whether salt_join salts the hot keys in this run."""
+        return self.name == 'salted' or (self.name == 'adaptive' and not self.adaptive)
+
+    def shuffle_partitions(self, total_bytes):
+        partitions = -(-total_bytes // self.partition_bytes)
+        return int(min(max(partitions, self.min_partitions), self.max_partitions))
+
+    def apply(self, spark, total_bytes=None):
+        """Sets the shuffle settings of the session for total_bytes of
+        input and returns the number of shuffle partitions. Without
+        total_bytes the session's number of shuffle partitions is kept."""
+        if self.name not in PROFILES:
+            raise ValueError("unknown job profile {!r}".format(self.name))
+        conf = spark.conf
+        if self.name == 'static':
+            return int(conf.get("spark.sql.shuffle.partitions"))
+
+        if total_bytes:
+            partitions = self.shuffle_partitions(total_bytes)
+            conf.set("spark.sql.shuffle.partitions", str(partitions))
+        else:
+            partitions = int(conf.get("spark.sql.shuffle.partitions"))
+        self.adaptive = self.name == 'adaptive' and aqe_available(spark)
+        if self.adaptive:
+            conf.set("spark.sql.adaptive.enabled", "true")
+            conf.set("spark.sql.adaptive.coalescePartitions.enabled", "true")
+            conf.set("spark.sql.adaptive.advisoryPartitionSizeInBytes", str(self.partition_bytes))
+            conf.set("spark.sql.adaptive.skewJoin.enabled", "true")
+            conf.set("spark.sql.adaptive.skewJoin.skewedPartitionFactor", str(self.skew_factor))
+            conf.set("spark.sql.adaptive.skewJoin.skewedPartitionThresholdInBytes",
+                     str(self.skew_threshold_bytes))
+        elif self.name == 'salted' or not aqe_available(spark):
+            conf.set("spark.sql.adaptive.enabled", "false")
+
+        print("job profile {}: {} bytes of input, {} shuffle partitions, {}".format(
+            self.name, total_bytes or "unknown", partitions,
+            "adaptive skew join" if self.adaptive else "salted hot keys"))
+        return partitions
+
+    def hot_keys(self, df, keys):
+        """Returns the rows of keys holding at least hot_key_share of the
+        rows of df, at most max_hot_keys of them."""
+        threshold = max(1, int(df.count() * self.hot_key_share))
+        return df.groupBy(*keys).count() \
+                 .filter(col("count") >= threshold) \
+                 .orderBy(col("count").desc()) \
+                 .limit(self.max_hot_keys) \
+                 .drop("count")
+
+    def salt_join(self, left, right, left_keys, right_keys, salt_columns):
+        """Adds the SALT column to both sides of a join of left and right
+        on left_keys = right_keys. The rows of the hot keys of left get a
+        salt in [0, salt_buckets) hashed from their salt_columns, and
+        their rows in right are copied once per salt; every other row gets
+        salt 0. Joining on the keys and SALT then spreads each hot key
+        over salt_buckets tasks. The salt is a function of the row, so a
+        retried task puts every row in the same partition as before.
+        Returns (left, right) unchanged unless the run is salted."""
+        if not self.salted:
+            return left, right
+
+        hot = broadcast(self.hot_keys(left, left_keys).withColumn("_hot", lit(True)))
+        print("salting {} hot join keys".format(hot.count()))
+        left = left.join(hot, left_keys, "left") \
+                   .withColumn(SALT, when(col("_hot"),
+                                          pmod(hash(*salt_columns), lit(self.salt_buckets)))
+                                     .otherwise(lit(0)).cast("int")) \
+                   .drop("_hot")
+        hot_right = hot.select(*[col(l).alias(r) for l, r in zip(left_keys, right_keys)],
+                               "_hot")
+        salts = array(*[lit(salt) for salt in range(self.salt_buckets)])
+        right = right.join(hot_right, right_keys, "left") \
+                     .withColumn(SALT, explode(when(col("_hot"), salts)
+                                               .otherwise(array(lit(0))))) \
+                     .drop("_hot")
+        return left, right
+
+
+# profile of the driver; etl.py configures it from dl.cfg
+job_profile = JobProfile()
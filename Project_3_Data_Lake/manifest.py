@@ -0,0 +1,162 @@
+import fnmatch
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pyspark.sql.types import StructType, StructField, StringType, LongType
+
+
+manifest_schema = StructType([
+    StructField('path', StringType(), False),
+    StructField('size', LongType(), False),
+    StructField('mtime', LongType(), False),
+    StructField('checksum', StringType(), True)
+])
+
+# characters that make a path component a glob, once its {a,b}
+# alternatives are expanded
+GLOB_CHARS = "*?["
+
+
+def file_system(spark, path):
+    """Returns the Hadoop FileSystem and Path objects for a path or glob."""
+    jvm = spark.sparkContext._jvm
+    hadoop_path = jvm.org.apache.hadoop.fs.Path(path)
+    conf = spark.sparkContext._jsc.hadoopConfiguration()
+    return hadoop_path.getFileSystem(conf), hadoop_path
+
+
+def expand_braces(pattern):
+    """Returns the patterns of the {a,b} alternatives of a Hadoop glob,
+    which fnmatch does not understand, expanding nested ones too."""
+    start = pattern.find("{")
+    if start < 0:
+        return [pattern]
+    depth = 0
+    alternatives = []
+    begin = start + 1
+    for i in range(start, len(pattern)):
+        if pattern[i] == "{":
+            depth += 1
+        elif pattern[i] == "}":
+            depth -= 1
+            if depth == 0:
+                alternatives.append(pattern[begin:i])
+                break
+        elif pattern[i] == "," and depth == 1:
+            alternatives.append(pattern[begin:i])
+            begin = i + 1
+    else:
+        raise ValueError("unbalanced braces in {}".format(pattern))
+
+    patterns = []
+    for alternative in alternatives:
+        patterns += expand_braces(pattern[:start] + alternative + pattern[i + 1:])
+    return patterns
+
+
+def list_files_parallel(spark, pattern, threads=16):
+    """Lists the files matching a glob as (path, size, mtime). The pattern
+    is expanded one directory level at a time, and the directories of a
+    level are listed concurrently on driver threads, so a prefix with
+    many directories costs a few rounds of listing calls instead of one
+    call per directory in turn. A pattern with {a,b} alternatives is
+    listed once per alternative."""
+    patterns = expand_braces(pattern)
+    if len(patterns) > 1:
+        files = {}
+        for alternative in patterns:
+            for f in list_files_parallel(spark, alternative, threads):
+                files.setdefault(f[0], f)
+        return sorted(files.values())
+
+    parts = pattern.rstrip("/").split("/")
+    first = next((i for i, part in enumerate(parts)
+                  if any(c in part for c in GLOB_CHARS)), len(parts) - 1)
+    fs, base = file_system(spark, "/".join(parts[:first]) or "/")
+
+    level = [base]
+    components = parts[first:]
+    with ThreadPoolExecutor(threads) as pool:
+        for depth, component in enumerate(components):
+            last = depth == len(components) - 1
+            listings = pool.map(lambda path: fs.listStatus(path) if fs.exists(path) else [],
+                                level)
+            statuses = [status for listing in listings for status in listing
+                        if fnmatch.fnmatchcase(status.getPath().getName(), component)
+                        and (status.isFile() if last else status.isDirectory())]
+            level = statuses if last else [status.getPath() for status in statuses]
+
+    return [(status.getPath().toString(), status.getLen(), status.getModificationTime())
+            for status in level]
+
+
+def list_input_files(spark, pattern, manifest=None, threads=16, checksums=True):
+    """Lists the files matching a glob as (path, size, mtime, checksum)
+    with list_files_parallel. The checksum is the file system's content
+    checksum when it provides one (for example the S3 etag), else None.
+    It is only fetched for files whose size or mtime differ from the
+    manifest; the others keep the checksum recorded there. Without
+    checksums it is not fetched at all and is None for those files."""
+    manifest = manifest or {}
+
+    def checksum(f):
+        recorded = manifest.get(f[0])
+        if recorded and recorded[:2] == f[1:]:
+            return recorded[2]
+        if not checksums:
+            return None
+        fs, path = file_system(spark, f[0])
+        value = fs.getFileChecksum(path)
+        return value.toString() if value else None
+
+    files = list_files_parallel(spark, pattern, threads)
+    with ThreadPoolExecutor(threads) as pool:
+        checksums = list(pool.map(checksum, files))
+    return [f + (value,) for f, value in zip(files, checksums)]
+
+
+def read_manifest(spark, manifest_path):
+    """Returns the files recorded in a manifest as a dict of path ->
+    (size, mtime, checksum). A manifest that does not exist is empty."""
+    fs, path = file_system(spark, manifest_path)
+    if not fs.exists(path):
+        return {}
+    rows = spark.read.schema(manifest_schema).json(manifest_path).collect()
+
+    # a changed file is recorded again, keep its latest entry
+    manifest = {}
+    for row in sorted(rows, key=lambda row: row.mtime):
+        manifest[row.path] = (row.size, row.mtime, row.checksum)
+    return manifest
+
+
+def pending_files(files, manifest):
+    """Returns the files that are not in the manifest or that changed
+    since they were recorded: their size differs, or their mtime does and
+    their checksum is unknown or differs."""
+    def changed(f):
+        recorded = manifest.get(f[0])
+        if recorded is None or recorded[0] != f[1]:
+            return True
+        if recorded[1] == f[2]:
+            return False
+        return f[3] is None or f[3] != recorded[2]
+
+    return [f for f in files if changed(f)]
+
+
+def record_files(spark, manifest_path, files, overwrite=False):
+    """Appends the files to the manifest, or with overwrite replaces the
+    manifest with them, as full runs do. Call it only after every output
+    built from them has been written: the data lake has no transactions,
+    so a run that fails before this point is simply processed again."""
+    if overwrite:
+        fs, path = file_system(spark, manifest_path)
+        fs.delete(path, True)
+    if files:
+        spark.createDataFrame(files, manifest_schema).coalesce(1)\
+             .write.mode('append').json(manifest_path)
+
+
+def manifest_path(output_data, name):
+    """Location of the manifest of one input dataset."""
+    return os.path.join(output_data, "_manifests", name)
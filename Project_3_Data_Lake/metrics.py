@@ -0,0 +1,163 @@
+import json
+import re
+import time
+import urllib.request
+from collections import Counter
+from contextlib import contextmanager
+import common.metrics
+
+# physical operators counted in the plan summary
+PLAN_OPERATORS = re.compile(r"\b(AdaptiveSparkPlan|BroadcastHashJoin|SortMergeJoin|"
+                            r"ShuffledHashJoin|BroadcastNestedLoopJoin|BroadcastExchange|"
+                            r"Exchange|Generate)\b")
+
+
+def explain_string(df, mode):
+    """Returns the plan df.explain(mode) would print: simple, extended,
+    codegen, cost or formatted."""
+    jvm = df.sql_ctx.sparkSession.sparkContext._jvm
+    return jvm.PythonSQLUtils.explainString(df._jdf.queryExecution(), mode)
+
+
+def plan_operators(plan):
+    """Counts the joins, exchanges and other PLAN_OPERATORS of a plan
+    string."""
+    return Counter(PLAN_OPERATORS.findall(plan))
+
+
+def fetch_json(url):
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.load(response)
+
+
+def completed_stages(spark, group):
+    """Yields the completed stage attempts of every job run under a job
+    group, from the Spark UI's REST API, with the API url of the stage.
+    Yields nothing when the UI is disabled."""
+    sc = spark.sparkContext
+    if not sc.uiWebUrl:
+        return
+
+    tracker = sc.statusTracker()
+    url = "{}/api/v1/applications/{}/stages/{{}}".format(sc.uiWebUrl, sc.applicationId)
+    for job_id in tracker.getJobIdsForGroup(group):
+        job = tracker.getJobInfo(job_id)
+        for stage_id in job.stageIds if job else []:
+            for attempt in fetch_json(url.format(stage_id)):
+                if attempt.get('status') == 'COMPLETE':
+                    yield url.format(stage_id), attempt
+
+
+def stage_metrics(spark, group):
+    """Sums the task metrics of the stages of every job run under a job
+    group. Returns None when the UI is disabled or does not answer."""
+    if not spark.sparkContext.uiWebUrl:
+        return None
+
+    totals = {'rows': 0, 'bytes': 0, 'shuffle_bytes': 0}
+    try:
+        for _, attempt in completed_stages(spark, group):
+            totals['rows'] += attempt.get('outputRecords', 0)
+            totals['bytes'] += attempt.get('inputBytes', 0)
+            totals['shuffle_bytes'] += attempt.get('shuffleReadBytes', 0)
+    except (OSError, ValueError):
+        return None
+    return totals
+
+
+def stage_details(spark, group):
+    """Returns, for every stage run under a job group, its tasks, bytes
+    read and written, and the median and slowest task run times. A
+    slowest task far above the median is a skewed partition. Returns []
+    when the UI is disabled or does not answer."""
+    details = []
+    try:
+        for url, attempt in completed_stages(spark, group):
+            quantiles = fetch_json("{}/{}/taskSummary?quantiles=0.5,1.0".format(
+                url, attempt.get('attemptId', 0)))
+            median_ms, max_ms = quantiles.get('executorRunTime', [0, 0])
+            details.append({'stage': attempt['stageId'], 'tasks': attempt.get('numTasks', 0),
+                            'bytes': attempt.get('inputBytes', 0),
+                            'shuffle_read': attempt.get('shuffleReadBytes', 0),
+                            'shuffle_write': attempt.get('shuffleWriteBytes', 0),
+                            'median_ms': median_ms, 'max_ms': max_ms})
+    except (OSError, ValueError):
+        return []
+    return sorted(details, key=lambda detail: detail['stage'])
+
+
+class Recorder(common.metrics.Recorder):
+    """Aggregates the wall time, rows written and bytes read of the Spark
+    actions and stages of a run by (kind, name).
+
+    Each action runs under its own job group, so its task metrics can be
+    summed from the Spark UI afterwards. With `explain` set to a
+    df.explain mode, the plan of each action's DataFrame is kept the
+    first time it runs. `write` appends the totals to a JSON-lines file,
+    or replaces a Prometheus text file when the path ends in .prom.
+
+    With `summarize` set, the joins and exchanges of the plan and the
+    task metrics of every Spark stage of each action's last run are kept
+    as well, and `summary` returns them as a report."""
+
+    COUNTERS = [('rows', 'Rows written by the action.'),
+                ('bytes', 'Input bytes read by the action.'),
+                ('shuffle_bytes', 'Shuffle bytes read by the action.')]
+    PLAN_KIND = 'action'
+
+    def __init__(self, pipeline='spark', explain=None):
+        super().__init__(pipeline, explain)
+        self.summarize = False
+        self.operators = {}
+        self.details = {}
+
+    @contextmanager
+    def action(self, spark, name, df=None):
+        """Times the Spark jobs run in the block under the job group
+        `name` and adds their rows written and bytes read."""
+        if self.explain and df is not None and name not in self.plans:
+            self.plans[name] = explain_string(df, self.explain)
+        if self.summarize and df is not None:
+            self.operators[name] = plan_operators(explain_string(df, 'simple'))
+
+        sc = spark.sparkContext
+        group = "{}-{}".format(name, time.time())
+        sc.setJobGroup(group, name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            sc.setLocalProperty("spark.jobGroup.id", None)
+            sc.setLocalProperty("spark.job.description", None)
+        seconds = time.perf_counter() - start
+
+        totals = stage_metrics(spark, group) or {}
+        self.add('action', name, seconds, totals.get('rows'),
+                 totals.get('bytes'), shuffle_bytes=totals.get('shuffle_bytes'))
+        if self.summarize:
+            self.details[name] = stage_details(spark, group)
+
+    def summary(self):
+        """Returns a report of every action: its time, rows and bytes, the
+        operators of its plan, and one line per Spark stage of its last
+        run with the median and slowest task times."""
+        lines = []
+        for record in self.records():
+            if record['kind'] != 'action':
+                continue
+            name = record['name']
+            lines.append('{name}: {seconds:.2f}s, {rows} rows, {bytes} bytes read, '
+                         '{shuffle_bytes} shuffle bytes'.format(**record))
+            operators = self.operators.get(name)
+            if operators:
+                lines.append('  plan: ' + ', '.join(
+                    '{} x{}'.format(op, n) for op, n in sorted(operators.items())))
+            for detail in self.details.get(name, []):
+                lines.append('  stage {stage}: {tasks} tasks, {bytes} bytes read, '
+                             '{shuffle_read} shuffle read, {shuffle_write} shuffle written, '
+                             'task median {median_ms:.0f}ms max {max_ms:.0f}ms'.format(**detail))
+        return '\n'.join(lines)
+
+
+# recorder of the driver; etl.py configures it from dl.cfg
+recorder = Recorder()
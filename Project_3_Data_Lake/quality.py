@@ -0,0 +1,89 @@
+import os
+from pyspark.sql import functions as F
+from writer import read_table
+from metrics import recorder
+from common.quality import Check, evaluate
+
+# dimension tables and their keys, which songplays refers to
+DIMENSIONS = {'users_table': 'user_id',
+              'songtable': 'song_id',
+              'artists_table': 'artist_id',
+              'timetable': 'start_time'}
+
+
+def ratio(condition):
+    """Share of the rows where condition holds, 0 for an empty table."""
+    return F.coalesce(F.avg(F.when(condition, 1.0).otherwise(0.0)), F.lit(0.0))
+
+
+def total(condition):
+    """Number of rows where condition holds."""
+    return F.coalesce(F.sum(F.when(condition, 1).otherwise(0)), F.lit(0))
+
+
+def dimension_metrics(df, key):
+    """Rows, duplicate keys and NULL key ratio of a dimension table, in one
+    aggregation."""
+    return df.agg(F.count(F.lit(1)).alias("rows"),
+                  (F.count(key) - F.countDistinct(key)).alias("duplicate_keys"),
+                  ratio(F.col(key).isNull()).alias("key_null_ratio"))
+
+
+def songplays_metrics(songplays, dimensions):
+    """Rows, NULL ratios, orphan keys and duplicate plays of songplays, in
+    one aggregation over songplays left joined with the distinct keys of
+    each dimension."""
+    df = songplays
+    for table, key in DIMENSIONS.items():
+        keys = dimensions[table].select(key).distinct() \
+                                .withColumn("_in_" + table, F.lit(True))
+        df = df.join(keys, key, "left")
+
+    orphans = [total(F.col(key).isNotNull() & F.col("_in_" + table).isNull())
+               .alias("orphan_" + key) for table, key in DIMENSIONS.items()]
+    return df.agg(F.count(F.lit(1)).alias("rows"),
+                  ratio(F.col("user_id").isNull()).alias("user_id_null_ratio"),
+                  ratio(F.col("level").isNull()).alias("level_null_ratio"),
+                  (F.count(F.lit(1)) - F.countDistinct("user_id", "sessionid", "start_time"))
+                  .alias("duplicate_plays"),
+                  *orphans)
+
+
+def default_checks(max_null_ratio=0.0, min_match_rate=0.0):
+    """Returns the checks run after a load: every table has rows, no key is
+    NULL, duplicated or orphaned, and the NULL ratios and the songplays
+    match rate are within the given limits."""
+    checks = [Check(table, "rows", ">", 0) for table in list(DIMENSIONS) + ["songplays_table"]]
+    checks += [Check(table, "duplicate_keys", "==", 0) for table in DIMENSIONS]
+    checks += [Check(table, "key_null_ratio", "<=", max_null_ratio) for table in DIMENSIONS]
+    checks += [Check("songplays_table", metric, "<=", max_null_ratio)
+               for metric in ("user_id_null_ratio", "level_null_ratio")]
+    checks += [Check("songplays_table", "orphan_" + key, "==", 0) for key in DIMENSIONS.values()]
+    checks += [Check("songplays_table", "duplicate_plays", "==", 0),
+               Check("songplays_table", "match_rate", ">=", min_match_rate)]
+    return checks
+
+
+def run_checks(spark, output_data, checks, next_song_events=None):
+    """Computes the metrics of each table of the checks with a single
+    aggregation, timed as a 'check <table>' action, and evaluates the
+    checks on them. The songplays match rate is its rows over
+    next_song_events, the NextSong events the run read; without them it
+    is not checked. Prints a report and returns (check, value, passed)
+    for every check."""
+    tables = {name: read_table(spark, os.path.join(output_data, name))
+              for name in list(DIMENSIONS) + ["songplays_table"]}
+
+    results = []
+    for table in dict.fromkeys(check.source for check in checks):
+        if table == "songplays_table":
+            df = songplays_metrics(tables[table], tables)
+        else:
+            df = dimension_metrics(tables[table], DIMENSIONS[table])
+        with recorder.action(spark, "check " + table, df):
+            metrics = df.first().asDict()
+        if table == "songplays_table" and next_song_events:
+            metrics["match_rate"] = metrics["rows"] / float(next_song_events)
+        print(table)
+        results += evaluate(checks, table, metrics)
+    return results
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from pyspark.sql.functions import broadcast, input_file_name, regexp_extract
+from pyspark.sql.types import StructType, StructField, StringType
+from manifest import file_system
+from input_compaction import read_text, write_text
+
+# column of the cached records holding the input file they were parsed from
+SOURCE_COLUMN = "_source"
+
+# pack a cached record was read from; a pack can also hold an older
+# version of the same input file
+PACK_COLUMN = "_pack"
+
+# index of a dataset's chunks, in its directory
+INDEX_FILE = "_INDEX"
+
+
+def schema_key(schema):
+    """Short digest of a schema, so records parsed with one schema are not
+    read back with another."""
+    return hashlib.sha1(schema.json().encode("utf-8")).hexdigest()[:8]
+
+
+def chunk_name(path, size, mtime, *_):
+    """Name of the cached records of one input file version, from its path,
+    size and modification time."""
+    return hashlib.sha1("{}|{}-{}".format(path, size, mtime).encode("utf-8")).hexdigest()
+
+
+class StagingCache:
+    """Parquet copies of the parsed json input files under
+    <directory>/<dataset>-<schema key>/.
+
+    Files that are not cached yet are read as json once, with the explicit
+    schema, and written together as one pack-<id> directory of parquet
+    files of about target_bytes, with the input file of every record in
+    SOURCE_COLUMN. The dataset's _INDEX maps each file version (its chunk)
+    to its pack and source, so later runs and backfills read a few large
+    packs with Spark's vectorized parquet reader, keeping the records of
+    the files they asked for, instead of parsing json again.
+
+    evict is called once at the end of a run. It deletes the least
+    recently used packs until the cache holds at most max_bytes, but never
+    one the run read, since the DataFrames of the run may still read it
+    lazily. Use is recorded by setting the pack's modification time where
+    the file system supports it, e.g. local and HDFS directories; on S3
+    packs are evicted oldest first."""
+
+    def __init__(self, directory=None, max_bytes=10 << 30, target_bytes=128 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.target_bytes = target_bytes
+        self.used = set()
+        # the song and log stages of --parallel-stages read concurrently;
+        # the index of each dataset is updated by one of them at a time
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.directory)
+
+    def configure(self, directory, max_bytes, target_bytes=128 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.target_bytes = target_bytes
+
+    def _path(self, spark, *parts):
+        return spark.sparkContext._jvm.org.apache.hadoop.fs.Path(
+            os.path.join(self.directory, *parts))
+
+    def _index(self, spark, dataset):
+        """Returns the dataset's index: {chunk: [pack, source]}."""
+        text = read_text(spark, os.path.join(self.directory, dataset, INDEX_FILE))
+        return json.loads(text) if text else {}
+
+    def _write_index(self, spark, dataset, index):
+        write_text(spark, os.path.join(self.directory, dataset, INDEX_FILE), json.dumps(index))
+
+    def _write_pack(self, spark, files, schema, dataset, index):
+        """Parses the files into a new pack and adds their chunks to index.
+        Files without records get no chunk."""
+        jvm = spark.sparkContext._jvm
+        chunks = {jvm.org.apache.hadoop.fs.Path(f[0]).toString(): chunk_name(*f)
+                  for f in files}
+        pack = "pack-{}".format(uuid.uuid4().hex)
+        pack_path = os.path.join(self.directory, dataset, pack)
+        num_files = max(1, -(-sum(f[1] for f in files) // self.target_bytes))
+        spark.read.json([f[0] for f in files], schema) \
+             .withColumn(SOURCE_COLUMN, input_file_name()) \
+             .coalesce(num_files) \
+             .write.parquet(pack_path)
+
+        # input_file_name gives a URI; the index keeps it as written, and
+        # matches it to the listing by its Hadoop path
+        sources = spark.read.parquet(pack_path).select(SOURCE_COLUMN).distinct().collect()
+        for (source,) in sources:
+            path = jvm.org.apache.hadoop.fs.Path(jvm.java.net.URI(source)).toString()
+            if path in chunks:
+                index[chunks[path]] = [pack, source]
+
+    def _touch(self, spark, dataset, packs):
+        fs, _ = file_system(spark, self.directory)
+        now = int(time.time() * 1000)
+        for pack in packs:
+            try:
+                fs.setTimes(self._path(spark, dataset, pack), now, -1)
+            except Exception:
+                # the file system does not keep modification times (S3)
+                return
+
+    def evict(self, spark, keep=None):
+        """Deletes the least recently used packs of every dataset until the
+        cache holds at most max_bytes, and drops their chunks from the
+        indexes. Packs in keep, by default every pack read since the last
+        evict, are not deleted."""
+        keep = self.used if keep is None else keep
+        fs, root = file_system(spark, self.directory)
+        if not fs.exists(root):
+            return
+
+        packs = {}
+        for dataset in fs.listStatus(root):
+            if not dataset.isDirectory() or dataset.getPath().getName().startswith("_"):
+                continue
+            for pack in fs.listStatus(dataset.getPath()):
+                if pack.isDirectory():
+                    packs[pack.getPath().toString()] = [pack.getModificationTime(), 0,
+                                                        dataset.getPath().getName(),
+                                                        pack.getPath()]
+
+        iterator = fs.listFiles(root, True)
+        while iterator.hasNext():
+            status = iterator.next()
+            pack = packs.get(status.getPath().getParent().toString())
+            if pack:
+                pack[1] += status.getLen()
+
+        total = sum(pack[1] for pack in packs.values())
+        deleted = {}
+        for mtime, size, dataset, path in sorted(packs.values(), key=lambda p: p[0]):
+            if total <= self.max_bytes:
+                break
+            if path.getName() in keep:
+                continue
+            deleted.setdefault(dataset, set()).add(path.getName())
+            total -= size
+
+        # the index stops naming a pack before it is deleted
+        for dataset, names in deleted.items():
+            index = self._index(spark, dataset)
+            self._write_index(spark, dataset, {chunk: entry for chunk, entry in index.items()
+                                               if entry[0] not in names})
+            for name in names:
+                fs.delete(self._path(spark, dataset, name), True)
+        self.used = set()
+
+    def read_json(self, spark, files, schema, dataset):
+        """Returns the records of the input files, as spark.read.json(paths,
+        schema) would, reading the cached packs where they hold them.
+        files are (path, size, mtime, ...) tuples of the input listing."""
+        dataset = "{}-{}".format(dataset, schema_key(schema))
+        names = {f[0]: chunk_name(*f) for f in files}
+        with self._lock:
+            lock = self._locks.setdefault(dataset, threading.Lock())
+        with lock:
+            index = self._index(spark, dataset)
+            missing = [f for f in files if names[f[0]] not in index]
+            if missing:
+                self._write_pack(spark, missing, schema, dataset, index)
+                self._write_index(spark, dataset, index)
+
+            entries = [index[name] for name in names.values() if name in index]
+            packs = sorted({pack for pack, _ in entries})
+            self._touch(spark, dataset, packs)
+        with self._lock:
+            self.used.update(packs)
+
+        df = None
+        if packs:
+            chunks = spark.createDataFrame(entries, [PACK_COLUMN, SOURCE_COLUMN])
+            cached_schema = StructType(schema.fields + [StructField(SOURCE_COLUMN, StringType())])
+            df = spark.read.schema(cached_schema) \
+                      .parquet(*[os.path.join(self.directory, dataset, pack) for pack in packs]) \
+                      .withColumn(PACK_COLUMN, regexp_extract(input_file_name(), r"/(pack-[0-9a-f]+)/", 1)) \
+                      .join(broadcast(chunks), [PACK_COLUMN, SOURCE_COLUMN], "left_semi") \
+                      .drop(PACK_COLUMN, SOURCE_COLUMN)
+        # files whose records could not be cached, e.g. empty files
+        uncached = [path for path, name in names.items() if name not in index]
+        if uncached:
+            raw = spark.read.json(uncached, schema)
+            df = raw if df is None else df.unionByName(raw)
+        return df if df is not None else spark.createDataFrame([], schema)
+
+
+# cache of the driver; etl.py configures it from dl.cfg
+staging_cache = StagingCache()
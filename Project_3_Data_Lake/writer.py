@@ -0,0 +1,169 @@
+import json
+import os
+import time
+from pyspark.sql.functions import broadcast
+from pyspark.sql.types import StructType
+from manifest import file_system
+from metrics import recorder
+
+
+# partition columns of every output table
+TABLES = {
+    "songtable": ["year"],
+    "artists_table": [],
+    "users_table": [],
+    "timetable": ["year", "month"],
+    "songplays_table": ["year", "month"],
+}
+
+# name of the snapshot manifest written in each table's directory
+SNAPSHOT_FILE = "_SNAPSHOT"
+
+
+def table_exists(spark, path):
+    fs, hadoop_path = file_system(spark, path)
+    return fs.exists(hadoop_path)
+
+
+def _write(spark, df, path, partition_by, rows_per_file):
+    """Adds the rows of df to the table as new files, leaving the existing
+    files alone until write_snapshot replaces them. Rows are grouped by
+    partition before the write so each partition is written by one task,
+    in files of at most rows_per_file rows."""
+    if partition_by:
+        df = df.repartition(*partition_by)
+    else:
+        df = df.repartition(max(1, -(-df.count() // rows_per_file)))
+
+    df.write.mode('append') \
+      .option("maxRecordsPerFile", rows_per_file) \
+      .partitionBy(*partition_by) \
+      .parquet(path)
+
+
+def _data_files(fs, hadoop_path):
+    """Returns {path: size} of the table's parquet files."""
+    files = {}
+    if not fs.exists(hadoop_path):
+        return files
+    iterator = fs.listFiles(hadoop_path, True)
+    while iterator.hasNext():
+        status = iterator.next()
+        name = status.getPath().getName()
+        if name.endswith(".parquet") and "/_temporary/" not in status.getPath().toString():
+            files[status.getPath().toString()] = status.getLen()
+    return files
+
+
+def _snapshot(spark, path):
+    """Returns the table's last _SNAPSHOT, or None. A reader that comes
+    between the delete and the rename of write_snapshot finds the new
+    manifest, complete, under its temporary name."""
+    jvm = spark.sparkContext._jvm
+    for name in (SNAPSHOT_FILE, SNAPSHOT_FILE + ".tmp", SNAPSHOT_FILE):
+        fs, hadoop_path = file_system(spark, os.path.join(path, name))
+        if not fs.exists(hadoop_path):
+            continue
+        stream = fs.open(hadoop_path)
+        reader = jvm.java.io.BufferedReader(jvm.java.io.InputStreamReader(stream, "UTF-8"))
+        try:
+            return json.loads(reader.readLine() or "null")
+        except ValueError:
+            # the manifest of a write that failed before it was closed
+            continue
+        finally:
+            reader.close()
+    return None
+
+
+def write_snapshot(spark, path, schema, partition_by, before):
+    """Commits a write: replaces the _SNAPSHOT manifest with the files the
+    write added, and for a partitioned table the files of the previous
+    snapshot in the partitions the write did not touch. Then deletes the
+    files of `before`, the table's files listed before the write, that the
+    new manifest does not list.
+
+    Writes only add files, under the new names Spark gives every job's
+    files, and the manifest is switched with a rename, so a read_table
+    running during a write reads the previous snapshot. Files of a failed
+    write are listed by no snapshot and deleted by the next one."""
+    fs, hadoop_path = file_system(spark, path)
+    added = {f: size for f, size in _data_files(fs, hadoop_path).items() if f not in before}
+    files = [{"path": f, "size": size} for f, size in added.items()]
+    if partition_by:
+        previous = _snapshot(spark, path)
+        if previous is None:
+            # first write, or a table written before snapshots existed
+            previous = [{"path": f, "size": size} for f, size in before.items()]
+        else:
+            previous = previous["files"]
+        touched = {f.rsplit("/", 1)[0] for f in added}
+        files += [f for f in previous if f["path"].rsplit("/", 1)[0] not in touched]
+
+    snapshot = {"committed_at": int(time.time() * 1000), "files": files,
+                "schema": schema.jsonValue()}
+    jvm = spark.sparkContext._jvm
+    tmp = jvm.org.apache.hadoop.fs.Path(os.path.join(path, SNAPSHOT_FILE + ".tmp"))
+    out = fs.create(tmp, True)
+    out.write(bytearray(json.dumps(snapshot).encode("utf-8")))
+    out.close()
+
+    target = jvm.org.apache.hadoop.fs.Path(os.path.join(path, SNAPSHOT_FILE))
+    fs.delete(target, False)
+    fs.rename(tmp, target)
+
+    listed = {f["path"] for f in files}
+    for f in before:
+        if f not in listed:
+            fs.delete(jvm.org.apache.hadoop.fs.Path(f), False)
+
+
+def read_table(spark, path):
+    """Reads a table as of its last _SNAPSHOT, or the whole directory for
+    tables written before snapshots existed."""
+    snapshot = _snapshot(spark, path)
+    if snapshot is None:
+        return spark.read.parquet(path)
+
+    files = [f["path"] for f in snapshot["files"]]
+    if not files:
+        # a write without rows leaves no parquet file to read the schema from
+        return spark.createDataFrame([], StructType.fromJson(snapshot["schema"]))
+    return spark.read.option("basePath", path).parquet(*files)
+
+
+def write_table(spark, df, output_data, name, rows_per_file, incremental=False):
+    """Writes an output table, replacing the partitions in df.
+
+    A full run replaces the partitions it produced. An incremental run
+    merges its rows with the existing rows of the partitions it touches,
+    or of the whole table if it is not partitioned, so that only those
+    partitions are rewritten. The new files replace the old ones when
+    write_snapshot commits the write."""
+    path = os.path.join(output_data, name)
+    partition_by = TABLES[name]
+    fs, hadoop_path = file_system(spark, path)
+    before = _data_files(fs, hadoop_path)
+
+    if incremental and table_exists(spark, path):
+        existing = read_table(spark, path)
+        if partition_by:
+            touched = df.select(*partition_by).distinct()
+            existing = existing.join(broadcast(touched), partition_by, "left_semi")
+        df = existing.unionByName(df).dropDuplicates()
+
+    with recorder.action(spark, "write " + name, df):
+        _write(spark, df, path, partition_by, rows_per_file)
+    write_snapshot(spark, path, df.schema, partition_by, before)
+
+
+def compact_table(spark, output_data, name, rows_per_file):
+    """Rewrites every partition of a table into files of up to
+    rows_per_file rows, merging the small files left by earlier runs."""
+    path = os.path.join(output_data, name)
+    fs, hadoop_path = file_system(spark, path)
+    before = _data_files(fs, hadoop_path)
+    df = read_table(spark, path)
+    with recorder.action(spark, "compact " + name, df):
+        _write(spark, df, path, TABLES[name], rows_per_file)
+    write_snapshot(spark, path, df.schema, TABLES[name], before)
@@ -0,0 +1,235 @@
+"""Generates a synthetic Sparkify dataset at a configurable scale.
+
+Writes, under the output directory:
+
+    data/song_data/A/B/C/TR*.json      song files, as read by every project
+    data/log_data/2018/11/*.json       json-lines log events, one file a day
+    event_data/2018-11-*-events.csv    the same events as the Cassandra csvs
+
+Song popularity and user activity follow Zipf distributions, so a few
+songs and users account for most plays. Sessions are runs of consecutive
+events of one user whose length is drawn around --session-length. Only
+--match-rate of the plays are of songs in song_data, like the sample
+data, where most plays have no matching song file.
+
+    python generate.py out/scale_10 --scale 10
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import random
+import string
+
+# 2018-11-01 00:00:00 UTC in epoch milliseconds
+START_TS = 1541030400000
+DAY_MS = 24 * 60 * 60 * 1000
+DAYS = 30
+
+# pages of the events that are not song plays, weighted as in the sample logs
+OTHER_PAGES = [('Home', 806), ('Login', 92), ('Logout', 90), ('Downgrade', 60),
+               ('Settings', 56), ('Help', 47), ('About', 36), ('Upgrade', 21),
+               ('Save Settings', 10), ('Error', 9), ('Submit Upgrade', 8),
+               ('Submit Downgrade', 1)]
+
+# share of NextSong events in the sample logs
+NEXT_SONG_RATE = 6820 / 8056
+
+LOG_FIELDS = ['artist', 'auth', 'firstName', 'gender', 'itemInSession', 'lastName',
+              'length', 'level', 'location', 'method', 'page', 'registration',
+              'sessionId', 'song', 'status', 'ts', 'userAgent', 'userId']
+
+# columns of the event_data csvs, which have no userAgent
+CSV_FIELDS = [field for field in LOG_FIELDS if field != 'userAgent']
+
+LOCATIONS = ['San Francisco-Oakland-Hayward, CA', 'Phoenix-Mesa-Scottsdale, AZ',
+             'New York-Newark-Jersey City, NY-NJ-PA', 'Atlanta-Sandy Springs-Roswell, GA',
+             'Chicago-Naperville-Elgin, IL-IN-WI', 'Lansing-East Lansing, MI']
+
+USER_AGENTS = ['"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.36 '
+               '(KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36"',
+               'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:31.0) Gecko/20100101 Firefox/31.0',
+               '"Mozilla/5.0 (iPhone; CPU iPhone OS 7_1_2 like Mac OS X) AppleWebKit/537.51.2 '
+               '(KHTML, like Gecko) Version/7.0 Mobile/11D257 Safari/9537.53"']
+
+
+def zipf_weights(n, skew):
+    """Cumulative weights of ranks 1..n with P(rank) proportional to
+    1 / rank ** skew, for random.choices(cum_weights=...)."""
+    return list(itertools.accumulate(1.0 / rank ** skew for rank in range(1, n + 1)))
+
+
+def random_id(rng, prefix, length=16):
+    return prefix + ''.join(rng.choice(string.ascii_uppercase + string.digits)
+                            for _ in range(length))
+
+
+def make_songs(num_songs, rng):
+    """Returns num_songs song records, about three per artist."""
+    artists = []
+    for i in range(max(num_songs // 3, 1)):
+        located = rng.random() < 0.4
+        artists.append({'artist_id': random_id(rng, 'AR'),
+                        'artist_latitude': round(rng.uniform(-60, 60), 5) if located else None,
+                        'artist_longitude': round(rng.uniform(-150, 150), 5) if located else None,
+                        'artist_location': rng.choice(LOCATIONS) if located else '',
+                        'artist_name': 'Artist {}'.format(i)})
+
+    songs = []
+    for i in range(num_songs):
+        song = {'num_songs': 1}
+        song.update(artists[i % len(artists)])
+        song.update({'song_id': random_id(rng, 'SO'),
+                     'title': 'Song {}'.format(i),
+                     'duration': round(rng.uniform(90, 480), 5),
+                     'year': rng.choice([0, 0, 1985, 1995, 2001, 2005, 2008])})
+        songs.append(song)
+    return songs
+
+
+def write_songs(path, songs, rng):
+    """Writes one json file per song under song_data/<A-Z>/<A-Z>/<A-Z>/,
+    named after a track id like the real dataset."""
+    for song in songs:
+        track_id = random_id(rng, 'TR')
+        directory = os.path.join(path, 'data', 'song_data', *track_id[2:5])
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, track_id + '.json'), 'w') as f:
+            json.dump(song, f)
+
+
+def make_users(num_users, rng):
+    users = []
+    for user_id in range(1, num_users + 1):
+        users.append({'userId': str(user_id),
+                      'firstName': 'First{}'.format(user_id),
+                      'lastName': 'Last{}'.format(user_id),
+                      'gender': rng.choice('MF'),
+                      'level': rng.choice(['free', 'paid', 'paid']),
+                      'location': rng.choice(LOCATIONS),
+                      'registration': float(START_TS - rng.randint(1, 365) * DAY_MS),
+                      'userAgent': rng.choice(USER_AGENTS)})
+    return users
+
+
+def generate_events(num_events, songs, users, rng, song_skew=1.1, user_skew=1.0,
+                    session_length=8.5, match_rate=0.5):
+    """Yields (day, event) for num_events events in sessions of one user,
+    spread over DAYS days in ts order within each day."""
+    song_weights = zipf_weights(len(songs), song_skew)
+    user_weights = zipf_weights(len(users), user_skew)
+    other_pages = [page for page, _ in OTHER_PAGES]
+    other_weights = list(itertools.accumulate(weight for _, weight in OTHER_PAGES))
+
+    per_day = -(-num_events // DAYS)
+    session_id = 0
+    emitted = 0
+    for day in range(DAYS):
+        day_events = []
+        while len(day_events) < per_day and emitted + len(day_events) < num_events:
+            session_id += 1
+            user = rng.choices(users, cum_weights=user_weights)[0]
+            # a free user upgrades now and then, so users change level
+            if user['level'] == 'free' and rng.random() < 0.02:
+                user['level'] = 'paid'
+            ts = START_TS + day * DAY_MS + rng.randint(0, DAY_MS - 1)
+            length = max(1, int(rng.expovariate(1.0 / session_length)))
+            for item in range(length):
+                if rng.random() < NEXT_SONG_RATE:
+                    song = rng.choices(songs, cum_weights=song_weights)[0]
+                    if rng.random() >= match_rate:
+                        # a play of a song that has no song file
+                        song = dict(song, title=song['title'] + ' (Live)')
+                    page, artist, title, length_s = ('NextSong', song['artist_name'],
+                                                     song['title'], song['duration'])
+                else:
+                    page = rng.choices(other_pages, cum_weights=other_weights)[0]
+                    artist = title = length_s = None
+
+                event = {'artist': artist, 'auth': 'Logged In',
+                         'firstName': user['firstName'], 'gender': user['gender'],
+                         'itemInSession': item, 'lastName': user['lastName'],
+                         'length': length_s, 'level': user['level'],
+                         'location': user['location'],
+                         'method': 'PUT' if page == 'NextSong' else 'GET', 'page': page,
+                         'registration': user['registration'], 'sessionId': session_id,
+                         'song': title, 'status': 200, 'ts': ts,
+                         'userAgent': user['userAgent'], 'userId': user['userId']}
+                day_events.append(event)
+                ts += int((length_s or 30) * 1000)
+                if len(day_events) >= per_day or emitted + len(day_events) >= num_events:
+                    break
+
+        day_events.sort(key=lambda event: event['ts'])
+        emitted += len(day_events)
+        for event in day_events:
+            yield day, event
+
+
+def write_events(path, events):
+    """Writes the events to one json-lines log file and one csv a day.
+    Returns the number of events written."""
+    log_dir = os.path.join(path, 'data', 'log_data', '2018', '11')
+    csv_dir = os.path.join(path, 'event_data')
+    os.makedirs(log_dir, exist_ok=True)
+    os.makedirs(csv_dir, exist_ok=True)
+
+    count = 0
+    for day, day_events in itertools.groupby(events, key=lambda item: item[0]):
+        name = '2018-11-{:02d}-events'.format(day + 1)
+        with open(os.path.join(log_dir, name + '.json'), 'w', encoding='utf8') as log_file, \
+                open(os.path.join(csv_dir, name + '.csv'), 'w', encoding='utf8',
+                     newline='') as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(CSV_FIELDS)
+            for _, event in day_events:
+                log_file.write(json.dumps(event, separators=(',', ':')) + '\n')
+                writer.writerow(['' if event[field] is None else event[field]
+                                 for field in CSV_FIELDS])
+                count += 1
+    return count
+
+
+def generate(path, scale=1, base_songs=1000, base_events=10000, base_users=100,
+             song_skew=1.1, user_skew=1.0, session_length=8.5, match_rate=0.5, seed=42):
+    """Writes a dataset of scale * base_songs songs and scale * base_events
+    events of scale * base_users users under path. Returns a dict of the
+    number of songs, events and users."""
+    rng = random.Random(seed)
+    songs = make_songs(scale * base_songs, rng)
+    write_songs(path, songs, rng)
+    users = make_users(scale * base_users, rng)
+    events = generate_events(scale * base_events, songs, users, rng, song_skew,
+                             user_skew, session_length, match_rate)
+    num_events = write_events(path, events)
+    return {'songs': len(songs), 'events': num_events, 'users': len(users)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic Sparkify dataset.')
+    parser.add_argument('output', help='directory to write data/ and event_data/ to')
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--songs', type=int, default=1000, help='songs at scale 1')
+    parser.add_argument('--events', type=int, default=10000, help='log events at scale 1')
+    parser.add_argument('--users', type=int, default=100, help='users at scale 1')
+    parser.add_argument('--song-skew', type=float, default=1.1,
+                        help='Zipf exponent of song popularity, 0 for uniform')
+    parser.add_argument('--user-skew', type=float, default=1.0,
+                        help='Zipf exponent of user activity, 0 for uniform')
+    parser.add_argument('--session-length', type=float, default=8.5,
+                        help='mean events per session')
+    parser.add_argument('--match-rate', type=float, default=0.5,
+                        help='share of song plays whose song is in song_data')
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    counts = generate(args.output, args.scale, args.songs, args.events, args.users,
+                      args.song_skew, args.user_skew, args.session_length,
+                      args.match_rate, args.seed)
+    print('{songs} songs, {events} events of {users} users written to {path}'
+          .format(path=args.output, **counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Measures the peak memory of reading one large log file in Project_1.
+
+A single json-lines log file is generated for every event count, and each
+mode loads it in its own process with etl.process_log_file:
+
+    whole    pd.read_json of the whole file, as without --chunk-size
+    chunked  readers.iter_log_chunks with --chunk-size lines
+
+The statements insert_log_frame runs go to a cursor that only counts
+them, so no database is needed, but every row is built by the same code
+as a real load. The peak RSS of the whole-file mode grows with the file,
+while that of the chunked mode stays flat:
+
+    python log_memory.py --events 100000 400000 1600000 --chunk-size 10000
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import generate
+from run import run_process
+
+POSTGRES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                            'Project_1_DataModeling_Postgres')
+
+MODES = ['whole', 'chunked']
+
+
+def write_log_file(path, num_events, seed=42):
+    """Writes num_events synthetic events to one json-lines file and
+    returns its size in bytes."""
+    rng = random.Random(seed)
+    songs = generate.make_songs(1000, rng)
+    users = generate.make_users(100, rng)
+    with open(path, 'w', encoding='utf8') as f:
+        for _, event in generate.generate_events(num_events, songs, users, rng):
+            f.write(json.dumps(event, separators=(',', ':')) + '\n')
+    return os.path.getsize(path)
+
+
+class CountingCursor:
+    """Stands in for a database cursor: counts the statements it is given
+    and finds no song for a song_select."""
+
+    def __init__(self):
+        self.statements = 0
+
+    def execute(self, query, vars=None):
+        self.statements += 1
+
+    def fetchone(self):
+        return None
+
+
+def read_log_file(path, mode, chunk_size):
+    """Child process: loads the file in the given mode with
+    etl.process_log_file against a CountingCursor."""
+    sys.path.insert(0, POSTGRES_DIR)
+    import etl
+
+    cur = CountingCursor()
+    etl.process_log_file(cur, path, chunksize=chunk_size if mode == 'chunked' else None)
+    return cur.statements
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the peak memory of '
+                                     'whole-file and chunked log reading.')
+    parser.add_argument('--events', type=int, nargs='+', default=[100000, 400000])
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='lines per chunk of the chunked mode')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--results', default='results.jsonl',
+                        help='JSON-lines file the results are appended to')
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'PATH'),
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        read_log_file(args.child[1], args.child[0], args.chunk_size)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='sparkify_log_memory_')
+    print('{:>10} {:>9} {:>8} {:>10} {:>10}'.format(
+        'events', 'file MB', 'mode', 'seconds', 'peak MB'))
+    try:
+        for num_events in args.events:
+            path = os.path.join(workdir, 'events-{}.json'.format(num_events))
+            size = write_log_file(path, num_events)
+
+            for mode in args.modes:
+                command = [sys.executable, os.path.abspath(__file__), '--child', mode,
+                           path, '--chunk-size', str(args.chunk_size)]
+                seconds, peak_rss = run_process(command, POSTGRES_DIR)
+                result = {'benchmark': 'log_memory', 'events': num_events,
+                          'file_mb': size / 2.0 ** 20, 'mode': mode,
+                          'chunk_size': args.chunk_size if mode == 'chunked' else None,
+                          'seconds': seconds, 'peak_rss_mb': peak_rss, 'run': time.time()}
+                print('{events:>10} {file_mb:>9.1f} {mode:>8} {seconds:>9.1f}s '
+                      '{peak_rss_mb:>10.0f}'.format(**result))
+                with open(args.results, 'a', encoding='utf8') as f:
+                    f.write(json.dumps(result) + '\n')
+            os.remove(path)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""Runs the Sparkify pipelines on generated datasets of increasing scale.
+
+For every scale, a dataset is generated with generate.py and each selected
+pipeline is run on it as a subprocess:
+
+    postgres   Project_1 create_tables.py, then etl.py on data/ (local Postgres)
+    spark      Project_3 etl.py on data/ in Spark local mode
+    cassandra  Project_1 Cassandra event_stream.py --load on event_data/
+
+The wall time, input events per second and the peak resident set size of
+the pipeline process and the processes it waited for (the Spark JVM, the
+etl.py worker pool) are printed and appended to a JSON-lines results file.
+
+    python run.py --scales 1 10 100 --pipelines postgres spark
+"""
+import argparse
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+POSTGRES_DIR = os.path.join(ROOT, 'Project_1_DataModeling_Postgres')
+CASSANDRA_DIR = os.path.join(ROOT, 'Project_1_Data_Modeling_Cassandra')
+SPARK_DIR = os.path.join(ROOT, 'Project_3_Data_Lake')
+
+
+def run_process(command, cwd):
+    """Runs a command and returns its wall time in seconds and the peak RSS
+    in MB of it and its waited-for descendants. Raises CalledProcessError
+    if it fails."""
+    start = time.time()
+    process = subprocess.Popen(command, cwd=cwd)
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    # ru_maxrss is in kilobytes on Linux
+    return elapsed, usage.ru_maxrss / 1024.0
+
+
+def postgres_commands(dataset, args):
+    """Recreates sparkifydb, then loads dataset/data with etl.py."""
+    yield [sys.executable, 'create_tables.py'], POSTGRES_DIR, False
+    yield ([sys.executable, os.path.join(POSTGRES_DIR, 'etl.py')] +
+           shlex.split(args.postgres_args)), dataset, True
+
+
+def spark_commands(dataset, args):
+    output = os.path.join(dataset, 'lake')
+    shutil.rmtree(output, ignore_errors=True)
+    yield ([sys.executable, 'etl.py', '--input', 'file://{}/data/'.format(dataset),
+            '--output', 'file://{}/'.format(output)] + shlex.split(args.spark_args)), \
+        SPARK_DIR, True
+
+
+def cassandra_commands(dataset, args):
+    yield ([sys.executable, 'event_stream.py', os.path.join(dataset, 'event_data'),
+            '--load'] + shlex.split(args.cassandra_args)), CASSANDRA_DIR, True
+
+
+PIPELINES = {'postgres': postgres_commands,
+             'spark': spark_commands,
+             'cassandra': cassandra_commands}
+
+
+def run_pipeline(name, dataset, args):
+    """Runs the commands of a pipeline and returns the wall time and peak
+    RSS of its measured commands."""
+    seconds, peak_rss = 0.0, 0.0
+    for command, cwd, measured in PIPELINES[name](dataset, args):
+        elapsed, rss = run_process(command, cwd)
+        if measured:
+            seconds += elapsed
+            peak_rss = max(peak_rss, rss)
+    return seconds, peak_rss
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the Sparkify pipelines '
+                                     'on synthetic data.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--pipelines', nargs='+', choices=sorted(PIPELINES),
+                        default=sorted(PIPELINES))
+    parser.add_argument('--workdir', help='keep the generated datasets here '
+                        '(default: a temporary directory that is removed)')
+    parser.add_argument('--results', default='results.jsonl',
+                        help='JSON-lines file the results are appended to')
+    parser.add_argument('--postgres-args', default='',
+                        help='extra etl.py arguments, e.g. "--bulk"')
+    parser.add_argument('--spark-args', default='', help='extra etl.py arguments')
+    parser.add_argument('--cassandra-args', default='',
+                        help='extra event_stream.py arguments, e.g. "--concurrency 256"')
+    parser.add_argument('--songs', type=int, default=1000, help='songs at scale 1')
+    parser.add_argument('--events', type=int, default=10000, help='log events at scale 1')
+    parser.add_argument('--users', type=int, default=100, help='users at scale 1')
+    parser.add_argument('--song-skew', type=float, default=1.1)
+    parser.add_argument('--user-skew', type=float, default=1.0)
+    parser.add_argument('--session-length', type=float, default=8.5)
+    parser.add_argument('--match-rate', type=float, default=0.5)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='sparkify_bench_')
+    print('{:>6} {:>10} {:>10} {:>10} {:>12} {:>10}'.format(
+        'scale', 'pipeline', 'events', 'seconds', 'events/sec', 'peak MB'))
+    try:
+        for scale in args.scales:
+            dataset = os.path.abspath(os.path.join(workdir, 'scale_{}'.format(scale)))
+            if not os.path.isdir(dataset):
+                generate.generate(dataset, scale, args.songs, args.events, args.users,
+                                  args.song_skew, args.user_skew, args.session_length,
+                                  args.match_rate, args.seed)
+            events = scale * args.events
+
+            for name in args.pipelines:
+                seconds, peak_rss = run_pipeline(name, dataset, args)
+                result = {'scale': scale, 'pipeline': name, 'events': events,
+                          'songs': scale * args.songs, 'seconds': seconds,
+                          'events_per_sec': events / max(seconds, 1e-9),
+                          'peak_rss_mb': peak_rss, 'run': time.time()}
+                print('{scale:>6} {pipeline:>10} {events:>10} {seconds:>9.1f}s '
+                      '{events_per_sec:>12.0f} {peak_rss_mb:>10.0f}'.format(**result))
+                with open(args.results, 'a', encoding='utf8') as f:
+                    f.write(json.dumps(result) + '\n')
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
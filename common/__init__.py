@@ -0,0 +1,6 @@
+"""Code shared by the Sparkify projects.
+
+The entry points of each project put the repository root on sys.path
+before their first project import, so the modules of a project import
+these as common.<module> in any order.
+"""
@@ -0,0 +1,31 @@
+import threading
+from psycopg2.extensions import STATUS_READY, TRANSACTION_STATUS_IDLE
+from psycopg2.pool import ThreadedConnectionPool
+
+
+class Pool:
+    """ThreadedConnectionPool whose getconn waits for a free connection
+    instead of failing once `maxconn` connections are checked out."""
+
+    def __init__(self, maxconn, **params):
+        self._pool = ThreadedConnectionPool(1, maxconn, **params)
+        self._slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self):
+        self._slots.acquire()
+        try:
+            return self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn):
+        # a connection that is still in a transaction or broken is closed
+        # rather than handed to the next caller
+        close = bool(conn.closed) or conn.status != STATUS_READY or \
+            conn.info.transaction_status != TRANSACTION_STATUS_IDLE
+        self._pool.putconn(conn, close=close)
+        self._slots.release()
+
+    def closeall(self):
+        self._pool.closeall()
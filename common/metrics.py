@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# the fields of every metric, with their Prometheus help text; a project's
+# recorder adds its own counters after these
+TIMING_FIELDS = [('calls', 'Number of times the query, action or stage ran.'),
+                 ('seconds', 'Total wall time in seconds.'),
+                 ('max_seconds', 'Slowest single run in seconds.')]
+
+
+def query_names(module):
+    """Returns every SQL string of a sql_queries module keyed by its text,
+    so that a statement is reported under the name of its constant."""
+    return {value: name for name, value in vars(module).items()
+            if isinstance(value, str) and not name.startswith('_')}
+
+
+def query_name(query, names):
+    """Returns the constant of names a statement comes from, or its first
+    words for statements built elsewhere."""
+    if isinstance(query, bytes):
+        query = query.decode('utf8', 'replace')
+    if not isinstance(query, str):
+        query = str(query)
+    return names.get(query) or ' '.join(query.split()[:3])[:60]
+
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Recorder:
+    """Aggregates the wall time and the COUNTERS of the queries, actions
+    and stages of a run by (kind, name), from any number of threads.
+
+    Plans kept in `plans` by name are added to the records of PLAN_KIND.
+    `write` appends the totals to a JSON-lines file, or replaces a
+    Prometheus text file when the path ends in .prom. Each project
+    subclasses it with the way its statements or actions are measured."""
+
+    # counters summed into every metric, with their help text
+    COUNTERS = [('rows', 'Rows affected, returned or written.'),
+                ('bytes', 'Bytes read.')]
+    PLAN_KIND = 'query'
+
+    def __init__(self, pipeline, explain=None):
+        self.pipeline = pipeline
+        self.explain = explain
+        self.metrics = {}
+        self.plans = {}
+        self.started = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, kind, name, seconds, rows=None, bytes_read=None, calls=1, **counters):
+        """Adds a run of (kind, name). rows and bytes_read set the rows and
+        bytes counters, and the other COUNTERS are passed by name."""
+        counters.update(rows=rows, bytes=bytes_read)
+        with self._lock:
+            metric = self.metrics.get((kind, name))
+            if metric is None:
+                metric = {'kind': kind, 'name': name, 'calls': 0, 'seconds': 0.0,
+                          'max_seconds': 0.0}
+                metric.update((field, 0) for field, _ in self.COUNTERS)
+                self.metrics[(kind, name)] = metric
+            metric['calls'] += calls
+            metric['seconds'] += seconds
+            metric['max_seconds'] = max(metric['max_seconds'], seconds)
+            for field, _ in self.COUNTERS:
+                value = counters.get(field)
+                if value is not None and value > 0:
+                    metric[field] += value
+
+    @contextmanager
+    def measure(self, kind, name, bytes_read=None):
+        """Times the block; it can set 'rows' and 'bytes' on the yielded
+        dict."""
+        stats = {'rows': None, 'bytes': bytes_read}
+        start = time.perf_counter()
+        yield stats
+        self.add(kind, name, time.perf_counter() - start,
+                 stats['rows'], stats['bytes'])
+
+    def stage(self, name):
+        return self.measure('stage', name)
+
+    def records(self):
+        """Returns the metrics as a list of dicts, with their plans."""
+        with self._lock:
+            metrics = sorted(self.metrics.items())
+        records = []
+        for (kind, name), metric in metrics:
+            record = dict(metric)
+            if kind == self.PLAN_KIND and self.plans.get(name) is not None:
+                record['plan'] = self.plans[name]
+            records.append(record)
+        return records
+
+    def drain(self):
+        """Returns the records and clears them, keeping the set of
+        names already explained."""
+        records = self.records()
+        with self._lock:
+            self.metrics = {}
+            self.plans = dict.fromkeys(self.plans)
+        return records
+
+    def merge(self, records):
+        """Adds records returned by another process's `drain`."""
+        for record in records:
+            counters = {field: record[field] for field, _ in self.COUNTERS}
+            self.add(record['kind'], record['name'], 0.0, counters.pop('rows'),
+                     counters.pop('bytes'), record['calls'], **counters)
+            with self._lock:
+                metric = self.metrics[(record['kind'], record['name'])]
+                metric['seconds'] += record['seconds']
+                metric['max_seconds'] = max(metric['max_seconds'], record['max_seconds'])
+            if record.get('plan') is not None:
+                self.plans.setdefault(record['name'], record['plan'])
+
+    def instrument(self, conn):
+        """Makes every cursor of a psycopg2 connection record into this
+        recorder, with the cursor class of the subclass's
+        cursor_factory."""
+        conn.cursor_factory = self.cursor_factory()
+        return conn
+
+    def write(self, path):
+        if path.endswith('.prom'):
+            self.write_prometheus(path)
+        else:
+            self.write_jsonl(path)
+
+    def write_jsonl(self, path):
+        """Appends one line per metric, tagged with the run's start time."""
+        with open(path, 'a', encoding='utf8') as f:
+            for record in self.records():
+                record.update(pipeline=self.pipeline, run=self.started)
+                f.write(json.dumps(record, default=str) + '\n')
+
+    def write_prometheus(self, path):
+        """Replaces a node_exporter textfile with the run's gauges."""
+        records = self.records()
+        lines = []
+        for field, help_text in TIMING_FIELDS + self.COUNTERS:
+            metric = 'sparkify_etl_' + field
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} gauge'.format(metric))
+            for record in records:
+                lines.append('{}{{pipeline="{}",kind="{}",name="{}"}} {}'.format(
+                    metric, self.pipeline, record['kind'],
+                    escape_label(record['name']), record[field]))
+        lines.append('# HELP sparkify_etl_last_run_timestamp_seconds Start time of the run.')
+        lines.append('# TYPE sparkify_etl_last_run_timestamp_seconds gauge')
+        lines.append('sparkify_etl_last_run_timestamp_seconds{{pipeline="{}"}} {}'
+                     .format(self.pipeline, self.started))
+
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
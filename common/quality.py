@@ -0,0 +1,49 @@
+import operator
+import time
+from collections import namedtuple
+
+# a check passes when `<column of its source's metrics row> <op> <threshold>`
+# holds; the source is a query for the SQL projects and a table for Spark
+Check = namedtuple('Check', ['source', 'column', 'op', 'threshold'])
+
+OPERATORS = {'>': operator.gt, '>=': operator.ge, '==': operator.eq,
+             '<=': operator.le, '<': operator.lt}
+
+
+def evaluate(checks, source, row):
+    """Evaluates the checks of source on its metrics row, a dict by
+    column. A check whose column the row does not have was not measured
+    in this run and is skipped. Prints a line per check and returns
+    (check, value, passed) for every check evaluated."""
+    results = []
+    for check in checks:
+        if check.source != source:
+            continue
+        if check.column not in row:
+            print('  skip {} (not measured in this run)'.format(check.column))
+            continue
+        value = row[check.column]
+        passed = value is not None and OPERATORS[check.op](value, check.threshold)
+        results.append((check, value, passed))
+        print('  {:<4} {} = {} (expected {} {})'.format(
+            'ok' if passed else 'FAIL', check.column, value, check.op,
+            check.threshold))
+    return results
+
+
+def run_query_checks(cur, checks, recorder, query_name):
+    """Runs each query of the checks once and evaluates its checks on the
+    row it returns. Query times are added to recorder as 'check' records
+    under query_name(query). Prints a report and returns (check, value,
+    passed) for every check."""
+    results = []
+    for query in dict.fromkeys(check.source for check in checks):
+        start = time.perf_counter()
+        cur.execute(query)
+        columns = [column[0] for column in cur.description]
+        row = dict(zip(columns, cur.fetchone()))
+        seconds = time.perf_counter() - start
+        recorder.add('check', query_name(query), seconds)
+        print('{} ({:.3f}s)'.format(query_name(query), seconds))
+        results += evaluate(checks, query, row)
+    return results
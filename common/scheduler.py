@@ -0,0 +1,112 @@
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+# a unit of a load: func() runs once every stage named in needs has
+# finished. Needs that are not stages of the run are taken as met.
+Stage = namedtuple('Stage', ['name', 'func', 'needs'])
+
+
+class Scheduler:
+    """Runs stages on a thread pool as soon as the stages they need have
+    finished, up to `workers` at a time, and times each one as a stage
+    of `recorder` when one is given.
+
+    Finished stages are recorded in the JSON state file, so after a
+    failure run(resume=True) only runs the stages that did not finish.
+    The state file is removed once every stage has finished."""
+
+    def __init__(self, stages, workers=4, state_path=None, recorder=None):
+        self.stages = {stage.name: stage for stage in stages}
+        if len(self.stages) != len(stages):
+            raise ValueError('duplicate stage names')
+        self.workers = max(1, workers)
+        self.state_path = state_path
+        self.recorder = recorder
+        self.order()
+
+    def order(self):
+        """Returns the stage names in an order that respects their needs.
+        Raises ValueError if the needs form a cycle."""
+        order, visiting, visited = [], set(), set()
+
+        def visit(name):
+            if name in visited or name not in self.stages:
+                return
+            if name in visiting:
+                raise ValueError('stage {!r} needs itself'.format(name))
+            visiting.add(name)
+            for need in self.stages[name].needs:
+                visit(need)
+            visiting.discard(name)
+            visited.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    def load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return set()
+        with open(self.state_path) as f:
+            return set(json.load(f)['done']) & set(self.stages)
+
+    def save_state(self, done):
+        if not self.state_path:
+            return
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'done': sorted(done)}, f)
+        os.replace(tmp, self.state_path)
+
+    def run_stage(self, stage):
+        if self.recorder is None:
+            stage.func()
+        else:
+            with self.recorder.stage(stage.name):
+                stage.func()
+        print('{} done'.format(stage.name))
+
+    def run(self, resume=False):
+        """Runs the stages that have not finished yet. If a stage fails,
+        no new stage is started, the running ones are waited for, and the
+        first error is raised."""
+        done = self.load_state() if resume else set()
+        if done:
+            print('resuming after {}'.format(', '.join(sorted(done))))
+        self.save_state(done)
+
+        pending = [name for name in self.order() if name not in done]
+        running = {}
+        failed = None
+        with ThreadPoolExecutor(self.workers) as pool:
+            while pending or running:
+                for name in list(pending):
+                    if failed or len(running) == self.workers:
+                        break
+                    needs = [need for need in self.stages[name].needs
+                             if need in self.stages]
+                    if all(need in done for need in needs):
+                        pending.remove(name)
+                        running[pool.submit(self.run_stage, self.stages[name])] = name
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print('{} failed: {}'.format(name, e))
+                        failed = failed or e
+                        continue
+                    done.add(name)
+                    self.save_state(done)
+
+        if failed:
+            raise failed
+        if self.state_path and os.path.exists(self.state_path):
+            os.remove(self.state_path)